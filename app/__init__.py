@@ -11,8 +11,6 @@ import datetime
 from ByHelpers import applogger
 import app.utils.errors as errors
 import app.utils.db as db
-if APP_MODE == 'CONSUMER':
-    from ByHelpers.rabbit_engine import RabbitEngine
 from redis import Redis
 
 # Flask app declaration
@@ -44,7 +42,7 @@ def get_db():
     """
     try:
         if not hasattr(g, '_db'):
-            g._db = db.getdb()
+            g._db = db.shared_db()
     except Exception as e:
         logger.error("Could not connect to Database!!")
         logger.error(e)
@@ -93,6 +91,8 @@ def get_consumer(queue=None):
     """ App method to connect to rabbit consumer
     """
     try:
+        # Imported here: the module opens connections on import
+        from ByHelpers.rabbit_engine import RabbitEngine
         if not hasattr(g, "_consumer"):
             g._consumer = {}
         if queue != None and queue not in g._consumer:
@@ -110,6 +110,7 @@ def get_producer(queue=None):
     """ App method to connect to rabbit consumer
     """
     try:
+        from ByHelpers.rabbit_engine import RabbitEngine
         if not hasattr(g, "_producer"):
             g._producer = {}
         if queue != None and queue not in g._producer:
@@ -133,12 +134,11 @@ def before_request():
 @app.teardown_appcontext
 def close_db(error):
     ''' 
-        Close connection at the end of every request
+        Release the connection at the end of every request, the
+        process-wide cluster is only shut down at process exit
     '''
     logger.debug("Teardown Method")
-    gdb = getattr(g, '_db', None)
-    if gdb is not None:
-        gdb.close()  
+    g.pop('_db', None)
 
 @app.cli.command('initdb')
 def initdb_cmd():
@@ -149,13 +149,34 @@ def initdb_cmd():
 
 # Consumer command
 @app.cli.command('consumer')
-def consumer_cmd():
+@click.option('--batch-size', default=1, help="Messages written and acked together --batch-size=<N>")
+@click.option('--batch-ms', default=500, help="Max. milliseconds to gather a batch --batch-ms=<T>")
+@click.option('--workers', default=1, help="Supervised consumer processes --workers=<N>")
+def consumer_cmd(batch_size, batch_ms, workers):
     """ Execute app consumer
     """
+    if workers > 1:
+        from app.supervisor import Supervisor
+        Supervisor(workers, batch_size=batch_size, batch_ms=batch_ms).run()
+        return
     from app.consumer import start
-    start()
+    start(batch_size=batch_size, batch_ms=batch_ms)
     logger.info("Initialized database")
 
+# Consumer benchmark command
+@app.cli.command('consumer-bench')
+@click.option('--file', default=None, help="NDJSON capture of messages to replay --file=<path>")
+@click.option('--messages', default=1000, help="Messages to replay, 0 for the whole capture --messages=<N>")
+@click.option('--stores', default=50, help="Locations of each synthetic message --stores=<N>")
+@click.option('--latency-ms', default=1.0, help="Fake C* write latency --latency-ms=<T>")
+@click.option('--concurrency', default=CONSUMER_WRITE_CONCURRENCY, help="C* writes in flight, 0 for serial --concurrency=<N>")
+def consumer_bench_cmd(file, messages, stores, latency_ms, concurrency):
+    """ Replay messages through the consumer callback
+        against fake RabbitMQ and C*
+    """
+    from app.consumer_bench import run, report
+    report(run(file, messages, stores, latency_ms, concurrency))
+
 @app.cli.command('script')
 @click.option('--name', default=None, help="Provide the task name with the option --name=<script>")
 def dump_cmd(name):
@@ -49,6 +49,13 @@ celery_app.conf.accept_content = ['json','pickle']
 celery_app.conf.result_serializer = 'json'
 celery_app.conf.task_serializer = 'json'
 
+@worker_process_shutdown.connect
+def close_db(**kwargs):
+    """ Shut down the worker process C* connection
+    """
+    db.close_shared()
+
+
 def with_context(original_function):
     """ Flask Context decorator for inside execution
     """
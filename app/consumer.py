@@ -11,7 +11,17 @@ from functools import wraps
 from app.utils import db, errors
 from ByHelpers import applogger
 from app.models.price import Price
+from app.models.price_state import PriceState
+from app.models.daily_stats import DailyStats
+from app.utils.decoders import decode
+from app.utils.publisher import AsyncPublisher
+from app.utils.adaptive import AdaptiveConcurrency
+from app.utils.spool import Spool, SpoolReplayer
+from app.utils.metrics import REGISTRY, StatsDumper, start_http_server
 import sys
+import time
+import signal
+from contextlib import contextmanager
 
 logger = applogger.get_logger()
 
@@ -19,6 +29,52 @@ q_geoprice = QUEUE_GEOPRICE
 q_cache = QUEUE_CACHE
 # Global counter
 gcounter = 1
+# Shared counters [messages, rows, writes window], set by the supervisor
+counters = None
+# Last seen prices, set on start when change detection is enabled
+price_state = None
+# Background publisher of the cache queue, set on start
+publisher = None
+# Adaptive C* writes window, set on start
+write_controller = None
+# Disk spool of failed writes, set on start
+spool = None
+# Daily stats aggregates, set on start when enabled
+daily_stats = None
+# Supervisor slot of this worker, offsets the metrics port
+worker_slot = 0
+
+# Consumer metrics
+MESSAGES = REGISTRY.counter('geoprice_messages_total', 'Saved messages')
+ROWS = REGISTRY.counter('geoprice_rows_total', 'Written location rows')
+ERRORS = REGISTRY.counter(
+    'geoprice_message_errors_total', 'Failed messages by stage', 'stage')
+STAGE_SECONDS = REGISTRY.histogram(
+    'geoprice_stage_seconds', 'Consumer stage latency', 'stage')
+
+
+@contextmanager
+def timed(stage):
+    """ Observe the latency of a consumer stage
+    """
+    start = time.perf_counter()
+    yield
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage)
+
+
+def count(messages, rows):
+    """ Add saved messages and rows to the metrics and
+        the shared counters
+    """
+    MESSAGES.inc(messages)
+    ROWS.inc(rows)
+    if counters is None:
+        return
+    with counters.get_lock():
+        counters[0] += messages
+        counters[1] += rows
+        if write_controller:
+            counters[2] = write_controller.limit
 
 
 def with_context(original_function):
@@ -42,45 +98,414 @@ def with_context(original_function):
     return new_function
 
 
+def publish_price(new_price):
+    """ Publish saved price to the cache queue
+    """
+    global gcounter
+    if publisher:
+        publisher.send(new_price)
+    elif q_cache in g._producer and  g._producer[q_cache]:
+        g._producer[q_cache].send(new_price)
+    else:
+        logger.warning("Producer not initialized!")
+        logger.error(g._producer)
+        return
+    # Modify partition to distribute
+    if gcounter >= 20:
+        gcounter = 1
+    else:
+        gcounter += 1
+
+
+def open_stats(prices):
+    """ Mark the dates of prices about to be written as
+        covered by this worker (see `DailyStats.covered`)
+    """
+    if daily_stats is None or not daily_stats.enabled:
+        return
+    for price in prices:
+        if price.date in daily_stats.days:
+            continue
+        try:
+            daily_stats.open(g._db, price.date)
+        except NoHostAvailable:
+            raise
+        except Exception as e:
+            logger.error("Could not mark stats date {}".format(price.date))
+            logger.error(e)
+
+
+def add_stats(price):
+    """ Add a written price to the daily stats aggregates,
+        flushing them every CONSUMER_STATS_FLUSH_SECS
+    """
+    if daily_stats is None or not daily_stats.enabled:
+        return
+    daily_stats.add(price)
+    if time.time() - daily_stats.last_flush >= CONSUMER_STATS_FLUSH_SECS:
+        flush_stats()
+
+
+def flush_stats(closing=False):
+    """ Write the daily stats aggregates as partial rows,
+        marking the dates complete when `closing`
+    """
+    if daily_stats is None:
+        return
+    try:
+        if closing:
+            daily_stats.close(g._db)
+        else:
+            daily_stats.flush(g._db)
+    except Exception as e:
+        logger.error("Could not flush daily stats")
+        logger.error(e)
+
+
+def write_prices(prices, batched=False):
+    """ Write prices to C*, spooling failed writes to disk when
+        the spool is enabled (spooled writes are not failures)
+
+        Params:
+        -----
+        prices : list
+            Price instances
+        batched : bool
+            Group writes in partition batches
+
+        Returns:
+        -----
+        list
+            Failed writes by table of each price
+    """
+    try:
+        failures = Price.save_many(
+            prices,
+            max(CONSUMER_WRITE_CONCURRENCY, 1),
+            batched=batched,
+            controller=write_controller
+        )
+    except NoHostAvailable as e:
+        if spool is None:
+            raise
+        logger.error("No Cassandra host available, spooling writes...")
+        logger.error(e)
+        failures = [{t: [e] for t in p.write_tables()} for p in prices]
+    if spool is None:
+        return failures
+    records = []
+    for price, fails in zip(prices, failures):
+        records += price.spool_records(fails.keys())
+    if not records:
+        return failures
+    try:
+        spool.append(records)
+    except Exception as e:
+        logger.error("Could not spool {} writes".format(len(records)))
+        logger.error(e)
+        return failures
+    logger.warning("Spooled {} writes".format(len(records)))
+    return [{} for _ in prices]
+
+
 # Rabbit MQ callback function
 def callback(ch, method, properties, body):
     global gcounter
+    stage = 'decode'
     try:
-        new_price = json.loads(body.decode('utf-8'))
-        logger.debug("Price "+new_price['retailer']+" - "+new_price['product_uuid']+" - stores: "+ str(len(new_price['location']['store'])))
+        with timed('decode'):
+            new_price = decode(body, properties.content_type)
+        stage = 'validate'
         # Valuamos las variables recibidas para verificar que tenga todos los datos
-        if not Price.validate(new_price):
+        with timed('validate'):
+            valid = Price.validate(new_price)
+            price = Price(new_price) if valid else None
+        if not valid:
+            ERRORS.inc(label='validate')
             logger.warning('Could not validate price')
-            pass
         else:
-            price = Price(new_price)
             # Set Partition value
             price.part = gcounter
+            # Drop unchanged observations
+            pending = price_state.filter([price])[0] if price_state else []
             # Save elements
-            price.save_all()
-            logger.info('Saved price for ' + price.retailer + ' ' + str(price.product_uuid))
-            # Publish message to price-cache
-            if q_cache in g._producer and  g._producer[q_cache]:
-                g._producer[q_cache].send(new_price)
-                # Modify partition to distribute
-                if gcounter >= 20:
-                    gcounter = 1
+            stage = 'write'
+            open_stats([price])
+            failures = {}
+            with timed('write'):
+                if not price.rows:
+                    logger.debug('Unchanged price, skipping writes')
+                elif CONSUMER_WRITE_CONCURRENCY > 0:
+                    failures = write_prices([price])[0]
                 else:
-                    gcounter += 1
-            else:
-                logger.warning("Producer not initialized!")
-                logger.error(g._producer)
+                    price.save_all()
+            if failures:
+                ERRORS.inc(label='write')
+            if price_state and not failures:
+                price_state.commit(pending)
+            if not failures:
+                add_stats(price)
+            logger.debug('Saved price for %s %s', price.retailer, price.product_uuid)
+            count(1, len(price.rows))
+            # Publish message to price-cache
+            stage = 'publish'
+            with timed('publish'):
+                publish_price(new_price)
     except NoHostAvailable as e:
         logger.error("No Cassandra host available, shutting down...")
         logger.error(e)
         sys.exit()
     except Exception as e:
+        ERRORS.inc(label=stage)
         logger.error(e)
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+    with timed('ack'):
+        ch.basic_ack(delivery_tag=method.delivery_tag)
+
+
+class BatchConsumer(object):
+    """ Micro-batching RabbitMQ callback: gathers up to `size`
+        messages or `ms` milliseconds of messages, writes them
+        together, acks the batch at once and nacks failed ones.
+    """
+
+    def __init__(self, size, ms):
+        self.size = size
+        self.ms = ms
+        self.channel = None
+        self.timer = None
+        self.buffer = []
+
+    def set_prefetch(self, engine, count):
+        """ Set the channel prefetch window right before
+            the RabbitEngine starts consuming
+        """
+        start_consuming = engine.start_consuming
+        def qos_start_consuming():
+            engine._channel.basic_qos(prefetch_count=count)
+            logger.info("Consumer prefetch set to {}".format(count))
+            start_consuming()
+        engine.start_consuming = qos_start_consuming
+
+    def __call__(self, ch, method, properties, body):
+        if self.channel is not None and ch is not self.channel:
+            # Reconnected, buffered tags belong to the dead channel
+            self.drop()
+        self.channel = ch
+        self.buffer.append((method, properties, body))
+        if len(self.buffer) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = ch.connection.add_timeout(
+                self.ms / 1000.0, self.flush)
+
+    def drop(self):
+        """ Forget the buffered messages of a closed channel,
+            the broker redelivers them
+        """
+        if self.buffer:
+            logger.warning("Dropping {} messages of a closed channel"
+                           .format(len(self.buffer)))
+        self.buffer = []
+        if self.timer is not None:
+            try:
+                self.channel.connection.remove_timeout(self.timer)
+            except Exception as e:
+                logger.debug(e)
+            self.timer = None
+
+    def flush(self):
+        """ Write buffered messages, then ack/nack them
+        """
+        global gcounter
+        if self.channel is not None and not self.channel.is_open:
+            self.drop()
+            return
+        if self.timer is not None:
+            self.channel.connection.remove_timeout(self.timer)
+            self.timer = None
+        batch, self.buffer = self.buffer, []
+        if not batch:
+            return
+        # Decode and validate, invalid messages are just acked
+        prices, failed = [], []
+        for method, properties, body in batch:
+            stage = 'decode'
+            try:
+                with timed('decode'):
+                    new_price = decode(body, properties.content_type)
+                stage = 'validate'
+                with timed('validate'):
+                    valid = Price.validate(new_price)
+                    price = Price(new_price) if valid else None
+                if not valid:
+                    ERRORS.inc(label='validate')
+                    logger.warning('Could not validate price')
+                    continue
+                price.part = gcounter
+                prices.append((method, new_price, price))
+            except Exception as e:
+                ERRORS.inc(label=stage)
+                logger.error(e)
+        # Drop unchanged observations
+        if price_state:
+            pending = price_state.filter([p for _, _, p in prices])
+        else:
+            pending = [[] for _ in prices]
+        # Write all prices together
+        try:
+            open_stats([p for _, _, p in prices])
+            with timed('write'):
+                failures = write_prices(
+                    [p for _, _, p in prices],
+                    batched=CONSUMER_BATCH_KB > 0
+                )
+        except NoHostAvailable as e:
+            # Unacked messages are redelivered to other consumers
+            logger.error("No Cassandra host available, shutting down...")
+            logger.error(e)
+            sys.exit()
+        for (method, new_price, price), fails, entries \
+                in zip(prices, failures, pending):
+            if fails:
+                ERRORS.inc(label='write')
+                failed.append(method)
+                continue
+            if price_state:
+                price_state.commit(entries)
+            add_stats(price)
+            count(1, len(price.rows))
+            try:
+                with timed('publish'):
+                    publish_price(new_price)
+            except Exception as e:
+                ERRORS.inc(label='publish')
+                logger.error(e)
+        with timed('ack'):
+            # Nack failed messages, retrying them only once
+            for method in failed:
+                self.channel.basic_nack(
+                    delivery_tag=method.delivery_tag,
+                    requeue=not method.redelivered
+                )
+            # Ack the rest of the batch at once, up to the highest
+            # tag still outstanding (nacked tags are not)
+            nacked = set(m.delivery_tag for m in failed)
+            acked = [m.delivery_tag for m, _, _ in batch
+                     if m.delivery_tag not in nacked]
+            if acked:
+                self.channel.basic_ack(delivery_tag=max(acked), multiple=True)
+        logger.info("Saved batch of {} prices ({} failed)"
+                    .format(len(prices) - len(failed), len(failed)))
+
+
+def register_gauges(db, replayer=None):
+    """ Gauges of the consumer state, read on render
+    """
+    REGISTRY.gauge('geoprice_writes_in_flight', 'C* writes in flight',
+                   fn=lambda: db.inflight)
+    if write_controller:
+        REGISTRY.gauge('geoprice_write_window', 'Adaptive C* writes window',
+                       fn=lambda: write_controller.limit)
+    if publisher:
+        REGISTRY.gauge('geoprice_publish_buffer', 'Buffered cache messages',
+                       fn=publisher.buffer.qsize)
+    if spool:
+        REGISTRY.gauge('geoprice_spooled_rows', 'Rows spooled to disk',
+                       fn=lambda: spool.spooled)
+    if replayer:
+        REGISTRY.gauge('geoprice_replayed_rows', 'Spooled rows replayed',
+                       fn=lambda: replayer.replayed)
 
 
 @with_context
-def start():
-    g._consumer[q_geoprice].set_callback(callback)
-    logger.info("Callback set for rabbitmq consumer")
-    g._consumer[q_geoprice].run()
+def start(batch_size=1, batch_ms=500):
+    """ Start consuming, one message at a time or micro-batches
+        when `batch_size` > 1
+    """
+    global price_state, publisher, write_controller, spool, daily_stats
+    consumer = g._consumer[q_geoprice]
+    if CONSUMER_ADAPTIVE_WRITES and CONSUMER_WRITE_CONCURRENCY > 0:
+        write_controller = AdaptiveConcurrency(
+            maximum=CONSUMER_WRITE_CONCURRENCY,
+            target_ms=CONSUMER_WRITE_TARGET_MS
+        )
+        logger.info("Adaptive writes window up to {} (p99 target {} ms)"
+                    .format(CONSUMER_WRITE_CONCURRENCY, CONSUMER_WRITE_TARGET_MS))
+    if CONSUMER_PUBLISH_BUFFER > 0:
+        publisher = AsyncPublisher(q_cache, limit=CONSUMER_PUBLISH_BUFFER)
+    replayer = None
+    if CONSUMER_SPOOL_DIR:
+        db = g._db
+        # Writes slower than the deadline time out and get spooled
+        db.set_timeout(CONSUMER_SPOOL_DEADLINE_MS / 1000.0)
+        db.set_timeout(CONSUMER_SPOOL_DEADLINE_MS / 1000.0, 'write')
+        spool = Spool(CONSUMER_SPOOL_DIR, segment_mb=CONSUMER_SPOOL_SEGMENT_MB)
+        replayer = SpoolReplayer(
+            spool,
+            lambda records: Price.save_spooled(db, records),
+            rate=CONSUMER_SPOOL_RATE,
+            healthy=write_controller.healthy if write_controller else None
+        )
+        logger.info("Spooling failed writes to {}".format(CONSUMER_SPOOL_DIR))
+    # Without stats no dates are marked: the flag must be set on
+    # every consumer for the daily job to use the partials
+    if CONSUMER_STATS_FLUSH_SECS > 0:
+        daily_stats = DailyStats()
+        logger.info("Flushing daily stats every {}s"
+                    .format(CONSUMER_STATS_FLUSH_SECS))
+    register_gauges(g._db, replayer)
+    dumper = None
+    if CONSUMER_METRICS_PORT:
+        start_http_server(CONSUMER_METRICS_PORT + worker_slot)
+    if CONSUMER_METRICS_SECS > 0:
+        dumper = StatsDumper(CONSUMER_METRICS_SECS)
+    if CONSUMER_DEDUP_WINDOW > 0:
+        price_state = PriceState(
+            CONSUMER_DEDUP_WINDOW,
+            size=CONSUMER_DEDUP_SIZE,
+            redis=getattr(g, '_redis', None) if CONSUMER_DEDUP_REDIS else None
+        )
+        logger.info("Skipping unchanged prices within {}s"
+                    .format(CONSUMER_DEDUP_WINDOW))
+    if batch_size > 1:
+        batcher = BatchConsumer(batch_size, batch_ms)
+        batcher.set_prefetch(consumer, batch_size * 2)
+        consumer.set_callback(batcher)
+        logger.info("Batch callback set for rabbitmq consumer ({} msgs / {} ms)"
+                    .format(batch_size, batch_ms))
+    else:
+        batcher = None
+        consumer.set_callback(callback)
+        logger.info("Callback set for rabbitmq consumer")
+
+    def drain():
+        """ Flush pending batch and stop consuming, the
+            ioloop stops once the channel is closed
+        """
+        consumer._closing = True
+        if batcher:
+            batcher.flush()
+        consumer.stop_consuming()
+
+    def on_sigterm(signum, frame):
+        # Signalled by both the stop script and the supervisor
+        if getattr(consumer, '_closing', False):
+            return
+        logger.info("Draining consumer...")
+        consumer._connection.add_timeout(0, drain)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    try:
+        consumer.run()
+    finally:
+        # Also on sys.exit (NoHostAvailable) or a lost connection,
+        # dates are only marked complete when fully flushed
+        flush_stats(closing=True)
+    if dumper:
+        dumper.stop()
+    if replayer:
+        replayer.stop()
+        spool.close()
+    if publisher:
+        publisher.close()
+    logger.info("Consumer stopped")
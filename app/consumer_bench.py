@@ -0,0 +1,216 @@
+"""
+Offline consumer benchmark: replays NDJSON captured messages (or
+synthetic ones with a given store fan-out) through the consumer
+`callback`, against an in-process fake RabbitMQ channel and a
+recording fake C* session with a configurable write latency.
+
+Run as:
+    `flask consumer-bench --stores=300 --messages=500 --latency-ms=2`
+    `flask consumer-bench --file=capture.ndjson`
+"""
+import json
+import time
+import uuid
+import datetime
+from types import SimpleNamespace
+from flask import g
+from config import *
+from ByHelpers import applogger
+from app import consumer
+from app.utils.adaptive import percentile
+
+logger = applogger.get_logger()
+
+
+class FakePrepared(object):
+    """ Prepared statement stand-in, binding records the table
+    """
+
+    def __init__(self, query_string):
+        self.query_string = query_string
+        self.table = query_string.split()[2]
+
+    def bind(self, values):
+        return (self.table, tuple(values))
+
+
+class RecordingCassandra(object):
+    """ `SimpleCassandra` stand-in that records writes by table
+        and waits `latency_ms` per write (once per in-flight
+        window on pipelined writes)
+    """
+
+    def __init__(self, latency_ms=1.0):
+        self.latency = latency_ms / 1000.0
+        self.writes = {}
+        self.inflight = 0
+        self._prepared = {}
+
+    def record(self, stmt):
+        table = stmt[0] if isinstance(stmt, tuple) else 'raw'
+        self.writes[table] = self.writes.get(table, 0) + 1
+
+    def prepare(self, qry):
+        if qry not in self._prepared:
+            self._prepared[qry] = FakePrepared(qry)
+        return self._prepared[qry]
+
+    def execute(self, qry, args=(), timeout=200):
+        time.sleep(self.latency)
+        self.record(qry)
+        return []
+
+    def execute_concurrent(self, statements_and_params, concurrency=100):
+        results = []
+        for i, (stmt, _) in enumerate(statements_and_params):
+            if i % concurrency == 0:
+                time.sleep(self.latency)
+            self.record(stmt)
+            results.append((True, []))
+        return results
+
+    def execute_adaptive(self, statements, controller, on_done=None,
+                         profile=None):
+        results = []
+        while len(results) < len(statements):
+            window = statements[len(results):len(results) + max(controller.limit, 1)]
+            time.sleep(self.latency)
+            for stmt in window:
+                self.record(stmt)
+                controller.record(self.latency)
+                if on_done is not None:
+                    on_done(len(results), self.latency, None)
+                results.append((True, []))
+        return results
+
+
+class FakeChannel(object):
+    """ RabbitMQ channel stand-in counting acks/nacks
+    """
+
+    def __init__(self):
+        self.acks = 0
+        self.nacks = 0
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acks += 1
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.nacks += 1
+
+
+class FakeProducer(object):
+    """ Cache queue producer stand-in
+    """
+
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, message):
+        self.sent += 1
+
+
+def build_message(stores):
+    """ Synthetic price message with `stores` locations
+    """
+    return {
+        "source": "walmart",
+        "retailer": "walmart",
+        "product_uuid": str(uuid.uuid4()),
+        "gtin": "07501043100137",
+        "price": 80.00,
+        "price_original": 100.00,
+        "promo": "2x10",
+        "currency": "MXN",
+        "date": datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+        "url": "https://super.walmart.com.mx/00750105590142",
+        "location": {
+            "store": [str(uuid.uuid4()) for _ in range(stores)],
+            "zip": ["14140"] * stores,
+            "city": ["México"] * stores,
+            "state": ["México"] * stores,
+            "country": ["México"] * stores,
+            "coords": [{"lat": 19.4968732, "lng": -99.7232672}
+                       for _ in range(stores)]
+        }
+    }
+
+
+def load_bodies(path=None, messages=1000, stores=50):
+    """ Raw message bodies from an NDJSON capture (one message
+        per line) or synthetic ones
+    """
+    if path:
+        with open(path, 'rb') as f:
+            bodies = [line.strip() for line in f if line.strip()]
+        return bodies[:messages] if messages else bodies
+    return [json.dumps(build_message(stores)).encode('utf-8')
+            for _ in range(messages)]
+
+
+def run(path=None, messages=1000, stores=50, latency_ms=1.0,
+        concurrency=CONSUMER_WRITE_CONCURRENCY):
+    """ Replay messages through the consumer callback
+
+        Params:
+        -----
+        path : str
+            NDJSON capture, synthetic messages if not set
+        messages : int
+            Messages to replay (0: whole capture)
+        stores : int
+            Locations of each synthetic message
+        latency_ms : float
+            Fake C* write latency
+        concurrency : int
+            C* writes in flight (0: serial writes)
+
+        Returns:
+        -----
+        dict
+            Benchmark results
+    """
+    bodies = load_bodies(path, messages, stores)
+    db = RecordingCassandra(latency_ms)
+    g._db = db
+    g._producer = {QUEUE_CACHE: FakeProducer()}
+    consumer.CONSUMER_WRITE_CONCURRENCY = concurrency
+    channel = FakeChannel()
+    props = SimpleNamespace(content_type='application/json')
+    latencies = []
+    # Location rows, counted as the consumer metrics do
+    rows_before = consumer.ROWS.values.get(None, 0)
+    start = time.perf_counter()
+    for tag, body in enumerate(bodies, 1):
+        method = SimpleNamespace(delivery_tag=tag, redelivered=False)
+        t0 = time.perf_counter()
+        consumer.callback(channel, method, props, body)
+        latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - start
+    rows = consumer.ROWS.values.get(None, 0) - rows_before
+    return {
+        "messages": len(bodies),
+        "rows": rows,
+        "seconds": elapsed,
+        "msgs_sec": len(bodies) / elapsed if elapsed else 0.0,
+        "rows_sec": rows / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "acks": channel.acks,
+        "published": g._producer[QUEUE_CACHE].sent,
+        "writes": db.writes,
+        "writes_total": sum(db.writes.values()),
+    }
+
+
+def report(results):
+    """ Print benchmark results
+    """
+    print("{messages} msgs, {rows} rows in {seconds:.2f}s -> "
+          "{msgs_sec:,.1f} msgs/sec, {rows_sec:,.1f} rows/sec".format(**results))
+    print("Latency per message: p50 {p50_ms:.2f} ms, p99 {p99_ms:.2f} ms"
+          .format(**results))
+    print("Acked {acks}, published {published}".format(**results))
+    print("C* writes: {writes_total}".format(**results))
+    for table, writes in sorted(results['writes'].items()):
+        print("  {}: {} writes".format(table, writes))
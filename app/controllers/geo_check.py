@@ -3,6 +3,7 @@ from app import errors, logger
 from flask import Blueprint, g, request, jsonify
 from flask_cors import CORS, cross_origin
 from app.models.geo_check import Check
+from app.utils.catalogue import Catalogue
 
 mod = Blueprint("geo_check", __name__)
 
@@ -29,4 +30,11 @@ def check_stores(retailer):
     logger.info("Start checking stores...")
     valid_stores = Check.valid_stores(retailer)
     logger.info("Serving checked stores")
-    return jsonify(valid_stores)
\ No newline at end of file
+    return jsonify(valid_stores)
+
+@mod.route('/catalogue_cache')
+def check_catalogue_cache():
+    """ Catalogue cache size and hit/miss counters
+        of the serving worker
+    """
+    return jsonify(Catalogue.cache_stats())
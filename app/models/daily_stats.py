@@ -0,0 +1,313 @@
+#-*- coding: utf-8 -*-
+import math
+import time
+import datetime
+from uuid import uuid1
+from ByHelpers import applogger
+
+logger = applogger.get_logger()
+
+
+class Aggregate(object):
+    """ Mergeable running aggregate of the prices of a
+        (product_uuid, date): count, sum, sum of squares, min,
+        max and a small price histogram for the mode
+    """
+    __slots__ = ('source', 'count', 'total', 'squares', 'low', 'high', 'hist')
+    # Distinct prices kept for the mode
+    hist_size = 32
+
+    def __init__(self, source=None):
+        self.source = source
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.low = math.inf
+        self.high = -math.inf
+        self.hist = {}
+
+    def add(self, price, n=1):
+        """ Add `n` observations of a price
+        """
+        self.count += n
+        self.total += price * n
+        self.squares += price * price * n
+        self.low = min(self.low, price)
+        self.high = max(self.high, price)
+        key = round(price, 2)
+        if key in self.hist or len(self.hist) < self.hist_size:
+            self.hist[key] = self.hist.get(key, 0) + n
+
+    def merge(self, other):
+        """ Merge another aggregate (or partial stats row)
+        """
+        self.source = self.source or other.source
+        self.count += other.count
+        self.total += other.total
+        self.squares += other.squares
+        self.low = min(self.low, other.low)
+        self.high = max(self.high, other.high)
+        for key, n in (other.hist or {}).items():
+            self.hist[key] = self.hist.get(key, 0) + n
+        if len(self.hist) > self.hist_size:
+            top = sorted(self.hist.items(), key=lambda kv: -kv[1])
+            self.hist = dict(top[:self.hist_size])
+
+    @classmethod
+    def from_row(cls, row):
+        """ Aggregate of a `stats_partial_by_product` row
+        """
+        agg = cls(row.source)
+        agg.count = row.datapoints
+        agg.total = row.sum_price
+        agg.squares = row.sumsq_price
+        agg.low = row.min_price
+        agg.high = row.max_price
+        agg.hist = dict(row.hist_price or {})
+        return agg
+
+    def stats(self):
+        """ Final values as stored in `stats_by_product`
+            (sample std, as computed by pandas)
+        """
+        n = self.count
+        avg = self.total / n if n else 0.0
+        var = (self.squares - self.total * avg) / (n - 1) if n > 1 else 0.0
+        mode = max(self.hist.items(), key=lambda kv: kv[1])[0] \
+            if self.hist else avg
+        return {
+            "source": self.source,
+            "datapoints": n,
+            "avg_price": avg,
+            "std_price": math.sqrt(max(var, 0.0)),
+            "max_price": self.high if n else 0.0,
+            "min_price": self.low if n else 0.0,
+            "mode_price": mode
+        }
+
+
+def date_of(ts):
+    """ Prices date (YYYYMMDD) of a datetime
+    """
+    return int(ts.strftime('%Y%m%d'))
+
+
+class DailyStats(object):
+    """ Per (product_uuid, date) aggregates kept by the consumer
+        and flushed as partial rows to `stats_partial_by_product`,
+        the daily stats job merges them into `stats_by_product`.
+
+        Consumer workers with stats enabled mark the dates they
+        write prices of in `stats_coverage_by_date` before writing
+        them, and mark them complete once all their aggregates of
+        the date are flushed. The partials of a date are only used
+        when `covered` proves them complete; workers without stats
+        write no markers, so every consumer must enable them.
+
+        Params:
+        -----
+        enabled : bool
+            Whether prices are aggregated (False only marks dates)
+    """
+    # Partitions of a date in the partials table
+    buckets = 64
+    # Partials are only needed until the daily job runs
+    ttl = 60 * 60 * 24 * 7
+    insert_cql = """INSERT INTO stats_partial_by_product (
+            date, bucket, product_uuid, flush_id, source, datapoints,
+            sum_price, sumsq_price, min_price, max_price, hist_price
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) USING TTL ?"""
+    select_cql = """SELECT product_uuid, source, datapoints, sum_price,
+            sumsq_price, min_price, max_price, hist_price
+        FROM stats_partial_by_product WHERE date = %s AND bucket = %s"""
+    open_cql = """INSERT INTO stats_coverage_by_date (
+            date, worker_id, started, stats, complete
+        ) VALUES (%s, %s, %s, %s, false) USING TTL %s"""
+    complete_cql = """UPDATE stats_coverage_by_date USING TTL %s
+        SET complete = true WHERE date = %s AND worker_id = %s"""
+    coverage_cql = """SELECT worker_id, started, stats, complete
+        FROM stats_coverage_by_date WHERE date = %s"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.aggs = {}
+        self.flushed = 0
+        self.last_flush = time.time()
+        # Coverage markers of this worker
+        self.worker_id = uuid1()
+        self.started = datetime.datetime.utcnow()
+        self.days = set()
+        self.completed = set()
+
+    def open(self, session, date):
+        """ Mark a date as written by this worker, before any
+            of its prices is written
+        """
+        if date in self.days:
+            return
+        session.execute(self.open_cql, (date, self.worker_id, self.started,
+                                        self.enabled, self.ttl))
+        self.days.add(date)
+
+    def complete(self, session, closing=False):
+        """ Mark as complete the dates without pending aggregates,
+            past dates only unless the worker is `closing`
+
+            Returns:
+            -----
+            list
+                Dates marked complete
+        """
+        if not self.enabled:
+            return []
+        today = date_of(datetime.datetime.utcnow())
+        pending = set(date for _, date in self.aggs)
+        dates = sorted(d for d in self.days - self.completed - pending
+                       if closing or d < today)
+        for date in dates:
+            session.execute(self.complete_cql,
+                            (self.ttl, date, self.worker_id))
+            self.completed.add(date)
+        return dates
+
+    def add(self, price):
+        """ Add the written rows of a price, all of them
+            share the product, date and price
+        """
+        rows = price.rows
+        if not rows:
+            return
+        key = (rows[0][0], price.date)
+        agg = self.aggs.get(key)
+        if agg is None:
+            agg = self.aggs[key] = Aggregate(price.source)
+        agg.add(float(price.price), len(rows))
+
+    def flush(self, session, concurrency=50):
+        """ Write the running aggregates as partial rows and
+            reset them, failed ones are kept for the next flush
+
+            Params:
+            -----
+            session : SimpleCassandra
+                Cassandra session
+
+            Returns:
+            -----
+            int
+                Partial rows written
+        """
+        self.last_flush = time.time()
+        aggs, self.aggs = self.aggs, {}
+        if not aggs:
+            self.complete(session)
+            return 0
+        items = list(aggs.items())
+        flush_id = uuid1()
+        try:
+            stmt = session.prepare(self.insert_cql)
+            results = session.execute_concurrent([
+                (stmt.bind((
+                    date, product_uuid.int % self.buckets, product_uuid,
+                    flush_id, agg.source, agg.count, agg.total, agg.squares,
+                    agg.low, agg.high, agg.hist, self.ttl
+                )), None)
+                for (product_uuid, date), agg in items
+            ], concurrency=concurrency)
+        except Exception:
+            for key, agg in items:
+                self.restore(key, agg)
+            raise
+        written = 0
+        for (key, agg), (success, res) in zip(items, results):
+            if success:
+                written += 1
+                continue
+            logger.error(res)
+            self.restore(key, agg)
+        self.flushed += written
+        logger.info("Flushed {} partial stats ({} pending)"
+                    .format(written, len(self.aggs)))
+        self.complete(session)
+        return written
+
+    def close(self, session):
+        """ Flush the aggregates of a stopping worker and mark
+            its dates complete (the ones fully flushed)
+        """
+        if self.enabled:
+            self.flush(session)
+        self.complete(session, closing=True)
+
+    def restore(self, key, agg):
+        """ Put back an aggregate that could not be flushed
+        """
+        if key in self.aggs:
+            agg.merge(self.aggs[key])
+        self.aggs[key] = agg
+
+    @classmethod
+    def covered(cls, session, date):
+        """ Whether the partials of a date hold all its prices:
+            every worker that wrote prices of the date had stats
+            enabled and flushed all of them, and at least one of
+            them was already running when the date began (so no
+            worker before them went unmarked)
+
+            Params:
+            -----
+            session : SimpleCassandra
+                Cassandra session
+            date : int
+                Prices date (YYYYMMDD)
+
+            Returns:
+            -----
+            bool
+        """
+        rows = session.query(cls.coverage_cql, (date,))
+        if not rows:
+            logger.info("No consumer marked {}".format(date))
+            return False
+        for row in rows:
+            if not row.stats:
+                logger.warning("Worker {} wrote {} without stats"
+                               .format(row.worker_id, date))
+                return False
+            if not row.complete:
+                logger.warning("Worker {} did not complete {}"
+                               .format(row.worker_id, date))
+                return False
+        began = datetime.datetime.strptime(str(date), '%Y%m%d')
+        if min(row.started for row in rows) > began:
+            logger.warning("No marked worker running since {} began"
+                           .format(date))
+            return False
+        return True
+
+    @classmethod
+    def load(cls, session, date):
+        """ Merged partial aggregates of a date
+
+            Params:
+            -----
+            session : SimpleCassandra
+                Cassandra session
+            date : int
+                Prices date (YYYYMMDD)
+
+            Returns:
+            -----
+            dict
+                Aggregate by product_uuid
+        """
+        aggs = {}
+        for bucket in range(cls.buckets):
+            for row in session.iter_query(cls.select_cql, (date, bucket),
+                                          timeout=200, profile='bulk_scan'):
+                part = Aggregate.from_row(row)
+                if row.product_uuid in aggs:
+                    aggs[row.product_uuid].merge(part)
+                else:
+                    aggs[row.product_uuid] = part
+        return aggs
@@ -138,12 +138,10 @@ class Alert(Alarm):
         prods, rows = [], []
         # Loop stores
         for ch_items in chunks_items:
-            # Loop items
-            _temp_prods = []
-            for _chi in ch_items:
-                _temp_prods += g._catalogue.get_products_by_item(_chi, 
-                    cols=['product_uuid', 'name', 'item_uuid', 'gtin', 'source']) 
-                prods += _temp_prods
+            # Products of the chunk items, in one cached request
+            _temp_prods = g._catalogue.get_products_by_item(ch_items, 
+                cols=['product_uuid', 'name', 'item_uuid', 'gtin', 'source'])
+            prods += _temp_prods
             logger.info("Found {} products".format(len(_temp_prods)))
             ch_prods = [ _tp['product_uuid'] for _tp in _temp_prods]
             for ch_stores in chunks_stores:
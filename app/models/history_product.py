@@ -9,12 +9,14 @@ from collections import OrderedDict
 from flask import g
 import pandas as pd
 import numpy as np
-import requests
+from app.utils import http_session
 from app import errors, logger
 from config import *
 from app.models.item import Item
 from app.models.task import Task
 from app.utils.helpers import *
+from app.utils.store_directory import get_directory
+from app.utils.spatial import StoreIndex
 
 
 class Product(object):
@@ -86,19 +88,26 @@ class Product(object):
             FROM price_by_product_date WHERE product_uuid = %s
             AND date = %s
             """
-        qs = []
-        # Iterate for each product-date combination
-        for _p, _d in itertools.product(prod_uuids, _days):
-            try:
-                q = g._db.query(cass_query, 
-                    (UUID(_p), _d),
-                    timeout=10)
-                if not q:
-                    continue
-                qs += list(q)
-            except Exception as e:
-                logger.error("Cassandra Connection error: " + str(e))
-                continue
+        try:
+            # Stores within the radius, prices of other stores are dropped
+            near = {st['store_uuid']: st for st in get_directory()
+                    .stores_within(lat, lng, radius)}
+        except Exception as e:
+            logger.error(e)
+            logger.warning('Could not Generate filters from from geolocation')
+            return []
+        logger.info('Found {} stores within {} km'.format(len(near), radius))
+        if not near:
+            return []
+        # Query every product-date partition concurrently
+        fan = g._db.fan_out(cass_query,
+            list(itertools.product(valid_uuids(prod_uuids), _days)),
+            timeout=10)
+        qs = [row for _, rows in fan for row in rows
+              if str(row.store_uuid) in near]
+        if fan.errors:
+            logger.error("Cassandra Connection error in {} partitions: {}"
+                         .format(len(fan.errors), next(iter(fan.errors.values()))))
         logger.info("Fetched {} prices".format(len(qs)))
         logger.debug(qs[:1] if len(qs) > 1 else [])
         # Empty validation
@@ -109,35 +118,15 @@ class Product(object):
         filt_df['item_uuid'] = str(i_uuid) if i_uuid else ''
         filt_df['store_uuid'] = filt_df.store_uuid.astype(str)
         filt_df['product_uuid'] = filt_df.product_uuid.astype(str)
-        logger.info('Got prices, now fetching stores...')
-        # Get all stores from geolocation and save into DF
-        stores_df = get_all_stores()
-        # Merge stores with prices to get (lat and lng)
-        filt_df = pd.merge(filt_df,
-            stores_df[['store_uuid', 'lat', 'lng', 'source']],
-            on='store_uuid', how='left')
-        try:
-            # Filter by coordinates and radius size
-            filt_df['distance'] = np\
-                .arccos(np.sin(np.deg2rad(filt_df.lat))
-                        * np.sin(np.deg2rad(lat))
-                        + np.cos(np.deg2rad(filt_df.lat))
-                        * np.cos(np.deg2rad(lat))
-                        * np.cos(np.deg2rad(lng)
-                                 - (np.deg2rad(filt_df.lng))
-                                 )
-                        ) * 6371
-            filt_df = filt_df[filt_df['distance'] <= radius]
-            # Drop store duplicates
-            filt_df.sort_values(['time'],
-                ascending=[0], inplace=True)
-            filt_df.drop_duplicates(subset='store_uuid',
-                keep='first', inplace=True)
-            logger.info('Filtered response, got {} products'.format(len(filt_df)))            
-        except Exception as e:
-            logger.error(e)
-            logger.warning('Could not Generate filters from from geolocation')
-            return []
+        # Add store source and distance
+        filt_df['source'] = filt_df.store_uuid.map(lambda x: near[x]['source'])
+        filt_df['distance'] = filt_df.store_uuid.map(lambda x: near[x]['distance'])
+        # Drop store duplicates
+        filt_df.sort_values(['time'],
+            ascending=[0], inplace=True)
+        filt_df.drop_duplicates(subset='store_uuid',
+            keep='first', inplace=True)
+        logger.info('Filtered response, got {} products'.format(len(filt_df)))
         # Compute discount
         filt_df['price_original'] = filt_df['price_original']\
             .apply(lambda x : x if (x and float(x) != 0.0) else np.nan)
@@ -157,9 +146,7 @@ class Product(object):
             .to_dict(orient='records')
         for i, irow in enumerate(prods):
             try:
-                tmp_store = stores_df\
-                            .loc[stores_df['store_uuid'] == irow['store_uuid']]\
-                            .to_dict(orient="records")[0]
+                tmp_store = near[irow['store_uuid']]
                 logger.debug(tmp_store)
                 d_time, d_name, d_address = Product.contact_store_info(tmp_store)
                 # If centralized, generate record for each store
@@ -248,19 +235,14 @@ class Product(object):
             WHERE product_uuid = %s
             AND date = %s
             """
-        qs = []
-        # Iterate for each product-date combination
-        for _p, _d in itertools.product(prod_uuids, _days):
-            try:
-                q = g._db.query(cass_query, 
-                    (UUID(_p), _d),
-                    timeout=10)
-                if not q:
-                    continue
-                qs += list(q)
-            except Exception as e:
-                logger.error("Cassandra Connection error: " + str(e))
-                continue
+        # Query every product-date partition concurrently
+        fan = g._db.fan_out(cass_query,
+            list(itertools.product(valid_uuids(prod_uuids), _days)),
+            timeout=10)
+        qs = [row for _, rows in fan for row in rows]
+        if fan.errors:
+            logger.error("Cassandra Connection error in {} partitions: {}"
+                         .format(len(fan.errors), next(iter(fan.errors.values()))))
         # Empty verification
         if len(qs) == 0:
             return {'history': {}, 'history_byretailer': {}}
@@ -364,7 +346,7 @@ class Product(object):
             try:
                 q = g._db.query(cass_query,
                     (UUID(_s), _d),
-                    timeout=120)
+                    timeout=120, profile='fast_read')
                 if not q:
                     continue
                 qs += list(q)
@@ -446,7 +428,7 @@ class Product(object):
             try:
                 q = g._db.query(cass_query,
                     (UUID(_s), _d, _delta),
-                    timeout=120)
+                    timeout=120, profile='fast_read')
                 if not q:
                     continue                
                 _count += list(q)[0].count
@@ -637,7 +619,7 @@ class Product(object):
             try: 
                 q = g._db.query(cass_query,
                     (UUID(_s), _d),
-                    timeout=120)
+                    timeout=120, profile='fast_read')
                 if not q:
                     continue                
                 _count += list(q)[0].count
@@ -800,19 +782,14 @@ class Product(object):
             WHERE product_uuid = %s
             AND date = %s
             """
-        qs = []
-        # Iterate for each product-date combination
-        for _p, _d in itertools.product(prod_uuids, _days):
-            try:
-                q = g._db.query(cass_query, 
-                    (UUID(_p), _d),
-                    timeout=10)
-                if not q:
-                    continue
-                qs += list(q)
-            except Exception as e:
-                logger.error("Cassandra Connection error: " + str(e))
-                continue
+        # Query every product-date partition concurrently
+        fan = g._db.fan_out(cass_query,
+            list(itertools.product(valid_uuids(prod_uuids), _days)),
+            timeout=10)
+        qs = [row for _, rows in fan for row in rows]
+        if fan.errors:
+            logger.error("Cassandra Connection error in {} partitions: {}"
+                         .format(len(fan.errors), next(iter(fan.errors.values()))))
         logger.info("Fetched {} prices".format(len(qs)))
         task.progress = 80
         logger.debug(qs[:1] if len(qs) > 1 else [])
@@ -1131,8 +1108,8 @@ class Product(object):
                     continue
                 ad_name = ad_f['item_uuid'].tolist()[0]
                 try:
-                    #ad_name = requests.get("http://"+SRV_ITEM+"/item/info/"+ad_name).json()['names'][0]
-                    ad_name = requests.get("http://"+SRV_CATALOGUE+"/item/details?uuid="+ad_name).json()['name'].upper()
+                    #ad_name = http_session.get("http://"+SRV_ITEM+"/item/info/"+ad_name).json()['names'][0]
+                    ad_name = http_session.get("http://"+SRV_CATALOGUE+"/item/details?uuid="+ad_name).json()['name'].upper()
                 except:
                     pass
                 # Fetch store name
@@ -1153,6 +1130,9 @@ class Product(object):
             df_to_exp = pd.concat(csv_df)
             task.progress = 100
             return df_to_exp.reset_index().to_dict(orient='records')
+        # Spatial index of the priced stores of each added item
+        added_idx = [StoreIndex(_ai.lat.values, _ai.lng.values)
+                     if not _ai.empty else None for _ai in added_dfs]
         # Construct Response
         _rows = []
         for _j, _jrow in fix_df.iterrows():
@@ -1165,9 +1145,7 @@ class Product(object):
                             'price']].to_dict()
             }
             _segs = []
-            for _ith, _deepai in enumerate(added_dfs):
-                # Use deep copy for calculations
-                _ai = _deepai.copy()
+            for _ith, _ai in enumerate(added_dfs):
                 # Set unfound price like dict
                 if _ai.empty:
                     _pds = Item.get_by_item(added[_ith]['item_uuid'], 
@@ -1192,25 +1170,19 @@ class Product(object):
                 if len(_ai) == 0:
                     _segs.append(_jkth)
                     continue
-                # Compute Distance
-                _ai['dist'] = np\
-                    .arccos(np.sin(np.deg2rad(_ai.lat))
-                        * np.sin(np.deg2rad(_jrow['lat']))
-                        + np.cos(np.deg2rad(_ai.lat))
-                        * np.cos(np.deg2rad(_jrow['lat']))
-                        * np.cos(np.deg2rad(_jrow['lng'])
-                                 - (np.deg2rad(_ai.lng))
-                                 )
-                        ) * 6371
-                # Sort by distance
-                _ai.sort_values(by=['dist'], inplace=True)
-                _ai.reset_index(inplace=True)
+                # Nearest priced store
+                _pos, _dist = added_idx[_ith].nearest(_jrow['lat'], _jrow['lng'])
+                if len(_pos):
+                    _near, _ndist = _ai.iloc[int(_pos[0])], float(_dist[0])
+                else:
+                    # No geolocated store
+                    _near, _ndist = _ai.iloc[0], np.nan
                 # Update jkth element
-                _jkth.update(_ai.loc[0][['store', 'price', 'dist']]\
-                                .to_dict())
+                _jkth.update({'store': _near['store'],
+                              'price': _near['price'],
+                              'dist': round(_ndist, 2)})
                 # Add difference (Fixed - Added)
-                _jkth['dist'] = round(_jkth['dist'], 2)
-                _jkth['diff'] = _jrow['price'] - _ai.loc[0]['price']
+                _jkth['diff'] = _jrow['price'] - _near['price']
                 # Add to segments
                 _segs.append(_jkth)
             # Add computed Segments to Row
@@ -1450,19 +1422,14 @@ class Product(object):
             WHERE product_uuid=%s
             AND date=%s
             """
-        qs = []
-        # Iterate for each product-date combination
-        for _p, _d in itertools.product(prod_uuids, _days):
-            try:
-                q = g._db.query(cass_query, 
-                    (UUID(_p), _d),
-                    timeout=10)
-                if not q:
-                    continue
-                qs += list(q)
-            except Exception as e:
-                logger.error("Cassandra Connection error: " + str(e))
-                continue
+        # Query every product-date partition concurrently
+        fan = g._db.fan_out(cass_query,
+            list(itertools.product(valid_uuids(prod_uuids), _days)),
+            timeout=10)
+        qs = [row for _, rows in fan for row in rows]
+        if fan.errors:
+            logger.error("Cassandra Connection error in {} partitions: {}"
+                         .format(len(fan.errors), next(iter(fan.errors.values()))))
         if len(qs) == 0:
             return {}
         # Fetch agg values:        
@@ -1523,21 +1490,15 @@ class Product(object):
             AND time > %s
             AND time < %s
             """
-        qs = []
-        count = 0
-        for _d in _days:
-            for store_uuid in uuids:
-                count += 1
-                try:
-                    q = g._db.query(cass_query, 
-                            (UUID(store_uuid), _d, _time, _time_plus),
-                            timeout=30)
-                    if not q:
-                        continue
-                    qs += list(q)
-                except Exception as e:
-                    logger.error("Cassandra Connection error: " + str(e))
-                    continue
+        # Query every store-date partition concurrently
+        fan = g._db.fan_out(cass_query,
+            [(UUID(store_uuid), _d, _time, _time_plus)
+             for _d in _days for store_uuid in uuids],
+            timeout=30, profile='fast_read')
+        qs = [row for _, rows in fan for row in rows]
+        if fan.errors:
+            logger.error("Cassandra Connection error in {} partitions: {}"
+                         .format(len(fan.errors), next(iter(fan.errors.values()))))
         if len(qs) == 0:
             return {'count' : 0}
         # Fetch agg values:        
@@ -1638,7 +1599,7 @@ class Product(object):
         _st_list = []
         for _r in _rets:
             try:
-                _stj = requests\
+                _stj = http_session\
                         .get(SRV_PROTOCOL+"://"+SRV_GEOLOCATION+"/store/retailer?key="+_r)\
                         .json()
                 for _i, _s in enumerate(_stj):
@@ -1724,7 +1685,7 @@ class Product(object):
                 continue
             ad_name = ad_f['item_uuid'].tolist()[0]
             try:
-                ad_name = requests.get(SRV_PROTOCOL+"://"+SRV_CATALOGUE+"/item/details?uuid="+ad_name).json()['name'].upper()
+                ad_name = http_session.get(SRV_PROTOCOL+"://"+SRV_CATALOGUE+"/item/details?uuid="+ad_name).json()['name'].upper()
             except:
                 pass
             _df = ad_f.copy()
@@ -1,6 +1,7 @@
 import json
 from flask import g
-import requests
+from app.utils import http_session
+from app.utils.catalogue_snapshot import get_snapshot, covers, project
 from app import logger
 from config import SRV_CATALOGUE, SRV_PROTOCOL
 
@@ -15,7 +16,7 @@ class Item(object):
         pass
 
     @staticmethod
-    def get_by_product(p_uuids, cols=['item_uuid']):
+    def get_by_product(p_uuids, cols=['item_uuid'], snapshot=False):
         """ Get list item_uuids from an item,
             given a product_uuids
 
@@ -25,6 +26,9 @@ class Item(object):
                 List of Product UUIDs
             cols : list
                 List of additional columns to call
+            snapshot : bool
+                Read from the catalogue snapshot (batch jobs
+                only, it can be up to 48h old)
 
             Returns: 
             -----
@@ -32,6 +36,13 @@ class Item(object):
                 List of product with respective cols
         """
         _k, items = 100, []
+        # Products from the snapshot, only misses are requested
+        snap = get_snapshot() if snapshot else None
+        if snap is not None and covers(cols):
+            items, p_uuids = snap.products(p_uuids)
+            items = project(items, cols, ('product_uuid',))
+            logger.debug("{} products from snapshot, {} missing"
+                         .format(len(items), len(p_uuids)))
         # Iterate over batches of lenght: _k
         for i in range(0, len(p_uuids), _k):
             _pbatch = p_uuids[i: i+_k]
@@ -42,7 +53,7 @@ class Item(object):
                         cols=','.join(cols))
             logger.debug(url)
             try:
-                r = requests.get(url)
+                r = http_session.get(url)
                 logger.debug(r.status_code)
                 # In case of error
                 if r.status_code != 200:
@@ -78,7 +89,7 @@ class Item(object):
                     cols=','.join(cols))
         logger.debug(url)
         try:
-            r = requests.get(url)
+            r = http_session.get(url)
             logger.debug(r.status_code)
             # In case of error
             if r.status_code != 200:
@@ -96,7 +107,7 @@ class Item(object):
         return products
 
     @staticmethod
-    def get_by_items_and_retailers(items, retailers):
+    def get_by_items_and_retailers(items, retailers, snapshot=False):
         """ Get list of products given an 
             item_uuid, with specified table columns.
 
@@ -106,6 +117,10 @@ class Item(object):
                 Item UUID
             cols : list
                 List of requested table columns
+            snapshot : bool
+                Read from the catalogue snapshot (batch jobs
+                only, it misses products added after it was
+                built for the items it holds)
 
             Returns: 
             -----
@@ -114,11 +129,16 @@ class Item(object):
         """
 
         chunk_size = 100
+        products = []
+        # Products from the snapshot, only misses are requested
+        snap = get_snapshot() if snapshot else None
+        if snap is not None and snap.has_sources(retailers):
+            products, items = snap.by_items(items, retailers)
+            logger.debug("{} products from snapshot, {} items missing"
+                         .format(len(products), len(items)))
 
         chunk_items = Item.divide_chunks(items, chunk_size)
 
-        products = []
-
         for items in chunk_items:
             logger.debug('chunk ')
             url = SRV_PROTOCOL + '://' + SRV_CATALOGUE + \
@@ -127,7 +147,7 @@ class Item(object):
                         retailers=','.join(retailers))
             logger.debug(url)
             try:
-                r = requests.get(url)
+                r = http_session.get(url)
                 logger.debug(r.status_code)
                 # In case of error
                 if r.status_code != 200:
@@ -161,7 +181,7 @@ class Item(object):
         headers = {'content-type': 'application/json'}
         logger.debug(url)
         try:
-            resp = requests.request("POST", url, data=payload, headers=headers)
+            resp = http_session.request("POST", url, data=payload, headers=headers)
             logger.debug(resp.status_code)
             return resp.json()
         except Exception as e:
@@ -194,7 +214,7 @@ class Item(object):
                     ipp=_ipp)
         logger.debug(url)
         try:
-            r = requests.get(url)
+            r = http_session.get(url)
             logger.debug(r.status_code)
             # In case of error
             if r.status_code != 200:
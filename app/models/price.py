@@ -1,6 +1,10 @@
 #-*- coding: utf-8 -*-
 from flask import g
-from config import CASSANDRA_TTL
+from config import CASSANDRA_TTL, CONSUMER_WRITE_CONCURRENCY, \
+    CONSUMER_BATCH_KB
+from cassandra.cluster import NoHostAvailable
+from cassandra.query import BatchStatement, BatchType
+from collections import OrderedDict
 import datetime
 import json
 import uuid
@@ -10,10 +14,44 @@ import warnings
 from uuid import UUID
 import pandas as pd
 from time import time
+from operator import itemgetter
+from app.utils.adaptive import FixedConcurrency
+from app.utils.metrics import REGISTRY
 
 # Database connection:  db.session
 logger = applogger.get_logger()
 
+# Write metrics by table
+WRITE_SECONDS = REGISTRY.histogram(
+    'geoprice_write_seconds', 'C* write latency by table', 'table')
+WRITE_ERRORS = REGISTRY.counter(
+    'geoprice_write_errors_total', 'Failed C* writes by table', 'table')
+
+
+def _float(val):
+    """ Float cast keeping nulls
+    """
+    return float(val) if val is not None else None
+
+
+class Location(object):
+    ''' Store location of a price, UUID and coordinates
+        are converted once when the price is received
+    '''
+    __slots__ = ('store', 'store_uuid', 'lat', 'lng',
+                 'zip', 'city', 'state', 'coords')
+
+    def __init__(self, store, coords, zip, city, state):
+        self.store = store
+        self.store_uuid = uuid.UUID(store)
+        self.coords = coords
+        self.lat = _float(coords['lat'])
+        self.lng = _float(coords['lng'])
+        self.zip = zip
+        self.city = city
+        self.state = state
+
+
 class Price(object):
     ''' All attributes received from kafka that a price can have
     '''
@@ -22,8 +60,7 @@ class Price(object):
     fields = [
         'product_uuid', 'gtin', 'store_uuid', 'product_id',
         'price','price_original','discount', 'currency',
-        'promo','date','location','coords','zips', 'source',
-        'stores', 'lats', 'lngs', 'cities', 'url', 'retailer'
+        'promo','date','location', 'source', 'url', 'retailer'
     ]
 
     product_uuid = None
@@ -37,16 +74,58 @@ class Price(object):
     discount = None
     promo = None
     date = None
-    coords = []
-    zips = []
-    stores = []
-    cities = []
-    states = []
-    lats = []
-    lngs = []
     location = {}
+    locations = []
+    _rows = None
     _part = None
     insert_ttl = CASSANDRA_TTL
+    # Positional layout of the compact per-location row
+    row_fields = (
+        'product_uuid', 'date', 'time', 'store_uuid', 'source',
+        'lat', 'lng', 'price', 'price_original', 'promo', 'url',
+        'currency', 'insert_ttl'
+    )
+    # Written columns by table, TTL is always bound last
+    table_columns = {
+        'price_by_product_date': (
+            'product_uuid', 'date', 'time', 'store_uuid', 'source',
+            'price', 'price_original', 'promo', 'currency', 'url'
+        ),
+        'price_by_product_store': (
+            'product_uuid', 'date', 'store_uuid', 'time', 'source',
+            'lat', 'lng', 'price', 'price_original', 'promo', 'url', 'currency'
+        ),
+        'price_by_store': (
+            'store_uuid', 'date', 'time', 'product_uuid', 'source',
+            'lat', 'lng', 'price', 'price_original', 'promo', 'url', 'currency'
+        ),
+        'promo': (
+            'product_uuid', 'date', 'time', 'store_uuid', 'source',
+            'lat', 'lng', 'price', 'price_original', 'promo', 'url', 'currency'
+        ),
+        'promo_by_store': (
+            'product_uuid', 'date', 'time', 'store_uuid', 'source',
+            'lat', 'lng', 'price', 'price_original', 'promo', 'url', 'currency'
+        ),
+    }
+    # Partition key columns by table
+    partition_keys = {
+        'price_by_product_date': ('product_uuid', 'date'),
+        'price_by_product_store': ('product_uuid', 'store_uuid', 'date'),
+        'price_by_store': ('store_uuid', 'date'),
+        'promo': ('product_uuid', 'date'),
+        'promo_by_store': ('store_uuid', 'date'),
+    }
+    # Validation schema of received messages
+    required_fields = (
+        'product_uuid', 'price', 'price_original', 'date', 'location'
+    )
+    number_types = (float, int)
+    # Tables only written when the price has a promo
+    promo_tables = ('promo', 'promo_by_store')
+    # Row projections by table, built below the class
+    table_binders = {}
+    partition_getters = {}
 
     def __init__(self, *initial_data, **kwargs):
         # Db session init
@@ -71,29 +150,13 @@ class Price(object):
             self.gtin = None
             #logger.error("Gtin invalid format, only int accepted: {}".format(self.gtin))
         # Locations
-        coords = []
-        zips = []
-        stores = []
-        cities = []
-        states = []
-        lats = []
-        lngs = []
-        for i in range(0,len(self.location['store'])):
-            # Explode location array into multiple
-            stores.append(self.location['store'][i])
-            coords.append(self.location['coords'][i])
-            zips.append(self.location['zip'][i])
-            cities.append(self.location['city'][i])
-            states.append(self.location['state'][i])
-            lats.append(self.location['coords'][i]['lat'])
-            lngs.append(self.location['coords'][i]['lng'])
-        self.stores = stores
-        self.coords = coords
-        self.zips = zips
-        self.cities = cities
-        self.states = states
-        self.lats = lats
-        self.lngs = lngs
+        loc = self.location
+        self.locations = [
+            Location(loc['store'][i], loc['coords'][i], loc['zip'][i],
+                     loc['city'][i], loc['state'][i])
+            for i in range(0, len(loc['store']))
+        ]
+        self._rows = None
         # Retailer as source
         self.source = self.retailer if not self.source else self.source
 
@@ -122,13 +185,13 @@ class Price(object):
             'promo' : self.promo if (self.promo != None and self.promo != 'null') else 0,
             'date' : self.date,
             'time' : self.time,
-            'store' : [sts if sts != None else '' for sts in self.stores],
-            'state' : [sts if sts != None else '' for sts in self.states],
-            'city' : [sts if sts != None else '' for sts in self.cities],
-            'zip' : [sts if sts != None else '' for sts in self.zips],
-            'coords' : self.coords,
-            'lat' : [ coords['lat'] for coords in self.location['coords'] ],
-            'lng' : [ coords['lng'] for coords in self.location['coords'] ],
+            'store' : [l.store if l.store != None else '' for l in self.locations],
+            'state' : [l.state if l.state != None else '' for l in self.locations],
+            'city' : [l.city if l.city != None else '' for l in self.locations],
+            'zip' : [l.zip if l.zip != None else '' for l in self.locations],
+            'coords' : [l.coords for l in self.locations],
+            'lat' : [l.lat for l in self.locations],
+            'lng' : [l.lng for l in self.locations],
         }
 
     @property
@@ -147,36 +210,30 @@ class Price(object):
 
     @staticmethod
     def validate(elem):
-        ''' Quick fields validation
+        ''' Quick fields validation, only checks the
+            precompiled `required_fields` and field types
         '''
-        logger.debug("Validating price")
-        req_vars = ["product_uuid","price","price_original","date","location"]
-        keys = list(elem.keys())
         # Si no tiene todas las keys requeridas regresamos False
-        if not set(req_vars).issubset(keys):
-            logger.error("Invalid price: not complete set of required params")
-            logger.debug(elem)
-            return False
+        for key in Price.required_fields:
+            if key not in elem:
+                logger.error("Invalid price: not complete set of required params")
+                return False
         # If there is no price, return False
-        try:
-            assert (type(elem['price']) is float or type(elem['price']) is int ) == True
-        except:
+        if type(elem['price']) not in Price.number_types:
             logger.error("Invalid price: error in price field")
             return False
         # Currency
-        try:
-            if 'currency' in elem:
-                assert type(elem['currency']) == str
-        except:
+        if 'currency' in elem and type(elem['currency']) is not str:
             logger.warning("Invalid price: error in currency field")
-            if 'currency' in elem:
-                del elem['currency']
+            del elem['currency']
         # Retailer or Source validation
         if 'retailer' not in elem and 'source' not in elem:
             logger.error("Missing Retailer or Source field")
             return False
         # If there is no location of the price, return False
-        if not elem['location'] or not elem['location']['coords'] or type(elem['location']['coords']) != list:
+        location = elem['location']
+        coords = location.get('coords') if type(location) is dict else None
+        if not coords or type(coords) is not list:
             logger.error("Invalid price: error in location")
             return False
         return True
@@ -185,7 +242,7 @@ class Price(object):
     def loc_generator(self):
         ''' Generator for locations in a price
         '''
-        for i in range(0,len(self.location['store'])):
+        for l in self.locations:
             yield {
                 'product_uuid' : uuid.UUID(self.product_uuid),
                 'gtin' :  self.gtin if self.gtin is None else int(self.gtin),
@@ -198,17 +255,94 @@ class Price(object):
                 'promo' : self.promo,
                 'date' : self.date,
                 'time' : self.time,
-                'store_uuid' : uuid.UUID(self.stores[i]),
-                'state' : self.states[i],
-                'city' : self.cities[i],
-                'zip' : self.zips[i],
-                'coords' : self.coords[i],
-                'lat' : self.lats[i],
-                'lng' : self.lngs[i],
+                'store_uuid' : l.store_uuid,
+                'state' : l.state,
+                'city' : l.city,
+                'zip' : l.zip,
+                'coords' : l.coords,
+                'lat' : l.lat,
+                'lng' : l.lng,
                 'part': self.part,
                 'insert_ttl': self.insert_ttl
             }
 
+    @property
+    def rows(self):
+        ''' Compact location rows laid out as `row_fields`, built
+            once and shared by every table writer
+        '''
+        if self._rows is None:
+            product_uuid = uuid.UUID(self.product_uuid)
+            price = float(self.price)
+            price_original = float(self.price_original) if self.price_original else price
+            self._rows = [
+                (product_uuid, self.date, self.time, l.store_uuid,
+                 self.source, l.lat, l.lng, price, price_original,
+                 self.promo, self.url, self.currency, self.insert_ttl)
+                for l in self.locations
+            ]
+        return self._rows
+
+    @staticmethod
+    def insert_cql(table):
+        """ Positional INSERT statement of a price table
+
+            Params:
+            -----
+            table : str
+                Table name in `table_columns`
+
+            Returns:
+            -----
+            str
+                CQL with `?` markers, TTL as last marker
+        """
+        cols = Price.table_columns[table]
+        return "INSERT INTO {} ({}) VALUES ({}) USING TTL ?".format(
+            table, ', '.join(cols), ', '.join(['?'] * len(cols))
+        )
+
+    @staticmethod
+    def prepared_insert(session, table):
+        """ Prepared INSERT of a table, raises when the server
+            rejected it (the markers can not run unprepared)
+        """
+        stmt = session.prepare(Price.insert_cql(table))
+        if stmt is None:
+            raise Exception("Could not prepare INSERT into {}".format(table))
+        return stmt
+
+    def save_rows(self, table):
+        """ Write every location row into a table through
+            its prepared INSERT (prepared once per session)
+
+            Params:
+            -----
+            table : str
+                Table name in `table_columns`
+        """
+        stmt = Price.prepared_insert(self.session, table)
+        bind = self.table_binders[table]
+        for row in self.rows:
+            self.session.execute(stmt.bind(bind(row)))
+
+    def write_tables(self):
+        """ Tables this price has to be written to
+        """
+        return [t for t in self.table_columns
+                if self.promo or t not in self.promo_tables]
+
+    def write_plan(self):
+        """ List of (table, bound statement) of every pending
+            write of this price
+        """
+        plan = []
+        for table in self.write_tables():
+            stmt = Price.prepared_insert(self.session, table)
+            bind = self.table_binders[table]
+            plan += [(table, stmt.bind(bind(row))) for row in self.rows]
+        return plan
+
 
     # Save price in every price table
     def save_all(self):
@@ -224,6 +358,177 @@ class Price(object):
 
         return True
 
+    def save_all_async(self, concurrency=CONSUMER_WRITE_CONCURRENCY,
+                       controller=None):
+        """ Save price in all tables pipelining the writes with
+            `execute_async`, keeping at most `concurrency` in flight.
+            Returns once every write is confirmed.
+
+            Params:
+            -----
+            concurrency : int
+                Max. writes in flight
+            controller : AdaptiveConcurrency
+                Adaptive writes window, overrides `concurrency`
+
+            Returns:
+            -----
+            dict
+                Failed writes by table (empty when all succeeded)
+        """
+        return Price.save_many([self], concurrency, controller=controller)[0]
+
+    def spool_records(self, tables):
+        """ (table, row) records of this price for the
+            given tables, to be spooled and replayed later
+        """
+        return [(table, row) for table in tables for row in self.rows]
+
+    @staticmethod
+    def save_spooled(session, records, concurrency=16):
+        """ Write spooled (table, row) records
+
+            Params:
+            -----
+            session : SimpleCassandra
+                Cassandra session
+            records : list
+                (table, row) records from `spool_records`
+            concurrency : int
+                Max. writes in flight
+
+            Returns:
+            -----
+            list
+                Records that could not be written
+        """
+        stmts = [
+            Price.prepared_insert(session, table)
+                .bind(Price.table_binders[table](row))
+            for table, row in records
+        ]
+        results = session.execute_concurrent(
+            [(stmt, None) for stmt in stmts], concurrency=concurrency)
+        return [rec for rec, (success, _) in zip(records, results)
+                if not success]
+
+    @staticmethod
+    def row_size(row):
+        """ Rough serialized size in bytes of a location row
+        """
+        return 120 + sum(len(v) for v in row if isinstance(v, str))
+
+    @staticmethod
+    def batch_plan(prices, max_bytes=CONSUMER_BATCH_KB * 1024):
+        """ Group the pending writes of several prices by table and
+            partition key into UNLOGGED batches of at most `max_bytes`.
+            Partitions with a single row are written as a bare statement.
+
+            Params:
+            -----
+            prices : list
+                Price instances
+            max_bytes : int
+                Batch size bound (C* guidance: 1-100kB)
+
+            Returns:
+            -----
+            list
+                (price indexes, table, statement) tuples
+        """
+        groups = OrderedDict()
+        for i, price in enumerate(prices):
+            rows = price.rows
+            for table in price.write_tables():
+                stmt = Price.prepared_insert(price.session, table)
+                bind = Price.table_binders[table]
+                pkey = Price.partition_getters[table]
+                for row in rows:
+                    groups.setdefault((table, pkey(row)), [])\
+                        .append((i, stmt.bind(bind(row)), Price.row_size(row)))
+        plan = []
+        for (table, _), writes in groups.items():
+            if len(writes) == 1:
+                plan.append(((writes[0][0],), table, writes[0][1]))
+                continue
+            batch, idxs, size = None, set(), 0
+            for i, bound, rsize in writes:
+                if batch is None or size + rsize > max_bytes:
+                    if batch is not None:
+                        plan.append((tuple(idxs), table, batch))
+                    batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+                    idxs, size = set(), 0
+                batch.add(bound)
+                idxs.add(i)
+                size += rsize
+            plan.append((tuple(idxs), table, batch))
+        return plan
+
+    @staticmethod
+    def save_many(prices, concurrency=CONSUMER_WRITE_CONCURRENCY, batched=False,
+                  controller=None):
+        """ Save several prices pipelining all of their writes
+            together, keeping at most `concurrency` in flight.
+            Returns once every write is confirmed.
+
+            Params:
+            -----
+            prices : list
+                Price instances
+            concurrency : int
+                Max. writes in flight
+            batched : bool
+                Group writes in partition UNLOGGED batches (`batch_plan`)
+            controller : AdaptiveConcurrency
+                Adaptive writes window, overrides `concurrency`
+
+            Returns:
+            -----
+            list
+                Failed writes by table of each price (same order)
+        """
+        if not prices:
+            return []
+        try:
+            if batched:
+                plan = Price.batch_plan(prices)
+            else:
+                plan = []
+                for i, price in enumerate(prices):
+                    plan += [((i,), table, stmt) for table, stmt in price.write_plan()]
+        except NoHostAvailable:
+            raise
+        except Exception as e:
+            # Statements could not be prepared, every write failed
+            logger.error("Could not plan writes: {}".format(e))
+            return [{t: [e] for t in p.write_tables()} for p in prices]
+        def observe(idx, latency, error):
+            table = plan[idx][1]
+            WRITE_SECONDS.observe(latency, table)
+            if error is not None:
+                WRITE_ERRORS.inc(label=table)
+
+        results = prices[0].session.execute_adaptive(
+            [stmt for _, _, stmt in plan],
+            controller or FixedConcurrency(concurrency),
+            on_done=observe,
+            profile='write'
+        )
+        failures = [{} for _ in prices]
+        for (idxs, table, _), (success, res) in zip(plan, results):
+            if not success:
+                for i in idxs:
+                    failures[i].setdefault(table, []).append(res)
+        for i, fails in enumerate(failures):
+            for table, errs in fails.items():
+                logger.error("{} writes failed in {} for {}: {}"
+                    .format(len(errs), table, prices[i].product_uuid, errs[0]))
+                # Cluster is gone, let the consumer handle it
+                for err in errs:
+                    if isinstance(err, NoHostAvailable):
+                        raise err
+        return failures
+
     # Save as raw price in json format
     def save_price_raw(self):
         """ [DEPRECATED] `price_raw` table saver method. 
@@ -282,19 +587,7 @@ class Price(object):
         """ `price_by_product_date` table save method
         """
         try:
-            for elem in self.loc_generator():
-                self.session.execute(
-                    """
-                    INSERT INTO price_by_product_date(
-                        product_uuid, date, time, store_uuid, source, price, price_original, promo, currency, url
-                    )
-                    VALUES(
-                        %(product_uuid)s, %(date)s, %(time)s, %(store_uuid)s, %(source)s, %(price)s, %(price_original)s, %(promo)s, %(currency)s, %(url)s
-                    )
-                    USING TTL %(insert_ttl)s
-                    """,
-                    elem
-                )
+            self.save_rows('price_by_product_date')
             logger.debug("OK save_price_by_product_date")
             return True
         except Exception as e:
@@ -334,19 +627,7 @@ class Price(object):
         """
         #try:
         if True:
-            for elem in self.loc_generator():
-                self.session.execute(
-                    """
-                    INSERT INTO price_by_product_store(
-                        product_uuid, date, store_uuid, time, source, lat, lng, price, price_original, promo, url, currency 
-                    )
-                    VALUES(
-                        %(product_uuid)s, %(date)s, %(store_uuid)s, %(time)s, %(source)s, %(lat)s, %(lng)s, %(price)s, %(price_original)s, %(promo)s, %(url)s, %(currency)s
-                    )
-                    USING TTL %(insert_ttl)s
-                    """,
-                    elem
-                )
+            self.save_rows('price_by_product_store')
             logger.debug("OK save_price_by_product_store")
             return True
         if False:
@@ -426,19 +707,7 @@ class Price(object):
         """ `price_by_store` table saver method
         """
         try:
-            for elem in self.loc_generator():
-                self.session.execute(
-                    """
-                    INSERT INTO price_by_store (
-                        store_uuid, date, time, product_uuid, source, lat, lng, price, price_original, promo, url, currency 
-                    )
-                    VALUES(
-                        %(store_uuid)s, %(date)s, %(time)s, %(product_uuid)s, %(source)s, %(lat)s, %(lng)s, %(price)s, %(price_original)s, %(promo)s, %(url)s, %(currency)s
-                    )
-                    USING TTL %(insert_ttl)s
-                    """,
-                    elem
-                )
+            self.save_rows('price_by_store')
             logger.debug("OK save_price_by_store")
             return True
         except Exception as e:
@@ -454,19 +723,7 @@ class Price(object):
         if not self.promo or self.promo == None or self.promo == '':
             return True
         try:
-            for elem in self.loc_generator():
-                self.session.execute(
-                    """
-                    INSERT INTO promo (
-                        product_uuid, date, time, store_uuid, source, lat, lng, price, price_original, promo, url, currency 
-                    )
-                    VALUES(
-                        %(product_uuid)s, %(date)s, %(time)s, %(store_uuid)s, %(source)s,%(lat)s, %(lng)s, %(price)s, %(price_original)s, %(promo)s, %(url)s, %(currency)s
-                    )
-                    USING TTL %(insert_ttl)s
-                    """,
-                    elem
-                )
+            self.save_rows('promo')
             logger.debug("OK save_promo")
             return True
         except Exception as e:
@@ -482,19 +739,7 @@ class Price(object):
             return True
 
         try:
-            for elem in self.loc_generator():
-                self.session.execute(
-                    """
-                    INSERT INTO promo_by_store (
-                        product_uuid, date, time, store_uuid, source, lat, lng, price, price_original, promo, url, currency 
-                    )
-                    VALUES(
-                        %(product_uuid)s, %(date)s, %(time)s, %(store_uuid)s, %(source)s, %(lat)s, %(lng)s, %(price)s, %(price_original)s, %(promo)s, %(url)s, %(currency)s
-                    )
-                    USING TTL %(insert_ttl)s
-                    """,
-                    elem
-                )
+            self.save_rows('promo_by_store')
             logger.debug("OK save_promo_by_store")
             return True
         except Exception as e:
@@ -575,7 +820,7 @@ class Price(object):
         return True
 
     def save_batch(self):
-        """ Store in batch for following tables:
+        """ Store in partition UNLOGGED batches for following tables:
             `price_by_product_date`
             `price_by_product_store`
             `price_by_store`
@@ -583,51 +828,8 @@ class Price(object):
             `promo_by_store`
         """ 
         try:
-            elem = list(self.loc_generator())[0]
-            self.session.execute(
-                """
-                BEGIN BATCH
-
-                INSERT INTO price_by_product_date(
-                        product_uuid, date, time, store_uuid, source, price, price_original, promo, currency, url
-                    )
-                    VALUES(
-                        %(product_uuid)s, %(date)s, %(time)s, %(store_uuid)s, %(source)s, %(price)s, %(price_original)s, %(promo)s, %(currency)s, %(url)s
-                    ) USING TTL %(insert_ttl)s ;
-
-                INSERT INTO price_by_product_store(
-                        product_uuid, date, store_uuid, source,  time, lat, lng, price, price_original, promo, url, currency
-                    )
-                    VALUES(
-                        %(product_uuid)s, %(date)s, %(store_uuid)s, %(source)s, %(time)s, %(lat)s, %(lng)s, %(price)s, %(price_original)s, %(promo)s, %(url)s, %(currency)s
-                    ) USING TTL %(insert_ttl)s;
-
-                INSERT INTO price_by_store (
-                    store_uuid, date, time, product_uuid, source, lat, lng, price, price_original, promo, url, currency
-                )
-                VALUES(
-                    %(store_uuid)s, %(date)s, %(time)s, %(product_uuid)s, %(source)s, %(lat)s, %(lng)s, %(price)s, %(price_original)s, %(promo)s, %(url)s, %(currency)s
-                ) USING TTL %(insert_ttl)s;
-
-                INSERT INTO promo (
-                    product_uuid, date, time, store_uuid, source, lat, lng, price, price_original, promo, url, currency
-                )
-                VALUES(
-                    %(product_uuid)s, %(date)s, %(time)s, %(store_uuid)s, %(source)s, %(lat)s, %(lng)s, %(price)s, %(price_original)s, %(promo)s, %(url)s, %(currency)s
-                ) USING TTL %(insert_ttl)s;
-
-                INSERT INTO promo_by_store (
-                    product_uuid, date, time, store_uuid, source, lat, lng, price, price_original, promo, url, currency
-                )
-                VALUES(
-                    %(product_uuid)s, %(date)s, %(time)s, %(store_uuid)s, %(source)s, %(lat)s, %(lng)s, %(price)s, %(price_original)s, %(promo)s, %(url)s, %(currency)s
-                ) USING TTL %(insert_ttl)s;
-
-                APPLY BATCH;
-                """,
-                elem
-            )
-            return True
+            failures = Price.save_many([self], batched=True)[0]
+            return not failures
         except Exception as e:
             logger.error(e)
             return False
@@ -695,28 +897,29 @@ class Price(object):
         now = datetime.datetime.utcnow()
         then = _date = now - datetime.timedelta(hours=abs(hours))
         logger.debug("Getting prices from {}".format(then))
-        _prices = []
+        # Latest price by (product, store)
+        _prices = {}
         # Query all prices
         while _date.date() <= now.date():
-            rows = g._db.query("""SELECT product_uuid,
+            for row in g._db.iter_query("""SELECT product_uuid,
                         store_uuid, price, time,
                         price_original, promo
                     FROM price_by_store
                     WHERE store_uuid = %s
                     AND date = %s """,
-                    (UUID(st_uuid), int(_date.strftime("%Y%m%d")) )
-            )
-            if rows:
-                _prices += rows
+                    (UUID(st_uuid), int(_date.strftime("%Y%m%d")) ),
+                    profile='fast_read'
+            ):
+                _key = (row.product_uuid, row.store_uuid)
+                if _key not in _prices or row.time > _prices[_key].time:
+                    _prices[_key] = row
             # add to date 
             _date += datetime.timedelta(days=1)
         if not _prices:
             logger.warning("Not prices found!")
             return []
-        # Remove duplicated prices
-        _df = pd.DataFrame(_prices)\
-                .sort_values('time', ascending=False)\
-                .drop_duplicates(['product_uuid', 'store_uuid'])
+        _df = pd.DataFrame(list(_prices.values()))\
+                .sort_values('time', ascending=False)
         # Cast UUIDs
         _df['product_uuid'] = _df.product_uuid.astype(str)
         _df['store_uuid'] = _df.store_uuid.astype(str)
@@ -731,4 +934,18 @@ class Price(object):
             else:
                 res.append(l[i-1:i+1])
 
-        return res
\ No newline at end of file
+        return res
+
+
+# Row projections of `Price.row_fields` into each table's bind order
+Price.table_binders = {
+    _table: itemgetter(*[
+        Price.row_fields.index(_col) for _col in _cols + ('insert_ttl',)
+    ])
+    for _table, _cols in Price.table_columns.items()
+}
+# Partition key of a location row by table
+Price.partition_getters = {
+    _table: itemgetter(*[Price.row_fields.index(_col) for _col in _cols])
+    for _table, _cols in Price.partition_keys.items()
+}
@@ -0,0 +1,120 @@
+#-*- coding: utf-8 -*-
+import json
+import time
+from collections import OrderedDict
+from ByHelpers import applogger
+from app.models.price import Price
+
+logger = applogger.get_logger()
+
+# Row positions of the state key and the compared values
+_KEY = tuple(Price.row_fields.index(f)
+             for f in ('product_uuid', 'store_uuid', 'date'))
+_SIGNATURE = tuple(Price.row_fields.index(f)
+                   for f in ('price', 'price_original', 'promo'))
+
+
+class PriceState(object):
+    """ Last seen (price, price_original, promo) by
+        (product_uuid, store_uuid, date), kept in a bounded
+        in-process LRU and optionally shared through Redis.
+
+        Unchanged observations are dropped from the price rows
+        unless the last write is older than `window` seconds,
+        so a heartbeat row is still written periodically.
+    """
+    # Redis keys expire after the partition day is over
+    redis_ttl = 60 * 60 * 48
+
+    def __init__(self, window, size=500000, redis=None):
+        self.window = window
+        self.size = size
+        self.redis = redis
+        self.lru = OrderedDict()
+        self.skipped = 0
+
+    @staticmethod
+    def redis_key(key):
+        return 'geoprice:last:{}:{}:{}'.format(*key)
+
+    def lookup(self, keys):
+        """ Last (signature, written time) of each key,
+            LRU misses are fetched from Redis in one round trip
+        """
+        found = {}
+        misses = []
+        for key in keys:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                found[key] = self.lru[key]
+            else:
+                misses.append(key)
+        if misses and self.redis is not None:
+            try:
+                vals = self.redis.mget([self.redis_key(k) for k in misses])
+            except Exception as e:
+                logger.warning("Could not read price state from redis")
+                logger.error(e)
+                vals = []
+            for key, val in zip(misses, vals):
+                if val is None:
+                    continue
+                sig, ts = json.loads(val)
+                found[key] = (tuple(sig), ts)
+        return found
+
+    def filter(self, prices):
+        """ Drop the rows of unchanged observations from each price
+
+            Params:
+            -----
+            prices : list
+                Price instances, their `rows` are filtered in place
+
+            Returns:
+            -----
+            list
+                Pending state entries of each price, to `commit`
+                once their writes are confirmed
+        """
+        now = time.time()
+        keys = [tuple(r[i] for i in _KEY) for p in prices for r in p.rows]
+        last = self.lookup(keys)
+        pending = []
+        for price in prices:
+            rows, entries = [], []
+            for row in price.rows:
+                key = tuple(row[i] for i in _KEY)
+                sig = tuple(row[i] for i in _SIGNATURE)
+                prev = last.get(key)
+                if prev and prev[0] == sig and now - prev[1] < self.window:
+                    self.skipped += 1
+                    continue
+                rows.append(row)
+                entries.append((key, sig))
+            price._rows = rows
+            pending.append(entries)
+        return pending
+
+    def commit(self, entries):
+        """ Record written observations as last seen
+        """
+        if not entries:
+            return
+        now = time.time()
+        for key, sig in entries:
+            self.lru[key] = (sig, now)
+            self.lru.move_to_end(key)
+        while len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+        if self.redis is None:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, sig in entries:
+                pipe.set(self.redis_key(key), json.dumps([sig, now]),
+                         ex=self.redis_ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Could not write price state to redis")
+            logger.error(e)
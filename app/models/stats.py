@@ -8,6 +8,8 @@ from flask import g
 from app import errors
 from app.models.item import Item
 from app.utils.helpers import *
+from app.utils.columnar import Columns
+from app.utils import http_session
 from app.models.task import Task
 from ByHelpers import applogger
 
@@ -113,7 +115,7 @@ class Stats(object):
         if not rets:
             try:
                 rets = [r['key']
-                        for r in requests
+                        for r in http_session
                         .get(SRV_PROTOCOL + "://" + SRV_GEOLOCATION+'/retailer/all')
                         .json()]
             except Exception as e:
@@ -173,29 +175,26 @@ class Stats(object):
                 WHERE product_uuid in ({})
                 AND date in {}"""
 
-        qs = []
+        # Prices as float64, values end up JSON serialized
+        qs = Columns(floats=np.float64)
 
         for puuids in chunk_puuids:
             cass_query_text = cass_query.format(', '.join(puuids), str(_days))
             logger.info(cass_query_text)
 
             try:
-                q = g._db.query(cass_query_text,
-                                timeout=1500000000000)
-                if q:
-                    qs += list(q)
+                g._db.query_columns(cass_query_text,
+                                    timeout=1500000000000,
+                                    columns=qs)
             except Exception as e:
                 logger.error("Cassandra Connection error: " + str(e))
 
         logger.info("Fetched {} prices".format(len(qs)))
-        logger.debug(qs[:1] if len(qs) > 1 else [])
         # Empty validation
         if len(qs) == 0:
             return pd.DataFrame({'date': [], 'product_uuid': []})
-        # Load Response into a DF
-        df = pd.DataFrame(qs)
-        df['product_uuid'] = df.product_uuid.astype(str)
-        return df
+        # Columns into a DF (UUIDs as str)
+        return qs.frame()
 
     @staticmethod
     def get_cassandra_by_retailers_and_period(prods, rets, dates):
@@ -249,7 +248,8 @@ class Stats(object):
                 WHERE product_uuid in ({})
                 AND date in {}"""
     
-        qs = []
+        # Prices as float64, values end up JSON serialized
+        qs = Columns(floats=np.float64)
 
         for puuids in chunk_puuids:
             for days in chunk_dates:
@@ -257,22 +257,18 @@ class Stats(object):
                 logger.info(cass_query_text)
 
                 try:
-                    q = g._db.query(cass_query_text,
-                                    timeout=1500000000000)
-                    if q:
-                        qs += list(q)
+                    g._db.query_columns(cass_query_text,
+                                        timeout=1500000000000,
+                                        columns=qs)
                 except Exception as e:
                     logger.error("Cassandra Connection error: " + str(e))
 
         logger.info("Fetched {} prices".format(len(qs)))
-        logger.debug(qs[:1] if len(qs) > 1 else [])
         # Empty validation
         if len(qs) == 0:
             return pd.DataFrame({'date': [], 'product_uuid': []})
-        # Load Response into a DF
-        df = pd.DataFrame(qs)
-        df['product_uuid'] = df.product_uuid.astype(str)
-        return df
+        # Columns into a DF (UUIDs as str)
+        return qs.frame()
 
     @staticmethod
     def get_actual_by_retailer_task(task_id, params):
@@ -1162,7 +1158,7 @@ class Stats(object):
         logger.debug("Retrieving stats by uuid..")
         # Retailers from service
         try:
-            items = requests.get(
+            items = http_session.get(
                 SRV_PROTOCOL + "://" + SRV_CATALOGUE + "/product/by/iuuid?keys={uuid}&ipp=50&cols=product_uuid".format(
                     uuid=uuid)).json()
             dates = [
@@ -1249,7 +1245,7 @@ class Stats(object):
         logger.debug("Retrieving stats by uuid..")
         # Retailers from service
         try:
-            items = requests.get(
+            items = http_session.get(
                 SRV_PROTOCOL + "://" + SRV_CATALOGUE + "/product/by/iuuid?keys={uuid}&ipp=50&cols=product_uuid".format(
                     uuid=uuid)).json()
             dates = [
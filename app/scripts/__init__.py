@@ -19,6 +19,9 @@ def start_script(script):
     elif script == 'create_backups':
         from app.scripts import create_backups as module
         module.start()
+    elif script == 'create_catalogue_snapshot':
+        from app.scripts import create_catalogue_snapshot as module
+        module.start()
     else:
         # raise
         logger.error("Could not find the specified module...")
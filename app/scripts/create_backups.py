@@ -57,33 +57,35 @@ def backup_daily_data(_day, rets=[]):
     # Fetch Data from a Day before for todays Aggregates
     _day = int((_day - datetime.timedelta(days=1)).isoformat().replace('-', ''))
     _daily_count, st_list = 0, stores.store_uuid.tolist()
-    # Fetch prices by store
+    # Fetch prices by store, one page at a time
     for _part, _st in enumerate(st_list):
         try:
-            q = g._db.query(cass_qry, (_day, UUID(_st)), timeout=200)
-            if not q:
-                continue
+            for _chunk, q in enumerate(g._db.iter_query(
+                    cass_qry, (_day, UUID(_st)), timeout=200,
+                    profile='bulk_scan', pages=True)):
+                if not q:
+                    continue
+                # Format response
+                dtr = pd.DataFrame(q).drop(['lat', 'lng'], axis=1, errors='ignore')
+                dtr['product_uuid'] = dtr.product_uuid.astype(str)
+                dtr['store_uuid'] = dtr.store_uuid.astype(str)
+                dtr = pd.merge(dtr, 
+                    stores[['store_uuid',
+                            'zip', 'city','state', 'lat','lng']], 
+                    on='store_uuid', how='left')
+                dtr['source'] = dtr['source'].fillna('')
+                # Count amount of prices
+                _daily_count += len(dtr)
+                # Send to S3, following pages of a store as extra parts
+                try:
+                    send_prices_parquet(
+                        dtr, _part if not _chunk else '{}_{}'.format(_part, _chunk))
+                except Exception as e:
+                    logger.warning("Issues storing in S3!")
+                    logger.error(e)
         except Exception as e:
             logger.error("Cassandra Connection error: " + str(e))
             continue
-        # Format response
-        dtr = pd.DataFrame(q).drop(['lat', 'lng'], axis=1, errors='ignore')
-        dtr['product_uuid'] = dtr.product_uuid.astype(str)
-        dtr['store_uuid'] = dtr.store_uuid.astype(str)
-        dtr = pd.merge(dtr, 
-            stores[['store_uuid',
-                    'zip', 'city','state', 'lat','lng']], 
-            on='store_uuid', how='left')
-        dtr['source'] = dtr['source'].fillna('')
-        # Count amount of prices
-        _daily_count += len(dtr)
-        # Send to S3
-        try:
-            send_prices_parquet(dtr, _part)
-        except Exception as e:
-            logger.warning("Issues storing in S3!")
-            logger.error(e)
-            continue
     logger.info("Found {} daily prices".format(_daily_count))
 
 def send_prices_parquet(data, _part):
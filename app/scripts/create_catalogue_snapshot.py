@@ -0,0 +1,64 @@
+"""
+    Script that exports the Catalogue product mapping
+    (product_uuid, item_uuid, source, gtin, name) of every
+    source into the memory-mapped snapshot read by the
+    web service and workers (`CATALOGUE_SNAPSHOT_DIR`).
+"""
+import os
+import sys
+from config import *
+from ByHelpers import applogger
+from app.utils.catalogue import Catalogue
+from app.utils.store_directory import get_directory
+from app.utils import catalogue_snapshot
+
+# Logger
+logger = applogger.get_logger()
+
+
+def get_sources():
+    """ Configured snapshot sources, or all the retailers
+        plus the dump data sources
+    """
+    if CATALOGUE_SNAPSHOT_SOURCES:
+        return CATALOGUE_SNAPSHOT_SOURCES.split(',')
+    sources = [r['key'] for r in get_directory().retailers()]
+    for src in TASK_ARG_CREATE_DUMPS.split(','):
+        if src and src not in sources:
+            sources.append(src)
+    return sources
+
+
+def start():
+    """ Fetch the catalogue of every source from the live
+        service and publish a new snapshot version, nothing
+        is published if any source fails (the current version
+        is kept)
+    """
+    if not CATALOGUE_SNAPSHOT_DIR:
+        logger.error("CATALOGUE_SNAPSHOT_DIR is not set!")
+        return
+    os.makedirs(CATALOGUE_SNAPSHOT_DIR, exist_ok=True)
+    catalogue = Catalogue(uri=SRV_CATALOGUE, protocol=SRV_PROTOCOL)
+    records = []
+    for src in get_sources():
+        logger.info("Getting catalogue of {}".format(src))
+        try:
+            prods = catalogue.get_by_source(
+                src,
+                cols=list(catalogue_snapshot.FIELDS),
+                qsize=2000,
+                snapshot=False,
+                strict=True
+            )
+        except Exception as e:
+            logger.error(e)
+            logger.error("Catalogue of {} incomplete, snapshot not published"
+                         .format(src))
+            sys.exit(1)
+        logger.info("Got {} products".format(len(prods)))
+        for p in prods:
+            p.setdefault('source', src)
+        records += prods
+    catalogue_snapshot.build(records, CATALOGUE_SNAPSHOT_DIR)
+    logger.info("Finished creating catalogue snapshot!")
@@ -5,10 +5,12 @@ from config import *
 import app as geoprice
 import json
 import datetime
+import numpy as np
 import pandas as pd
 from collections import OrderedDict
 from functools import wraps
 from app.utils.helpers import tuplize
+from app.utils.columnar import Columns
 from tqdm import tqdm
 from app.models.geo_dump import Dump, BUCKET
 
@@ -82,12 +84,12 @@ def get_prices(product_uuids, retailer_keys):
             tuplize(product_uuids, is_uuid=True), 
             _dates
         )
-    rows = g._db.query(
+    df = g._db.query_columns(
                     qry,
                     size=2000,
-                    timeout=40
-    )
-    df = pd.DataFrame(rows)
+                    timeout=40,
+                    columns=Columns(floats=np.float64)
+    ).frame()
     # Get the stats per retailer
     for ret in retailer_keys:
         # For empty DF
@@ -170,13 +172,15 @@ def start():
     # Loop the sources of data we want as base for the table
     for src in SOURCES:
         logger.info("Getting total items for {}".format(src))
-        total_items = g._catalogue.get_by_source(src, ['item_uuid', 'gtin'])
+        total_items = g._catalogue.get_by_source(src, ['item_uuid', 'gtin'],
+                                                 snapshot=True)
         logger.info(len(total_items))
         # Fetch products with item_uuid
         total_products = g._catalogue.get_product_details(
             [_ti['item_uuid'] for _ti in total_items if _ti['item_uuid']],
             cols=['item_uuid', 'gtin'],
-            loop_size=50
+            loop_size=50,
+            snapshot=True
         )
         logger.info(len(total_products))
         # Build stats
@@ -19,6 +19,7 @@ from config import *
 from ByHelpers import applogger
 from app.consumer import with_context
 from app.models.price import Price
+from app.models.daily_stats import DailyStats
 from app.utils.helpers import get_all_stores
 from uuid import UUID
 from tqdm import tqdm
@@ -58,22 +59,27 @@ def get_daily_data(_day, rets=[]):
     _daily_count, st_list, _tfiles = 0, stores.store_uuid.tolist(), []
     # Generate N tmp files depending on the param
     for _j in range(0, len(stores), NUM_BATCHES):
-        daily = []
+        # Stream pages into the TMP csv file
+        _tfile_name = BASE_DIR+'/data/tmp_{}_{}.csv'.format(_day, _j)
+        if os.path.exists(_tfile_name):
+            os.remove(_tfile_name)
+        _rows = 0
         for _st in tqdm(st_list[_j:_j+NUM_BATCHES], desc="Store Prices"):
             try:
-                q = g._db.query(cass_qry, (_day, UUID(_st)), timeout=200)
-                if not q:
-                    continue
-                daily += list(q)
+                for page in g._db.iter_query(cass_qry, (_day, UUID(_st)),
+                                             timeout=200, profile='bulk_scan',
+                                             pages=True):
+                    if not page:
+                        continue
+                    pd.DataFrame(page).to_csv(_tfile_name, mode='a',
+                                              header=not _rows)
+                    _rows += len(page)
             except Exception as e:
                 logger.error("Cassandra Connection error: " + str(e))
                 continue
-        if not daily:
+        if not _rows:
             continue
-        # Generate TMP csv file  
-        _tfile_name = BASE_DIR+'/data/tmp_{}_{}.csv'.format(_day, _j)
-        pd.DataFrame(daily).to_csv(_tfile_name)
-        _daily_count += len(daily)
+        _daily_count += _rows
         _tfiles.append(_tfile_name)
         logger.info("Created: " + _tfile_name)
     logger.info("Found {} daily prices".format(_daily_count))
@@ -179,15 +185,50 @@ def aggregate_daily(daily_files, _day):
     for taf in daily_files:
         os.remove(taf)
 
+def merge_partial_stats(_day):
+    """ Finalise the partial aggregates flushed by the
+        consumers for the day before and load them into C*
+
+        Params:
+        -----
+        _day : datetime.date
+            Date to set in aggregates
+
+        Returns:
+        -----
+        bool
+            Whether the partial aggregates were complete and
+            merged
+    """
+    _prev = int((_day - datetime.timedelta(days=1)).strftime('%Y%m%d'))
+    if not DailyStats.covered(g._db, _prev):
+        return False
+    aggs = DailyStats.load(g._db, _prev)
+    if not aggs:
+        return False
+    logger.info("Merged partial stats of {} products".format(len(aggs)))
+    for puuid, agg in tqdm(aggs.items(), desc="Writing.."):
+        elem = agg.stats()
+        elem['product_uuid'] = puuid
+        elem['date'] = int(_day.strftime('%Y%m%d'))
+        Price.delete_stats_by_product(elem)
+        Price.save_stats_by_product(elem)
+    logger.info("Stored {} daily prices".format(len(aggs)))
+    return True
+
 @with_context
 def daily_stats(_day):
-    """ Perform daily stats
+    """ Perform daily stats, from the consumers partial
+        aggregates when they cover the whole day
 
         Params:
         -----
         _day : datetime.date
             Querying date
     """
+    if merge_partial_stats(_day):
+        return
+    logger.info("No complete partial stats, aggregating raw prices")
     # Retrieve daily data
     daily_files = get_daily_data(_day)
     # Aggregate data and load into C* table
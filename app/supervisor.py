@@ -0,0 +1,155 @@
+"""
+Consumer supervisor: forks N consumer workers (each with its own C*
+session and RabbitEngine channel), restarts crashed ones with backoff,
+drains them on SIGTERM and aggregates their throughput counters.
+"""
+import os
+import multiprocessing as mp
+import signal
+import time
+from config import *
+from ByHelpers import applogger
+
+logger = applogger.get_logger()
+
+# Restart backoff (seconds)
+BACKOFF_MIN = 1
+BACKOFF_MAX = 60
+# A worker living longer than this resets its backoff
+STABLE_SECS = 60
+# Time given to workers to drain on shutdown
+DRAIN_SECS = 30
+
+
+def run_worker(slot, counters, batch_size, batch_ms):
+    """ Worker process entrypoint, connections are
+        built here (after fork) by the consumer context
+    """
+    # Ctrl-C is handled by the supervisor, SIGTERM by the consumer
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    from app import consumer
+    consumer.counters = counters
+    consumer.worker_slot = slot
+    logger.info("Starting consumer worker {}".format(slot))
+    consumer.start(batch_size=batch_size, batch_ms=batch_ms)
+
+
+class Supervisor(object):
+    """ Multi-process consumer supervisor
+    """
+
+    def __init__(self, workers, batch_size=1, batch_ms=500,
+                 stats_secs=CONSUMER_STATS_SECS):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.stats_secs = stats_secs
+        self.stopping = False
+        self.procs = {}
+        # Per slot state, counters survive worker restarts
+        self.counters = {
+            s: mp.Array('L', 3) for s in range(workers)
+        }
+        self.started = {}
+        self.backoff = {s: BACKOFF_MIN for s in range(workers)}
+        self.restart_at = {}
+
+    def spawn(self, slot):
+        """ Fork the worker of a slot
+        """
+        proc = mp.Process(
+            target=run_worker,
+            args=(slot, self.counters[slot], self.batch_size, self.batch_ms),
+            name="{}-worker-{}".format(APP_NAME, slot)
+        )
+        proc.start()
+        self.procs[slot] = proc
+        self.started[slot] = time.time()
+        logger.info("Spawned worker {} (pid {})".format(slot, proc.pid))
+
+    def stop(self, signum, frame):
+        """ Signal handler, start draining workers
+        """
+        logger.info("Supervisor received signal {}, draining..."
+                    .format(signum))
+        self.stopping = True
+
+    def check(self):
+        """ Schedule and apply restarts of dead workers,
+            none once stopping (workers may be signalled too)
+        """
+        if self.stopping:
+            return
+        now = time.time()
+        for slot, proc in self.procs.items():
+            if proc.is_alive():
+                continue
+            if slot not in self.restart_at:
+                # Worker died, back off if it was unstable
+                if now - self.started[slot] > STABLE_SECS:
+                    self.backoff[slot] = BACKOFF_MIN
+                logger.warning("Worker {} exited ({}), restarting in {}s"
+                               .format(slot, proc.exitcode, self.backoff[slot]))
+                self.restart_at[slot] = now + self.backoff[slot]
+                self.backoff[slot] = min(self.backoff[slot] * 2, BACKOFF_MAX)
+            elif now >= self.restart_at[slot]:
+                del self.restart_at[slot]
+                self.spawn(slot)
+
+    def totals(self):
+        """ Aggregated (messages, rows) of all workers
+        """
+        msgs, rows = 0, 0
+        for arr in self.counters.values():
+            with arr.get_lock():
+                msgs += arr[0]
+                rows += arr[1]
+        return msgs, rows
+
+    def window(self):
+        """ Aggregated C* writes window of all workers
+        """
+        return sum(arr[2] for arr in self.counters.values())
+
+    def shutdown(self):
+        """ SIGTERM workers, wait for them to drain and
+            kill the ones that did not finish in time
+        """
+        for proc in self.procs.values():
+            if proc.is_alive():
+                proc.terminate()
+        deadline = time.time() + DRAIN_SECS
+        for slot, proc in self.procs.items():
+            proc.join(max(deadline - time.time(), 0))
+            if proc.is_alive():
+                logger.warning("Worker {} did not drain, killing it"
+                               .format(slot))
+                os.kill(proc.pid, signal.SIGKILL)
+                proc.join()
+
+    def run(self):
+        """ Spawn workers and supervise them until SIGTERM/SIGINT
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in range(self.workers):
+            self.spawn(slot)
+        last_t, last_msgs, last_rows = time.time(), 0, 0
+        while not self.stopping:
+            time.sleep(1)
+            self.check()
+            now = time.time()
+            if now - last_t >= self.stats_secs:
+                msgs, rows = self.totals()
+                logger.info("Consumers: {} alive, {:.1f} msgs/sec, "
+                            "{:.1f} rows/sec, {} msgs total, "
+                            "{} writes window".format(
+                                sum(p.is_alive() for p in self.procs.values()),
+                                (msgs - last_msgs) / (now - last_t),
+                                (rows - last_rows) / (now - last_t),
+                                msgs, self.window()))
+                last_t, last_msgs, last_rows = now, msgs, rows
+        self.shutdown()
+        msgs, rows = self.totals()
+        logger.info("Supervisor stopped: {} msgs, {} rows".format(msgs, rows))
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+""" Consumer write path benchmark against a local stand-in
+    C* session (no cluster needed).
+
+    Compares the legacy `%(name)s` formatted INSERTs sent as raw
+    strings against the prepared positional INSERTs of `Price`, both
+    serial and pipelined (`Price.save_all_async`).
+    The stand-in models the server side parse of a raw statement
+    with `--parse-us` and the network/write cost with `--exec-us`,
+    pipelined writes pay `--exec-us` once per in-flight window.
+    Those costs are a model, not a measurement of a cluster: only
+    the client side work (CQL interpolation against positional
+    binding) is measured, which is all the default run compares.
+
+    With `--build` it measures only the per-message location
+    handling (messages/sec and allocated blocks per message) of the
+    legacy parallel lists and per-table dicts (`LegacyPrice`, a
+    verbatim copy of the former builder) against the shared compact
+    rows (`Price.rows`).
+
+    Run as:
+        `python -m app.tests.bench_price --stores 300 --messages 200`
+        `python -m app.tests.bench_price --build --stores 500`
+"""
+import argparse
+import copy
+import datetime
+import gc
+import sys
+import time
+import uuid
+import app
+from flask import g
+from cassandra.encoder import Encoder
+from cassandra.query import bind_params
+from app.models.price import Price
+from app.consumer_bench import build_message
+
+# Legacy raw CQL per table (as sent before prepared statements)
+LEGACY_CQL = {
+    _table: "INSERT INTO {} ({}) VALUES ({}) USING TTL %(insert_ttl)s".format(
+        _table, ', '.join(_cols),
+        ', '.join(['%({})s'.format(_c) for _c in _cols])
+    )
+    for _table, _cols in Price.table_columns.items()
+}
+
+
+def spin(usecs):
+    """ Busy wait to model fixed per statement costs
+    """
+    if usecs <= 0:
+        return
+    until = time.perf_counter() + usecs / 1e6
+    while time.perf_counter() < until:
+        pass
+
+
+class StandInPrepared(object):
+    """ Prepared statement stand-in, binding is positional
+    """
+
+    def __init__(self, query_string):
+        self.query_string = query_string
+        self.query_id = uuid.uuid4().bytes
+
+    def bind(self, values):
+        return (self.query_id, tuple(values))
+
+
+class StandInCassandra(object):
+    """ `SimpleCassandra` stand-in that counts executed writes
+    """
+
+    def __init__(self, parse_us=0, exec_us=0):
+        self.parse_us = parse_us
+        self.exec_us = exec_us
+        self.encoder = Encoder()
+        self.writes = 0
+        self.prepares = 0
+        self._prepared = {}
+
+    def prepare(self, qry):
+        if qry not in self._prepared:
+            self.prepares += 1
+            spin(self.parse_us)
+            self._prepared[qry] = StandInPrepared(qry)
+        return self._prepared[qry]
+
+    def execute(self, qry, args=(), timeout=200):
+        if isinstance(qry, str):
+            # Client side interpolation + server side parse
+            bind_params(qry, args, self.encoder)
+            spin(self.parse_us)
+        spin(self.exec_us)
+        self.writes += 1
+        return []
+
+    def execute_concurrent(self, statements_and_params, concurrency=100):
+        results = []
+        for i, _ in enumerate(statements_and_params):
+            if i % concurrency == 0:
+                spin(self.exec_us)
+            self.writes += 1
+            results.append((True, []))
+        return results
+
+    def execute_adaptive(self, statements, controller, on_done=None,
+                         profile=None):
+        return self.execute_concurrent(
+            [(stmt, None) for stmt in statements], controller.limit)
+
+
+class LegacyPrice(Price):
+    """ Price with the location handling before `Location` rows,
+        copied verbatim as the benchmark baseline
+    """
+
+    def __init__(self, *initial_data, **kwargs):
+        # Db session init
+        self.session = g._db
+        # In case of dictionary initialization
+        for dictionary in initial_data:
+            for key in dictionary:
+                if key in dir(self):
+                    setattr(self, key, dictionary[key])
+        # In case of keyworded initialization
+        for key in kwargs:
+            if key in self.__dict__.keys():
+                setattr(self, key, kwargs[key])
+        # Date conversion
+        self.time = datetime.datetime.utcnow()
+        #self.date = self.time.strftime('%Y-%m-%d')     # <- Date as string
+        self.date = int(str(self.time.year)+str(self.time.month).zfill(2)+str(str(self.time.day).zfill(2)))
+        # Gtin
+        try:
+            self.gtin = int(self.gtin)
+        except:
+            self.gtin = None
+            #logger.error("Gtin invalid format, only int accepted: {}".format(self.gtin))
+        # Locations
+        coords = []
+        zips = []
+        stores = []
+        cities = []
+        states = []
+        lats = []
+        lngs = []
+        for i in range(0,len(self.location['store'])):
+            # Explode location array into multiple
+            stores.append(self.location['store'][i])
+            coords.append(self.location['coords'][i])
+            zips.append(self.location['zip'][i])
+            cities.append(self.location['city'][i])
+            states.append(self.location['state'][i])
+            lats.append(self.location['coords'][i]['lat'])
+            lngs.append(self.location['coords'][i]['lng'])
+        self.stores = stores
+        self.coords = coords
+        self.zips = zips
+        self.cities = cities
+        self.states = states
+        self.lats = lats
+        self.lngs = lngs
+        # Retailer as source
+        self.source = self.retailer if not self.source else self.source
+
+    def loc_generator(self):
+        ''' Generator for locations in a price
+        '''
+        for i in range(0,len(self.location['store'])):
+            yield {
+                'product_uuid' : uuid.UUID(self.product_uuid),
+                'gtin' :  self.gtin if self.gtin is None else int(self.gtin),
+                'source' : self.source,
+                'url' : self.url,
+                'price' : float(self.price),
+                'price_original' : float(self.price_original) if self.price_original else self.price,
+                'currency' : self.currency,
+                'discount' : float(self.discount) if self.discount else 0,
+                'promo' : self.promo,
+                'date' : self.date,
+                'time' : self.time,
+                'store_uuid' : uuid.UUID(self.stores[i]),
+                'state' : self.states[i],
+                'city' : self.cities[i],
+                'zip' : self.zips[i],
+                'coords' : self.coords[i],
+                'lat' : self.lats[i],
+                'lng' : self.lngs[i],
+                'part': self.part,
+                'insert_ttl': self.insert_ttl
+            }
+
+
+def save_all_legacy(price):
+    """ Legacy write path: one raw statement per location and table
+    """
+    for table in Price.table_columns:
+        if table in ('promo', 'promo_by_store') and not price.promo:
+            continue
+        for elem in price.loc_generator():
+            price.session.execute(LEGACY_CQL[table], elem)
+
+
+def run(mode, messages, stores, parse_us, exec_us, concurrency=100):
+    """ Time `messages` saves through the given write path
+    """
+    g._db = StandInCassandra(parse_us=parse_us, exec_us=exec_us)
+    msg = build_message(stores)
+    start = time.perf_counter()
+    cls = LegacyPrice if mode == 'legacy' else Price
+    for _ in range(messages):
+        price = cls(copy.copy(msg))
+        price.part = 1
+        if mode == 'legacy':
+            save_all_legacy(price)
+        elif mode == 'async':
+            price.save_all_async(concurrency)
+        else:
+            price.save_all()
+    elapsed = time.perf_counter() - start
+    return g._db.writes, elapsed
+
+
+def build_tables(price, mode):
+    """ Per table bind values of a price, as every saver builds them
+    """
+    values = []
+    for table in Price.table_columns:
+        if mode == 'dicts':
+            values.append(list(price.loc_generator()))
+        else:
+            bind = Price.table_binders[table]
+            values.append([bind(row) for row in price.rows])
+    return values
+
+
+def run_build(mode, messages, stores):
+    """ Time `messages` price builds and count the allocated
+        blocks of one of them (kept alive, gc disabled)
+    """
+    g._db = StandInCassandra()
+    msg = build_message(stores)
+    cls = LegacyPrice if mode == 'dicts' else Price
+    start = time.perf_counter()
+    for _ in range(messages):
+        build_tables(cls(copy.copy(msg)), mode)
+    elapsed = time.perf_counter() - start
+    gc.disable()
+    before = sys.getallocatedblocks()
+    kept = build_tables(cls(copy.copy(msg)), mode)
+    allocs = sys.getallocatedblocks() - before
+    gc.enable()
+    del kept
+    return messages / elapsed, allocs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Price write path benchmark")
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--stores', type=int, default=300)
+    parser.add_argument('--parse-us', type=int, default=0,
+                        help="Modeled server parse cost of a raw statement")
+    parser.add_argument('--exec-us', type=int, default=0,
+                        help="Modeled write cost of any statement")
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help="Writes in flight for the async mode")
+    parser.add_argument('--build', action='store_true',
+                        help="Benchmark only the location handling")
+    args = parser.parse_args()
+    with app.app.app_context():
+        if args.build:
+            for mode in ('dicts', 'rows'):
+                rate, allocs = run_build(mode, args.messages, args.stores)
+                print("{:>9}: {:,.0f} msgs/sec, {:,} allocated blocks/msg"
+                      .format(mode, rate, allocs))
+            sys.exit()
+        print("Stand-in session, modelled server costs: {} us parse per "
+              "raw statement, {} us per write".format(args.parse_us,
+                                                      args.exec_us))
+        for mode in ('legacy', 'prepared', 'async'):
+            writes, elapsed = run(mode, args.messages, args.stores,
+                                  args.parse_us, args.exec_us,
+                                  args.concurrency)
+            print("{:>9}: {:>8} writes in {:.2f}s -> {:,.0f} writes/sec"
+                  .format(mode, writes, elapsed, writes / elapsed))
@@ -0,0 +1,398 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+import app
+from flask import g
+from types import SimpleNamespace
+from cassandra import ConsistencyLevel, OperationTimedOut
+from cassandra.protocol import SyntaxException
+from cassandra.cluster import EXEC_PROFILE_DEFAULT
+from cassandra.policies import TokenAwarePolicy, ConstantSpeculativeExecutionPolicy
+from app.utils import db
+from app.utils.columnar import Columns, page_factory
+from app.utils.simple_cassandra import SimpleCassandra, PagedHandler, FanOut
+
+
+class SimpleCassandraTestCase(unittest.TestCase):
+    """ Test Case for the SimpleCassandra query helpers
+    """
+
+    def test_paged_handler_prefetch(self):
+        print("Validating paged query prefetch")
+        class FakeFuture(object):
+            def __init__(self, pages):
+                self.pages, self.fetches = pages, 0
+                self.has_more_pages = len(pages) > 1
+            def add_callbacks(self, callback, errback):
+                self.callback = callback
+                callback(self.pages[0])
+            def start_fetching_next_page(self):
+                self.fetches += 1
+                self.has_more_pages = self.fetches < len(self.pages) - 1
+                self.callback(self.pages[self.fetches])
+        future = FakeFuture([[1, 2], [3, 4], [5]])
+        handler = PagedHandler(future)
+        seen = []
+        for page in handler:
+            # Next page already requested when a page is handed out
+            self.assertEqual(future.fetches, min(len(seen) + 1, 2))
+            seen.append(page)
+        self.assertEqual(seen, [[1, 2], [3, 4], [5]])
+        pages = []
+        handler = PagedHandler(FakeFuture([[1], [2, 3]]), pages.append)
+        self.assertEqual(handler.wait(1), 3)
+        self.assertEqual(pages, [[1], [2, 3]])
+
+    def test_columnar_pages(self):
+        print("Validating columnar query buffers")
+        import uuid, datetime
+        names = ['product_uuid', 'price', 'date', 'time']
+        puuid, now = uuid.uuid4(), datetime.datetime(2019, 5, 1, 12)
+        cols = Columns()
+        cols.add_page(page_factory(names, [(puuid, 10.5, 20190501, now)]))
+        cols.add_page(page_factory(names, [(puuid, None, 20190502, now)]))
+        arrays = cols.arrays()
+        self.assertEqual(len(cols), 2)
+        self.assertEqual(str(arrays['price'].dtype), 'float32')
+        self.assertEqual(arrays['date'].tolist(), [20190501, 20190502])
+        df = cols.frame()
+        self.assertEqual(df.product_uuid.tolist(), [str(puuid)] * 2)
+        self.assertTrue(df.price.isnull().iloc[1])
+
+    def test_columnar_null_uuids(self):
+        print("Validating nullable UUID columns")
+        import uuid
+        names = ['product_uuid', 'price']
+        puuid = uuid.uuid4()
+        cols = Columns()
+        cols.add_page(page_factory(names, [(None, None)]))
+        cols.add_page(page_factory(names, [(puuid, 1.5), (None, 2.0)]))
+        self.assertEqual(str(cols.arrays()['product_uuid'].dtype), '|S16')
+        df = cols.frame()
+        self.assertEqual(df.product_uuid.tolist(), [None, str(puuid), None])
+        self.assertTrue(df.price.isnull().iloc[0])
+
+    def test_columnar_failed_query(self):
+        print("Validating columnar query failed partway drops its rows")
+        class FakeFuture(object):
+            has_more_pages = True
+            def add_callbacks(self, callback, errback):
+                self.errback = errback
+                callback(page_factory(['n'], [(1,), (2,)]))
+            def start_fetching_next_page(self):
+                self.errback(OperationTimedOut('page 2'))
+        cass = fake_cassandra()
+        cass.session.execute_async = lambda *args, **kw: FakeFuture()
+        cols = Columns()
+        cols.add_page(page_factory(['n'], [(0,)]))
+        with self.assertRaises(OperationTimedOut):
+            cass.query_columns("SELECT n FROM t", columns=cols)
+        self.assertEqual(len(cols), 1)
+        self.assertEqual(cols.arrays()['n'].tolist(), [0])
+
+    def test_fan_out_partitions(self):
+        print("Validating partition fan-out")
+        class FakeFuture(object):
+            has_more_pages = False
+            def __init__(self, key):
+                self.key = key
+            def add_callbacks(self, callback, errback):
+                if self.key[0] == 'bad':
+                    errback(ValueError(self.key))
+                else:
+                    callback([self.key] * 2)
+        class FakeSession(object):
+            def execute_async(self, key, **kw):
+                return FakeFuture(key)
+        class FakeStatement(object):
+            def bind(self, key):
+                return key
+        keys = [('a', 1), ('bad', 2), ('b', 3)]
+        fan = FanOut(FakeSession(), FakeStatement(), keys, concurrency=2)
+        results = dict(fan)
+        self.assertEqual(results, {('a', 1): [('a', 1)] * 2,
+                                   ('b', 3): [('b', 3)] * 2})
+        self.assertEqual(list(fan.errors), [('bad', 2)])
+
+    def test_adaptive_inflight_threads(self):
+        print("Validating in-flight writes counted across threads")
+        class FakeFuture(object):
+            def add_callbacks(self, callback, errback):
+                threading.Timer(0.001, callback, ([],)).start()
+        cass = fake_cassandra()
+        cass.session.execute_async = lambda stmt, **kw: FakeFuture()
+        controller = SimpleNamespace(limit=8, record=lambda *args: None)
+        statements = [FakePrepared('q').bind((i,)) for i in range(100)]
+        results = []
+        threads = [threading.Thread(target=lambda: results.extend(
+            cass.execute_adaptive(statements, controller)))
+            for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(10)
+        self.assertEqual(results, [(True, [])] * 400)
+        self.assertEqual(cass.inflight, 0)
+
+
+class FakePrepared(object):
+    """ Driver prepared statement stand-in of a table
+    """
+
+    def __init__(self, qry, keyspace='prices', table='price_by_store'):
+        self.qry = qry
+        self.column_metadata = [(keyspace, table, 'product_uuid', None)]
+        self.result_metadata = None
+
+    def bind(self, params):
+        return SimpleNamespace(prepared=self, params=params, fetch_size=None,
+                               consistency_level=None, is_idempotent=False)
+
+
+class FakeSession(object):
+    """ Driver session stand-in recording prepares and executes
+    """
+
+    def __init__(self):
+        self.prepared = []
+        self.executed = []
+        # Transient errors raised by the next prepares
+        self.errors = []
+
+    def set_keyspace(self, keyspace):
+        self.keyspace = keyspace
+
+    def prepare(self, qry):
+        if self.errors:
+            raise self.errors.pop(0)
+        if 'bad' in qry:
+            raise SyntaxException(0x2000, 'line 1:0 no viable alternative', None)
+        self.prepared.append(qry)
+        return FakePrepared(qry)
+
+    def execute(self, statement, params=None, **kwargs):
+        self.executed.append((statement, params, kwargs))
+        return []
+
+
+class FakeCluster(object):
+    """ Driver cluster stand-in with schema metadata
+    """
+
+    def __init__(self, contact_points, execution_profiles=None, **kwargs):
+        self.profile_manager = SimpleNamespace(profiles=execution_profiles)
+        self.metadata = SimpleNamespace(keyspaces={'prices': SimpleNamespace(
+            tables={'price_by_store': object()})})
+        self.session = FakeSession()
+
+    def connect(self):
+        return self.session
+
+    def shutdown(self):
+        pass
+
+
+def fake_cassandra(**kwargs):
+    """ SimpleCassandra over a fake driver cluster
+    """
+    with mock.patch('app.utils.simple_cassandra.Cluster', FakeCluster):
+        return SimpleCassandra(dict(CONTACT_POINTS=['127.0.0.1'],
+                                    KEYSPACE='prices',
+                                    CONSISTENCY_LEVEL='ONE'), **kwargs)
+
+
+class PreparedStatementsTestCase(unittest.TestCase):
+    """ Test Case for the SimpleCassandra prepared statements cache
+    """
+
+    def test_00_prepared_once(self):
+        print("Validating statements prepared once")
+        cass = fake_cassandra()
+        qry = "SELECT * FROM price_by_store WHERE date = %s AND store_uuid = %(st)s"
+        stmt = cass.prepare(qry)
+        self.assertIs(cass.prepare(qry), stmt)
+        self.assertEqual(cass.cluster.session.prepared,
+                         ["SELECT * FROM price_by_store WHERE date = ? AND store_uuid = :st"])
+        cass.execute("INSERT INTO price_by_store (date) VALUES (%s)", (20190501,))
+        bound = cass.cluster.session.executed[-1][0]
+        self.assertEqual(bound.params, (20190501,))
+        # Rejections are cached and run unprepared
+        self.assertIsNone(cass.prepare("bad %s"))
+        self.assertIsNone(cass.prepare("bad %s"))
+        self.assertEqual(len(cass.cluster.session.prepared), 2)
+        self.assertIsNone(cass.bind("bad %s", (1,)))
+
+    def test_03_transient_failure_retried(self):
+        print("Validating transient prepare failures are not cached")
+        cass = fake_cassandra()
+        session = cass.cluster.session
+        qry = "SELECT * FROM price_by_store WHERE date = %s"
+        session.errors.append(OperationTimedOut('prepare timed out'))
+        with self.assertRaises(OperationTimedOut):
+            cass.prepare(qry)
+        self.assertIsNotNone(cass.prepare(qry))
+        self.assertEqual(len(session.prepared), 1)
+        # Rejections are prepared again once expired
+        self.assertIsNone(cass.prepare("bad %s"))
+        self.assertIsNone(cass.prepare("bad %s"))
+        self.assertEqual(len(session.prepared), 1)
+        cass._prepared["bad %s"] = (None, 0)
+        with mock.patch.object(session, 'prepare', return_value=FakePrepared('ok')):
+            self.assertIsNotNone(cass.prepare("bad %s"))
+
+    def test_01_prepared_again_on_schema_change(self):
+        print("Validating statements prepared again on schema change")
+        cass = fake_cassandra()
+        qry = "INSERT INTO price_by_store (date) VALUES (%s)"
+        first = cass.prepare(qry)
+        # The driver replaces the table metadata on ALTER TABLE
+        cass.cluster.metadata.keyspaces['prices'].tables['price_by_store'] = object()
+        second = cass.prepare(qry)
+        self.assertIsNot(second, first)
+        self.assertIs(cass.prepare(qry), second)
+        self.assertEqual(len(cass.cluster.session.prepared), 2)
+        # Dropped statements are prepared again too
+        cass.invalidate(qry)
+        self.assertIsNot(cass.prepare(qry), second)
+        self.assertEqual(len(cass.cluster.session.prepared), 3)
+
+    def test_02_lru_size(self):
+        print("Validating prepared statements LRU")
+        cass = fake_cassandra(prepared_size=2)
+        for qry in ("SELECT a FROM t", "SELECT b FROM t", "SELECT a FROM t",
+                    "SELECT c FROM t", "SELECT a FROM t"):
+            cass.prepare(qry)
+        self.assertEqual(list(cass._prepared), ["SELECT c FROM t", "SELECT a FROM t"])
+        self.assertEqual(len(cass.cluster.session.prepared), 3)
+
+
+class ExecutionProfilesTestCase(unittest.TestCase):
+    """ Test Case for the SimpleCassandra execution profiles
+    """
+
+    def test_00_cluster_profiles(self):
+        print("Validating driver execution profiles")
+        cass = fake_cassandra(profiles={'write': {'timeout': 3},
+                                        'export': {'timeout': 600}})
+        profiles = cass.cluster.profile_manager.profiles
+        fast = profiles['fast_read']
+        self.assertEqual(fast.consistency_level, ConsistencyLevel.LOCAL_ONE)
+        self.assertEqual(fast.request_timeout, 5)
+        self.assertIsInstance(fast.load_balancing_policy, TokenAwarePolicy)
+        self.assertIsInstance(fast.speculative_execution_policy,
+                              ConstantSpeculativeExecutionPolicy)
+        # Session consistency when the profile sets none
+        self.assertEqual(profiles['bulk_scan'].consistency_level,
+                         ConsistencyLevel.ONE)
+        self.assertEqual(profiles['bulk_scan'].request_timeout, 200)
+        # Overrides and extra profiles
+        self.assertEqual(profiles['write'].request_timeout, 3)
+        self.assertEqual(profiles['export'].request_timeout, 600)
+        # Columnar twins
+        for name in ('columnar', 'fast_read:columnar', 'export:columnar'):
+            self.assertIs(profiles[name].row_factory, page_factory)
+        self.assertEqual(profiles['fast_read:columnar'].consistency_level,
+                         ConsistencyLevel.LOCAL_ONE)
+        cass.set_timeout(1.5, 'write')
+        self.assertEqual(profiles['write'].request_timeout, 1.5)
+        self.assertEqual(profiles['write:columnar'].request_timeout, 1.5)
+        self.assertEqual(profiles[EXEC_PROFILE_DEFAULT].request_timeout, 10)
+
+    def test_01_query_profile(self):
+        print("Validating execution profile selection of queries")
+        cass = fake_cassandra()
+        executed = cass.cluster.session.executed
+        qry = "SELECT * FROM price_by_store WHERE date = %s"
+        cass.query(qry, (20190501,), profile='fast_read')
+        stmt, _, kwargs = executed[-1]
+        self.assertEqual(kwargs, {'execution_profile': 'fast_read'})
+        self.assertEqual(stmt.fetch_size, 5000)
+        # Speculative reads must be idempotent
+        self.assertTrue(stmt.is_idempotent)
+        cass.query(qry, (20190501,), profile='bulk_scan')
+        stmt, _, kwargs = executed[-1]
+        self.assertEqual(kwargs, {'execution_profile': 'bulk_scan'})
+        self.assertEqual(stmt.fetch_size, 10000)
+        self.assertFalse(stmt.is_idempotent)
+        # No profile: default one with the explicit timeout
+        cass.query(qry, (20190501,))
+        self.assertEqual(executed[-1][2], {'timeout': 30})
+        cass.execute("SELECT now() FROM system.local", profile='fast_read')
+        stmt, _, kwargs = executed[-1]
+        self.assertEqual(stmt.query_string, "SELECT now() FROM system.local")
+        self.assertEqual(kwargs['execution_profile'], 'fast_read')
+        self.assertTrue(stmt.is_idempotent)
+
+
+class FakeDB(object):
+    """ SimpleCassandra stand-in counting shutdowns
+    """
+
+    def __init__(self):
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+
+class SharedSessionTestCase(unittest.TestCase):
+    """ Test Case for the per-process shared C* session
+    """
+
+    def setUp(self):
+        self.created = []
+        patches = [
+            mock.patch.object(db, 'getdb', self.getdb),
+            mock.patch.object(db, 'shared', None),
+            mock.patch.object(db, 'shared_pid', None),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def getdb(self):
+        # Slow connect, so concurrent first users overlap
+        time.sleep(0.05)
+        self.created.append(FakeDB())
+        return self.created[-1]
+
+    def test_00_reused_by_threads_and_contexts(self):
+        print("Validating one shared session per process")
+        found = []
+        threads = [threading.Thread(target=lambda: found.append(db.shared_db()))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(self.created), 1)
+        self.assertTrue(all(f is self.created[0] for f in found))
+        # App contexts borrow it, their teardown does not close it
+        for _ in range(2):
+            with app.app.app_context():
+                app.get_db()
+                self.assertIs(g._db, self.created[0])
+        self.assertEqual(self.created[0].closed, 0)
+
+    def test_01_rebuilt_after_fork(self):
+        print("Validating the shared session is rebuilt after fork")
+        parent = db.shared_db()
+        # As seen by a forked child: created by another pid
+        db.shared_pid = os.getpid() + 1
+        child = db.shared_db()
+        self.assertIsNot(child, parent)
+        self.assertEqual(db.shared_pid, os.getpid())
+        # Process exit only closes the session of its own pid
+        db.close_shared()
+        self.assertEqual((parent.closed, child.closed), (0, 1))
+        self.assertIsNone(db.shared)
+        db.shared, db.shared_pid = parent, os.getpid() + 1
+        db.close_shared()
+        self.assertEqual(parent.closed, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
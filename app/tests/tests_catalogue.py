@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import os
+import uuid
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from app.utils import catalogue_snapshot
+from app.utils.catalogue import Catalogue
+from app.scripts import create_catalogue_snapshot
+
+
+def response(status, products=()):
+    """ requests.Response stand-in of a Catalogue page
+    """
+    return SimpleNamespace(status_code=status,
+                           json=lambda: {'products': list(products)})
+
+
+class CatalogueSnapshotBuildTestCase(unittest.TestCase):
+    """ Test Case for the catalogue snapshot build script
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        patches = [
+            mock.patch.object(create_catalogue_snapshot,
+                              'CATALOGUE_SNAPSHOT_DIR', self.path),
+            mock.patch.object(create_catalogue_snapshot, 'get_sources',
+                              lambda: ['walmart']),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def fetch(self, pages):
+        return mock.patch('app.utils.catalogue.http_session.get',
+                          side_effect=pages)
+
+    def test_00_partial_fetch_raises(self):
+        print("Validating strict source fetch")
+        cat = Catalogue(uri='catalogue')
+        page = [{'product_uuid': 'a'}]
+        with self.fetch([response(200, page), response(500)]):
+            self.assertEqual(cat.get_by_source('walmart', snapshot=False), page)
+        with self.fetch([response(200, page), response(500)]):
+            with self.assertRaises(Exception):
+                cat.get_by_source('walmart', snapshot=False, strict=True)
+        with self.fetch([response(200, page), IOError('reset')]):
+            with self.assertRaises(Exception):
+                cat.get_by_source('walmart', snapshot=False, strict=True)
+
+    def test_01_failed_fetch_not_published(self):
+        print("Validating snapshot not published on a failed fetch")
+        page = [{'product_uuid': '0a4e0b57-7b8e-4ec6-9a3e-9c1e7b0f2a11'}]
+        with self.fetch([response(200, page), response(502)]):
+            with self.assertRaises(SystemExit):
+                create_catalogue_snapshot.start()
+        self.assertEqual(os.listdir(self.path), [])
+        with self.fetch([response(200, page), response(200)]):
+            create_catalogue_snapshot.start()
+        with open(os.path.join(self.path, 'CURRENT')) as f:
+            vdir = os.path.join(self.path, f.read().strip())
+        self.assertEqual(len(catalogue_snapshot.CatalogueSnapshot(vdir)), 1)
+
+
+class CatalogueSnapshotTestCase(unittest.TestCase):
+    """ Test Case for the memory-mapped catalogue snapshot
+    """
+
+    def test_catalogue_snapshot(self):
+        print("Validating catalogue snapshot lookups")
+        items = [str(uuid.uuid4()) for _ in range(2)]
+        recs = [{'product_uuid': str(uuid.uuid4()), 'item_uuid': items[i % 2],
+                 'source': ['walmart', 'chedraui'][i % 2],
+                 'gtin': '0750100000%d' % i, 'name': 'Leche %d' % i}
+                for i in range(6)]
+        vdir = catalogue_snapshot.build(recs, tempfile.mkdtemp())
+        snap = catalogue_snapshot.CatalogueSnapshot(vdir)
+        missing = str(uuid.uuid4())
+        found, rest = snap.products([recs[3]['product_uuid'], missing])
+        self.assertEqual(found, [recs[3]])
+        self.assertEqual(rest, [missing])
+        found, rest = snap.by_items(items + [missing], ['walmart'])
+        self.assertEqual(sorted(f['product_uuid'] for f in found),
+                         sorted(r['product_uuid'] for r in recs[::2]))
+        self.assertEqual(rest, [missing])
+        self.assertEqual(len(snap.by_source('chedraui')), 3)
+        self.assertIsNone(snap.by_source('soriana'))
+        # Projected to the requested columns, built in pages
+        self.assertEqual(sorted(snap.by_source('chedraui', ['gtin'], size=2),
+                                key=lambda r: r['gtin']),
+                         [{'gtin': r['gtin']} for r in recs[1::2]])
+
+
+class CatalogueSnapshotLookupsTestCase(unittest.TestCase):
+    """ Test Case for the Catalogue lookups through the snapshot
+    """
+
+    def setUp(self):
+        self.items = [str(uuid.uuid4()) for _ in range(2)]
+        self.recs = [{'product_uuid': str(uuid.uuid4()),
+                      'item_uuid': self.items[i % 2], 'source': 'walmart',
+                      'gtin': '0750100000%d' % i, 'name': 'Leche %d' % i}
+                     for i in range(4)]
+        snap = catalogue_snapshot.CatalogueSnapshot(
+            catalogue_snapshot.build(self.recs, tempfile.mkdtemp()))
+        p = mock.patch('app.utils.catalogue.get_snapshot', return_value=snap)
+        p.start()
+        self.addCleanup(p.stop)
+        self.cat = Catalogue(uri='catalogue')
+
+    def fetch(self, pages):
+        return mock.patch('app.utils.catalogue.http_session.get',
+                          side_effect=pages)
+
+    def test_00_projected_to_cols(self):
+        print("Validating snapshot records projected to the columns")
+        by_source = self.cat.get_by_source('walmart', ['item_uuid'],
+                                           qsize=3, snapshot=True)
+        self.assertEqual(sorted(r['item_uuid'] for r in by_source),
+                         sorted(r['item_uuid'] for r in self.recs))
+        self.assertEqual(set(k for r in by_source for k in r), {'item_uuid'})
+        prods = self.cat.get_product_details(self.items, cols=['gtin'],
+                                             snapshot=True)
+        self.assertEqual(len(prods), 4)
+        self.assertEqual(set(k for p in prods for k in p),
+                         {'item_uuid', 'product_uuid', 'gtin'})
+
+    def test_01_live_unless_opted_in(self):
+        print("Validating products added after the snapshot are found")
+        added = {'product_uuid': str(uuid.uuid4()),
+                 'item_uuid': self.items[0], 'gtin': '07501000009'}
+        live = self.recs[::2] + [added]
+        with self.fetch([response(200, live), response(200)]) as get:
+            by_source = self.cat.get_by_source('walmart', ['item_uuid'])
+        self.assertEqual(by_source, live)
+        self.assertEqual(get.call_count, 2)
+        with self.fetch([response(200, live)]):
+            prods = self.cat.get_product_details([self.items[0]],
+                                                 cols=['gtin'])
+        self.assertIn(added['product_uuid'],
+                      [p['product_uuid'] for p in prods])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,8 +6,16 @@ import json
 import threading
 import time
 import sys
+import tempfile
 from pprint import pprint
 from app.models.price import Price
+from app.utils.decoders import decode
+from app.models.price_state import PriceState
+from app.utils.adaptive import AdaptiveConcurrency
+from app.utils.spool import Spool
+from app.utils.metrics import Registry
+from app.models.daily_stats import Aggregate
+from cassandra import WriteTimeout
 
 new_price = {
     "route_key" : "price",
@@ -100,6 +108,16 @@ class GeopriceConsumerTestCase(unittest.TestCase):
         print(validate)
         self.assertTrue(validate)
 
+    def test_price_decode_validation(self):
+        print("Testing price decoding and invalid prices")
+        global new_price
+        body = json.dumps(new_price).encode('utf-8')
+        decoded = decode(body, 'application/json')
+        self.assertEqual(decoded, new_price)
+        self.assertTrue(Price.validate(decoded))
+        del decoded['location']
+        self.assertFalse(Price.validate(decoded))
+
     def test_price_save_success(self):
         print("Validating save price success")
         global new_price
@@ -108,5 +126,118 @@ class GeopriceConsumerTestCase(unittest.TestCase):
         result = pr.save_all()
         self.assertEqual(result, True)
 
+    def test_price_prepared_binding(self):
+        print("Validating prepared INSERT bind order")
+        global new_price
+        pr = Price(new_price)
+        pr.part = 1
+        row = pr.rows[0]
+        for table, cols in Price.table_columns.items():
+            cql = Price.insert_cql(table)
+            values = Price.table_binders[table](row)
+            self.assertEqual(cql.count('?'), len(values))
+            self.assertEqual(values[-1], pr.insert_ttl)
+            self.assertEqual(
+                values[cols.index('store_uuid')],
+                row[Price.row_fields.index('store_uuid')]
+            )
+
+    def test_price_batch_plan(self):
+        print("Validating partition batches plan")
+        global new_price
+        pr = Price(new_price)
+        pr.part = 1
+        plan = Price.batch_plan([pr])
+        # One batch per product partition, bare writes per store partition
+        by_table = {}
+        for idxs, table, stmt in plan:
+            self.assertEqual(idxs, (0,))
+            by_table[table] = by_table.get(table, 0) + 1
+        self.assertEqual(by_table['price_by_product_date'], 1)
+        self.assertEqual(by_table['promo'], 1)
+        self.assertEqual(by_table['price_by_store'], len(pr.locations))
+
+    def test_price_state_skips_unchanged(self):
+        print("Validating unchanged prices are skipped")
+        global new_price
+        state = PriceState(window=3600, size=10)
+        pr = Price(new_price)
+        pending = state.filter([pr])[0]
+        self.assertEqual(len(pr.rows), len(pr.locations))
+        state.commit(pending)
+        # Same observation within the window
+        pr = Price(new_price)
+        state.filter([pr])
+        self.assertEqual(len(pr.rows), 0)
+        # Changed price is written again
+        pr = Price(dict(new_price, price=79.0))
+        state.filter([pr])
+        self.assertEqual(len(pr.rows), len(pr.locations))
+
+    def test_adaptive_write_window(self):
+        print("Validating adaptive writes window")
+        ctrl = AdaptiveConcurrency(initial=4, maximum=32, target_ms=50)
+        # Healthy writes grow the window
+        for _ in range(200):
+            ctrl.record(0.005)
+        grown = ctrl.limit
+        self.assertGreater(grown, 4)
+        # Overload halves it
+        ctrl.record(0.5, WriteTimeout("timeout"))
+        self.assertEqual(ctrl.limit, grown // 2)
+
+    def test_spool_roundtrip(self):
+        print("Validating spooled writes roundtrip")
+        global new_price
+        pr = Price(new_price)
+        records = pr.spool_records(pr.write_tables())
+        spool = Spool(tempfile.mkdtemp(), segment_mb=1)
+        spool.append(records)
+        # Active segment is locked until rotated
+        self.assertIsNone(spool.claim())
+        spool.rotate()
+        fpath, f = spool.claim()
+        self.assertEqual(list(Spool.read(f)), records)
+        f.close()
+        # Corrupt tail stops the replay at the last good record
+        with open(fpath, 'r+b') as f:
+            f.seek(-1, 2)
+            f.write(b'x')
+        with open(fpath, 'rb') as f:
+            self.assertEqual(list(Spool.read(f)), records[:-1])
+
+    def test_metrics_render(self):
+        print("Validating metrics histograms and rendering")
+        reg = Registry()
+        hist = reg.histogram('geoprice_write_seconds', 'Latency', 'table')
+        for ms in range(1, 101):
+            hist.observe(ms / 1000.0, 'price_by_store')
+        # Bucket bounds are within ~19% of the value
+        self.assertAlmostEqual(hist.percentile(50, 'price_by_store'), 0.05, delta=0.012)
+        reg.counter('geoprice_messages_total', 'Messages').inc(3)
+        text = reg.render()
+        self.assertIn('geoprice_messages_total 3', text)
+        self.assertIn('geoprice_write_seconds_count{table="price_by_store"} 100', text)
+
+    def test_daily_stats_merge(self):
+        print("Validating mergeable daily stats aggregates")
+        prices = [10.0, 10.0, 12.0, 15.5, 10.0, 20.0]
+        first, second = Aggregate('walmart'), Aggregate()
+        for p in prices[:3]:
+            first.add(p)
+        for p in prices[3:]:
+            second.add(p)
+        first.merge(second)
+        stats = first.stats()
+        avg = sum(prices) / len(prices)
+        std = (sum((p - avg) ** 2 for p in prices) / (len(prices) - 1)) ** 0.5
+        self.assertEqual(stats['datapoints'], 6)
+        self.assertAlmostEqual(stats['avg_price'], avg)
+        self.assertAlmostEqual(stats['std_price'], std)
+        self.assertEqual((stats['min_price'], stats['max_price'], stats['mode_price']),
+                         (10.0, 20.0, 10.0))
+        self.assertEqual(stats['source'], 'walmart')
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import datetime
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+from uuid import uuid1
+import app
+from flask import g
+from app import consumer
+from app.models.daily_stats import DailyStats, date_of
+
+
+class FakeSession(object):
+    """ SimpleCassandra stand-in keeping the coverage markers
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.markers = {}
+        self.partials = 0
+
+    def execute(self, qry, args=(), timeout=None):
+        if qry == DailyStats.open_cql:
+            date, worker_id, started, stats, _ = args
+            self.markers[(date, worker_id)] = SimpleNamespace(
+                worker_id=worker_id, started=started, stats=stats,
+                complete=False)
+        elif qry == DailyStats.complete_cql:
+            _, date, worker_id = args
+            self.markers[(date, worker_id)].complete = True
+
+    def prepare(self, qry):
+        return SimpleNamespace(bind=lambda params: params)
+
+    def execute_concurrent(self, statements_and_params, concurrency=100):
+        if self.fail:
+            raise Exception('NoHostAvailable')
+        self.partials += len(statements_and_params)
+        return [(True, None)] * len(statements_and_params)
+
+    def query(self, qry, params=()):
+        return [m for (date, _), m in self.markers.items()
+                if date == params[0]]
+
+
+def written(date, product=None, price=10.0):
+    """ Price-like object with one written row
+    """
+    return SimpleNamespace(rows=[(product or uuid1(),)], date=date,
+                           source='walmart', price=price)
+
+
+class DailyStatsCoverageTestCase(unittest.TestCase):
+    """ Test Case for the daily stats coverage markers
+    """
+
+    def setUp(self):
+        self.today = date_of(datetime.datetime.utcnow())
+        self.yesterday = date_of(datetime.datetime.utcnow()
+                                 - datetime.timedelta(days=1))
+        self.session = FakeSession()
+
+    def worker(self, enabled=True, days_ago=2):
+        stats = DailyStats(enabled=enabled)
+        stats.started -= datetime.timedelta(days=days_ago)
+        return stats
+
+    def test_00_covered_after_flush(self):
+        print("Validating partials covered once flushed after the day")
+        stats = self.worker()
+        stats.open(self.session, self.yesterday)
+        stats.open(self.session, self.yesterday)
+        stats.add(written(self.yesterday))
+        self.assertFalse(DailyStats.covered(self.session, self.yesterday))
+        stats.flush(self.session)
+        self.assertEqual(self.session.partials, 1)
+        self.assertEqual(len(self.session.markers), 1)
+        self.assertTrue(DailyStats.covered(self.session, self.yesterday))
+
+    def test_01_today_completed_on_close(self):
+        print("Validating today only completed by a closing worker")
+        stats = self.worker()
+        stats.open(self.session, self.today)
+        stats.add(written(self.today))
+        stats.flush(self.session)
+        self.assertFalse(DailyStats.covered(self.session, self.today))
+        stats.close(self.session)
+        self.assertTrue(DailyStats.covered(self.session, self.today))
+
+    def test_02_lost_aggregates(self):
+        print("Validating partials not covered when a flush fails")
+        stats = self.worker()
+        stats.open(self.session, self.yesterday)
+        stats.add(written(self.yesterday))
+        self.session.fail = True
+        with self.assertRaises(Exception):
+            stats.close(self.session)
+        self.assertEqual(len(stats.aggs), 1)
+        self.assertFalse(DailyStats.covered(self.session, self.yesterday))
+
+    def test_03_worker_without_stats(self):
+        print("Validating partials not covered by a worker without stats")
+        stats, other = self.worker(), self.worker(enabled=False)
+        for w in (stats, other):
+            w.open(self.session, self.yesterday)
+            w.close(self.session)
+        self.assertFalse(DailyStats.covered(self.session, self.yesterday))
+
+    def test_04_enabled_mid_day(self):
+        print("Validating partials not covered when enabled mid-day")
+        stats = self.worker(days_ago=0)
+        stats.open(self.session, self.yesterday)
+        stats.close(self.session)
+        self.assertFalse(DailyStats.covered(self.session, self.yesterday))
+        # A worker running since the day began covers the restart
+        older = self.worker()
+        older.open(self.session, self.yesterday)
+        older.close(self.session)
+        self.assertTrue(DailyStats.covered(self.session, self.yesterday))
+
+    def test_05_disabled_consumer(self):
+        print("Validating dates not marked by consumers without stats")
+        stats = self.worker(enabled=False)
+        with app.app.app_context(), \
+                mock.patch.object(consumer, 'daily_stats', stats):
+            g._db = self.session
+            consumer.open_stats([written(self.yesterday)])
+        self.assertEqual(stats.days, set())
+        self.assertEqual(self.session.markers, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -267,7 +267,25 @@ class GeopriceGeoServicesTestCase(unittest.TestCase):
         except:
             pass
         self.assertEqual(_res.status_code, 200)
-          
+
+    def test_10_spatial_index_method(self):
+        """ Test store spatial index radius and nearest queries
+        """
+        print(">>>>>", "Test store spatial index radius and nearest queries")
+        from app.utils.spatial import StoreIndex
+        # Stores ~1.1 km apart along a meridian, one without coords
+        lats = [19.40 + 0.01 * i for i in range(10)] + [None]
+        lngs = [-99.10] * 10 + [None]
+        keys = ['st{}'.format(i) for i in range(11)]
+        sources = ['walmart', 'superama'] * 5 + ['walmart']
+        index = StoreIndex(lats, lngs, keys=keys, sources=sources)
+        within = index.stores_within(19.40, -99.10, 3.0)
+        self.assertEqual([k for k, _ in within], ['st0', 'st1', 'st2'])
+        self.assertAlmostEqual(within[1][1], 1.112, places=2)
+        nearest = index.k_nearest(19.45, -99.10, 2, retailer='walmart')
+        self.assertEqual(sorted(k for k, _ in nearest), ['st4', 'st6'])
+        self.assertEqual(len(index.k_nearest(0.0, 0.0, 20)), 10)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,6 +7,9 @@ import uuid
 import sys
 import time
 import json
+from unittest import mock
+from flask import g
+from app.models.history_product import Product
 
 task_id = None
 
@@ -493,6 +496,26 @@ class GeopriceHistoryTasksTestCase(unittest.TestCase):
         self.assertEqual(prog,100)
 
 
+class HistoryProductUuidsTestCase(unittest.TestCase):
+    """ Test Case for the product UUIDs of the history queries
+    """
+
+    def test_00_malformed_uuids_skipped(self):
+        print("Validating malformed product UUIDs skipped")
+        good = str(uuid.uuid4())
+        prods = [{'product_uuid': good}, {'product_uuid': 'not-a-uuid'}]
+        fan = mock.MagicMock(errors={})
+        fan.__iter__.return_value = iter([])
+        with app.app.app_context(), \
+                mock.patch('app.models.history_product.Item.get_by_item',
+                           return_value=prods):
+            g._db = mock.Mock()
+            g._db.fan_out.return_value = fan
+            self.assertEqual(Product.get_stats(str(uuid.uuid4()), None), {})
+            keys = g._db.fan_out.call_args[0][1]
+        self.assertEqual(set(k[0] for k in keys), {uuid.UUID(good)})
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from unittest import mock
+import config
+from app.utils import http_session
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """ Answers 503 to the first `failures` requests of each method
+    """
+    protocol_version = 'HTTP/1.1'
+    failures = 0
+    seen = []
+
+    def answer(self):
+        FlakyHandler.seen.append((self.command, self.client_address[1]))
+        failed = sum(1 for c, _ in FlakyHandler.seen if c == self.command)
+        status = 503 if failed <= FlakyHandler.failures else 200
+        body = b'{}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = answer
+    do_POST = answer
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class HttpSessionTestCase(unittest.TestCase):
+    """ Test Case for the pooled services HTTP session
+    """
+
+    def setUp(self):
+        FlakyHandler.failures, FlakyHandler.seen = 0, []
+        self.server = Server(('127.0.0.1', 0), FlakyHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}/item'.format(self.server.server_port)
+
+    def test_00_retry_5xx(self):
+        print("Validating retries of idempotent requests on 5xx")
+        FlakyHandler.failures = 2
+        session = http_session.build_session(retries=3, backoff=0)
+        self.addCleanup(session.close)
+        self.assertEqual(session.get(self.url).status_code, 200)
+        self.assertEqual([c for c, _ in FlakyHandler.seen], ['GET'] * 3)
+        # Not idempotent: answered as is
+        self.assertEqual(session.post(self.url).status_code, 503)
+        self.assertEqual(len(FlakyHandler.seen), 4)
+        # Retries exhausted, last response returned
+        FlakyHandler.failures, FlakyHandler.seen = 5, []
+        self.assertEqual(session.get(self.url).status_code, 503)
+        self.assertEqual(len(FlakyHandler.seen), 4)
+
+    def test_01_keep_alive(self):
+        print("Validating keep-alive connections")
+        session = http_session.build_session(retries=0)
+        self.addCleanup(session.close)
+        for _ in range(5):
+            session.get(self.url)
+        self.assertEqual(len(set(port for _, port in FlakyHandler.seen)), 1)
+
+    def test_02_rebuilt_per_pid(self):
+        print("Validating the shared session is rebuilt after fork")
+        with mock.patch.object(http_session, '_session', None), \
+                mock.patch.object(http_session, '_session_pid', None):
+            session = http_session.get_session()
+            self.assertIs(http_session.get_session(), session)
+            # As seen by a forked child: created by another pid
+            http_session._session_pid = os.getpid() + 1
+            child = http_session.get_session()
+            self.assertIsNot(child, session)
+            self.assertIs(http_session.get_session(), child)
+            with mock.patch.object(child, 'request') as req:
+                http_session.get(self.url)
+                req.assert_called_once_with('GET', self.url,
+                                            timeout=config.SRV_TIMEOUT)
+
+    def test_03_retried_methods(self):
+        print("Validating retried methods on every urllib3")
+        session = http_session.build_session()
+        retry = session.get_adapter(self.url).max_retries
+        self.assertEqual(getattr(retry, 'allowed_methods', None)
+                         or retry.method_whitelist, http_session._IDEMPOTENT)
+        # urllib3 >= 1.26 takes them as `allowed_methods`
+        seen = {}
+
+        class NewRetry(http_session.Retry):
+            DEFAULT_ALLOWED_METHODS = http_session._IDEMPOTENT
+
+            def __init__(self, allowed_methods=None, **kwargs):
+                seen['allowed_methods'] = allowed_methods
+                super(NewRetry, self).__init__(**kwargs)
+
+        with mock.patch.object(http_session, 'Retry', NewRetry):
+            http_session.build_session()
+        self.assertEqual(seen['allowed_methods'], http_session._IDEMPOTENT)
+
+
+if __name__ == '__main__':
+    unittest.main()
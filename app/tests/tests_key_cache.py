@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import unittest
+from app.utils.key_cache import KeyCache
+
+
+class KeyCacheTestCase(unittest.TestCase):
+    """ Test Case for the per-process service responses cache
+    """
+
+    def test_key_cache_single_flight(self):
+        print("Validating cache single-flight")
+        cache = KeyCache(maxsize=2, ttl=60)
+        calls, gate, results = [], threading.Event(), []
+        def fetch(keys):
+            calls.append(list(keys))
+            gate.wait(1)
+            return {k: k.upper() for k in keys if k != 'bad'}
+        def ask():
+            results.append(cache.get_many('test', ['a', 'b', 'bad'], fetch))
+        threads = [threading.Thread(target=ask) for _ in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        gate.set()
+        for t in threads:
+            t.join()
+        # One upstream call for the three askers, failures not cached
+        self.assertEqual(calls, [['a', 'b', 'bad']])
+        self.assertEqual(results, [{'a': 'A', 'b': 'B'}] * 3)
+        self.assertEqual(cache.get_many('test', ['a', 'c'], fetch),
+                         {'a': 'A', 'c': 'C'})
+        self.assertEqual(calls[-1], ['c'])
+        # Least recently used `b` evicted
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.stats()['hits']['test'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import unittest
+import app
+from flask import g
+from cassandra import OperationTimedOut
+from cassandra.cluster import NoHostAvailable
+from app.models.price import Price
+from app.consumer_bench import build_message, RecordingCassandra
+
+
+class FailingCassandra(RecordingCassandra):
+    """ Bench session whose prepares fail with `error`, or are
+        rejected (None) when it is not set
+    """
+
+    def __init__(self, error=None):
+        super(FailingCassandra, self).__init__(latency_ms=0)
+        self.error = error
+
+    def prepare(self, qry):
+        if self.error is not None:
+            raise self.error
+        return None
+
+
+class PriceWritesTestCase(unittest.TestCase):
+    """ Test Case for the Price writes when statements can not
+        be prepared
+    """
+
+    def setUp(self):
+        self.ctx = app.app.app_context()
+        self.ctx.push()
+        self.addCleanup(self.ctx.pop)
+
+    def prices(self, session):
+        g._db = session
+        return [Price(build_message(2)) for _ in range(2)]
+
+    def test_00_rejected_prepare(self):
+        print("Validating writes failed when an INSERT is rejected")
+        prices = self.prices(FailingCassandra())
+        for batched in (False, True):
+            failures = Price.save_many(prices, batched=batched)
+            self.assertEqual([sorted(f) for f in failures],
+                             [sorted(p.write_tables()) for p in prices])
+            self.assertIn('Could not prepare',
+                          str(failures[0]['price_by_store'][0]))
+        with self.assertRaises(Exception):
+            Price.save_spooled(g._db, prices[0].spool_records(['promo']))
+
+    def test_01_transient_prepare_failure(self):
+        print("Validating writes failed on a transient prepare error")
+        prices = self.prices(FailingCassandra(OperationTimedOut('prepare')))
+        failures = Price.save_many(prices)
+        self.assertIsInstance(failures[1]['promo'][0], OperationTimedOut)
+        # Left to the consumer (spool or shutdown)
+        g._db.error = NoHostAvailable('prepare', {})
+        with self.assertRaises(NoHostAvailable):
+            Price.save_many(prices)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+import unittest
+import pika
+from types import SimpleNamespace
+from unittest import mock
+import app
+from flask import g
+from app import consumer
+from app.consumer_bench import build_message, RecordingCassandra
+from app.utils.publisher import AsyncPublisher
+
+
+class FakeConnection(object):
+    """ pika connection stand-in for the batch timer
+    """
+
+    def add_timeout(self, secs, fn):
+        return (secs, fn)
+
+    def remove_timeout(self, timer):
+        pass
+
+
+class FakeChannel(object):
+    """ pika channel stand-in recording acks and nacks
+    """
+
+    def __init__(self):
+        self.is_open = True
+        self.connection = FakeConnection()
+        self.acks = []
+        self.nacks = []
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.nacks.append((delivery_tag, requeue))
+
+
+class FakeEngine(object):
+    """ Blocking RabbitEngine stand-in with publisher confirms,
+        sent once events are processed: `nacks` bodies are not
+        confirmed and `error` is raised while waiting
+    """
+    EXCHANGE = ''
+    ROUTING_KEY = 'test_cache'
+
+    def __init__(self, nacks=(), gate=None, error=None):
+        self._channel = SimpleNamespace(_impl=self)
+        self._connection = self
+        self.nacks = list(nacks)
+        self.gate = gate
+        self.error = error
+        self.on_confirm = None
+        self.sent = []
+        self.bodies = []
+        self.tag = 0
+        self.waits = 0
+        self.closed = False
+
+    def confirm_delivery(self, callback, nowait):
+        self.on_confirm = callback
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        if self.gate is not None:
+            self.gate.wait(1)
+        self.tag += 1
+        self.sent.append((self.tag, body))
+
+    def process_data_events(self, time_limit=0):
+        self.waits += 1
+        if self.error is not None:
+            raise self.error
+        for tag, body in self.sent:
+            if body in self.nacks:
+                self.nacks.remove(body)
+                self.on_confirm(SimpleNamespace(
+                    method=pika.spec.Basic.Nack(delivery_tag=tag)))
+            else:
+                self.bodies.append(json.loads(body))
+        # Every other one acked at once
+        self.on_confirm(SimpleNamespace(
+            method=pika.spec.Basic.Ack(delivery_tag=self.tag, multiple=True)))
+        self.sent = []
+
+    def close(self):
+        self.closed = True
+
+
+def delivery(tag, message):
+    """ (method, properties, body) of a delivered message
+    """
+    return (SimpleNamespace(delivery_tag=tag, redelivered=False),
+            SimpleNamespace(content_type='application/json'),
+            json.dumps(message).encode('utf-8'))
+
+
+class BatchConsumerTestCase(unittest.TestCase):
+    """ Test Case for the micro-batching consumer acks
+    """
+
+    def setUp(self):
+        # Prices are built in a Flask ctx with a C* session
+        self.ctx = app.app.app_context()
+        self.ctx.push()
+        self.addCleanup(self.ctx.pop)
+        g._db = RecordingCassandra(latency_ms=0)
+        self.messages = [build_message(2) for _ in range(3)]
+        self.failing = set()
+        patches = [
+            mock.patch.object(consumer, 'write_prices', self.write_prices),
+            mock.patch.object(consumer, 'publish_price', lambda msg: None),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def write_prices(self, prices, batched=False):
+        return [{'price_by_store': [Exception('write')]}
+                if p.product_uuid in self.failing else {}
+                for p in prices]
+
+    def run_batch(self, channel, batcher=None):
+        batcher = batcher or consumer.BatchConsumer(size=10, ms=500)
+        for tag, msg in enumerate(self.messages, 1):
+            batcher(channel, *delivery(tag, msg))
+        batcher.flush()
+        return batcher
+
+    def test_00_batch_acks_at_once(self):
+        print("Validating batch acked at once")
+        ch = FakeChannel()
+        self.run_batch(ch)
+        self.assertEqual(ch.acks, [(3, True)])
+        self.assertEqual(ch.nacks, [])
+
+    def test_01_highest_tag_failed(self):
+        print("Validating batch ack when the highest tag fails")
+        ch = FakeChannel()
+        self.failing.add(self.messages[2]['product_uuid'])
+        self.run_batch(ch)
+        self.assertEqual(ch.nacks, [(3, True)])
+        self.assertEqual(ch.acks, [(2, True)])
+
+    def test_02_all_failed(self):
+        print("Validating batch without ack when all fail")
+        ch = FakeChannel()
+        self.failing.update(m['product_uuid'] for m in self.messages)
+        self.run_batch(ch)
+        self.assertEqual(ch.nacks, [(1, True), (2, True), (3, True)])
+        self.assertEqual(ch.acks, [])
+
+    def test_03_reconnect_drops_buffer(self):
+        print("Validating buffered messages dropped on reconnect")
+        old, new = FakeChannel(), FakeChannel()
+        batcher = consumer.BatchConsumer(size=10, ms=500)
+        batcher(old, *delivery(7, self.messages[0]))
+        # Redelivered on the new channel with new tags
+        batcher(new, *delivery(1, self.messages[0]))
+        batcher.flush()
+        self.assertEqual(old.acks, [])
+        self.assertEqual(new.acks, [(1, True)])
+        # Closed channel, nothing written nor acked
+        batcher(new, *delivery(2, self.messages[1]))
+        new.is_open = False
+        batcher.flush()
+        self.assertEqual(new.acks, [(1, True)])
+        self.assertEqual(batcher.buffer, [])
+
+
+class AsyncPublisherTestCase(unittest.TestCase):
+    """ Test Case for the background cache queue publisher
+    """
+
+    def publisher(self, engines, limit=100):
+        """ Publisher connecting to the given engines in turn
+        """
+        engines = list(engines)
+        p = mock.patch.object(AsyncPublisher, 'new_engine',
+                              lambda self: engines.pop(0))
+        p.start()
+        self.addCleanup(p.stop)
+        return AsyncPublisher('test_cache', limit=limit)
+
+    def test_00_buffered_in_order(self):
+        print("Validating buffered messages published in order")
+        engine = FakeEngine()
+        pub = self.publisher([engine])
+        for i in range(20):
+            pub.send({'n': i})
+        pub.close(5)
+        self.assertFalse(pub.thread.is_alive())
+        self.assertEqual(engine.bodies, [{'n': i} for i in range(20)])
+        self.assertEqual((pub.published, pub.failed), (20, 0))
+        self.assertTrue(engine.closed)
+
+    def test_01_unconfirmed_retried(self):
+        print("Validating unconfirmed messages retried once")
+        once, twice = json.dumps({'n': 1}), json.dumps({'n': 3})
+        engines = [FakeEngine(nacks=[once, twice]), FakeEngine(nacks=[twice]),
+                   FakeEngine(error=IOError('reset')), FakeEngine()]
+        pub = self.publisher(engines)
+        # Confirms awaited once for the batch
+        msgs = [{'n': i} for i in range(1, 5)]
+        engine = pub.publish(None, msgs)
+        self.assertEqual(engines[0].waits, 1)
+        self.assertEqual(engines[0].bodies, [{'n': 2}, {'n': 4}])
+        # Nacked once: retried on a new connection, the old one closed
+        self.assertTrue(engines[0].closed)
+        self.assertEqual(engines[1].bodies, [{'n': 1}])
+        # Nacked twice: counted as failed
+        self.assertEqual((pub.published, pub.failed), (3, 1))
+        self.assertIsNone(engine)
+        # Failed while waiting: the whole batch retried
+        engine = pub.publish(engine, msgs[:2])
+        self.assertTrue(engines[2].closed)
+        self.assertIs(engine, engines[3])
+        self.assertEqual(engines[3].bodies, msgs[:2])
+        self.assertEqual((pub.published, pub.failed), (5, 1))
+        pub.close(5)
+
+    def test_02_backpressure(self):
+        print("Validating publisher backpressure at the buffer limit")
+        gate = threading.Event()
+        engine = FakeEngine(gate=gate)
+        pub = self.publisher([engine], limit=2)
+        pub.send({'n': 0})
+        while not pub.buffer.empty():
+            time.sleep(0.01)
+        pub.send({'n': 1})
+        pub.send({'n': 2})
+        blocked = threading.Thread(target=pub.send, args=({'n': 3},))
+        blocked.start()
+        blocked.join(0.2)
+        # First message in flight, buffer full, sender waiting
+        self.assertTrue(blocked.is_alive())
+        gate.set()
+        blocked.join(1)
+        self.assertFalse(blocked.is_alive())
+        pub.close(5)
+        self.assertEqual(engine.bodies, [{'n': i} for i in range(4)])
+
+    def test_03_partition_counter(self):
+        print("Validating cache partition counter on the publisher path")
+        pub = mock.Mock()
+        with mock.patch.object(consumer, 'publisher', pub), \
+                mock.patch.object(consumer, 'gcounter', 1):
+            parts = []
+            for _ in range(21):
+                consumer.publish_price({})
+                parts.append(consumer.gcounter)
+            self.assertEqual(parts[:3], [2, 3, 4])
+            self.assertEqual(parts[18:], [20, 1, 2])
+        self.assertEqual(pub.send.call_count, 21)
+
+
+if __name__ == '__main__':
+    unittest.main()
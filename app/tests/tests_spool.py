@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+import tempfile
+import threading
+import unittest
+from app.utils.spool import Spool
+
+
+class SpoolTestCase(unittest.TestCase):
+    """ Test Case for the failed writes spool
+    """
+
+    def test_00_rotate_at_segment_size(self):
+        print("Validating spool rotation at the segment size")
+        spool = Spool(tempfile.mkdtemp(), segment_mb=0)
+        spool.append([{'row': 1}])
+        # Rotated while appending, without deadlocking
+        self.assertIsNone(spool.active)
+        self.assertFalse(spool.pending)
+        fpath, f = spool.claim()
+        self.assertEqual(list(Spool.read(f)), [{'row': 1}])
+        f.close()
+
+    def test_01_pending_while_rotating(self):
+        print("Validating spool pending check during rotations")
+        spool = Spool(tempfile.mkdtemp(), segment_mb=1)
+        stop, errors = threading.Event(), []
+
+        def writer():
+            while not stop.is_set():
+                spool.append([{'row': 1}])
+                spool.rotate()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            for _ in range(5000):
+                spool.pending
+        except Exception as e:
+            errors.append(e)
+        finally:
+            stop.set()
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import tempfile
+import threading
+import time
+import unittest
+from app.utils.store_directory import StoreDirectory, StoreList
+
+
+class FakeRedis(object):
+    """ redis.Redis stand-in for the shared snapshots
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+
+class CountingDirectory(StoreDirectory):
+    """ Store directory with a fake Geolocation fetch
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CountingDirectory, self).__init__(*args, **kwargs)
+        self.fetches = []
+        self.gate = threading.Event()
+        self.gate.set()
+        self.fail = False
+
+    def fetch(self, retailer, active=None):
+        self.fetches.append(retailer)
+        self.gate.wait(1)
+        if self.fail:
+            raise IOError('geolocation')
+        return StoreList([{'uuid': 'st-{}'.format(len(self.fetches)),
+                           'lat': 19.4, 'lng': -99.1}])
+
+
+class StoreDirectoryTestCase(unittest.TestCase):
+    """ Test Case for the per-process store directory
+    """
+
+    def test_00_fresh_within_ttl(self):
+        print("Validating store lists kept for the TTL")
+        directory = CountingDirectory(ttl=60)
+        first = directory.get('walmart')
+        self.assertIs(directory.get('walmart'), first)
+        self.assertEqual(directory.fetches, ['walmart'])
+        # No TTL, always fetched
+        directory.ttl = 0
+        directory.get('walmart')
+        self.assertEqual(len(directory.fetches), 2)
+
+    def test_01_stale_while_refresh(self):
+        print("Validating stale store lists served while refreshed")
+        directory = CountingDirectory(ttl=60)
+        stale = directory.get('walmart')
+        stale.fetched -= 120
+        directory.gate.clear()
+        # Stale list served, one refresh in background
+        self.assertIs(directory.get('walmart'), stale)
+        self.assertIs(directory.get('walmart'), stale)
+        directory.gate.set()
+        for _ in range(100):
+            if directory.lists['walmart:'] is not stale:
+                break
+            time.sleep(0.01)
+        self.assertEqual(directory.fetches, ['walmart', 'walmart'])
+        self.assertEqual(directory.stores('walmart')[0]['uuid'], 'st-2')
+
+    def test_02_cold_miss_single_flight(self):
+        print("Validating a single fetch for concurrent cold misses")
+        directory = CountingDirectory(ttl=60)
+        directory.gate.clear()
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(directory.get('walmart')))
+            for _ in range(5)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        directory.gate.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(directory.fetches, ['walmart'])
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(directory.calls, {})
+
+    def test_03_cold_miss_failure(self):
+        print("Validating waiters fail with the in-flight fetch")
+        directory = CountingDirectory(ttl=60)
+        directory.fail = True
+        directory.gate.clear()
+        errors = []
+
+        def get():
+            try:
+                directory.get('walmart')
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=get) for _ in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        directory.gate.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(directory.fetches, ['walmart'])
+        # Not cached, fetched again by the next caller
+        directory.fail = False
+        self.assertEqual(directory.stores('walmart')[0]['uuid'], 'st-2')
+
+    def test_04_snapshot_loading(self):
+        print("Validating store lists loaded from shared snapshots")
+        path, redis = tempfile.mkdtemp(), FakeRedis()
+        writer = CountingDirectory(ttl=60, redis=redis, path=path)
+        writer.get('walmart')
+        # Another worker loads the snapshot instead of fetching
+        for shared in (dict(redis=redis), dict(path=path)):
+            reader = CountingDirectory(ttl=60, **shared)
+            self.assertEqual(reader.stores('walmart')[0]['uuid'], 'st-1')
+            self.assertEqual(reader.fetches, [])
+        # Stale snapshots are served and refreshed
+        stale = StoreList([{'uuid': 'old'}], fetched=time.time() - 120)
+        redis.set('geoprice:stores:chedraui:', stale.dumps())
+        reader = CountingDirectory(ttl=60, redis=redis)
+        self.assertEqual(reader.stores('chedraui')[0]['uuid'], 'old')
+        for _ in range(100):
+            if reader.fetches and not reader.refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(reader.fetches, ['chedraui'])
+        self.assertEqual(reader.stores('chedraui')[0]['uuid'], 'st-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+from app import supervisor
+
+
+def crash_worker(slot, counters, batch_size, batch_ms):
+    """ Worker dying right away
+    """
+    os._exit(3)
+
+
+def draining_worker(slot, counters, batch_size, batch_ms):
+    """ Worker counting a message once drained on SIGTERM
+    """
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda s, f: stopping.append(s))
+    while not stopping:
+        time.sleep(0.01)
+    with counters.get_lock():
+        counters[0] += 1
+    os._exit(0)
+
+
+def stuck_worker(slot, counters, batch_size, batch_ms):
+    """ Worker ignoring SIGTERM
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    while True:
+        time.sleep(0.01)
+
+
+class SupervisorTestCase(unittest.TestCase):
+    """ Test Case for the multi-process consumer supervisor
+    """
+
+    def use_worker(self, target):
+        p = mock.patch.object(supervisor, 'run_worker', target)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def wait_dead(self, sup):
+        for _ in range(200):
+            if not any(p.is_alive() for p in sup.procs.values()):
+                return
+            time.sleep(0.01)
+
+    def test_00_parent_without_connections(self):
+        print("Validating the consumer is only imported in the workers")
+        code = ("import sys, app, app.supervisor; "
+                "print('app.consumer' in sys.modules, "
+                "'ByHelpers.rabbit_engine' in sys.modules)")
+        out = subprocess.check_output([sys.executable, '-c', code],
+                                      env=dict(os.environ, APP_MODE='CONSUMER'))
+        self.assertEqual(out.split()[-2:], [b'False', b'False'])
+
+    def test_01_restart_backoff(self):
+        print("Validating crashed workers restart with backoff")
+        self.use_worker(crash_worker)
+        sup = supervisor.Supervisor(1)
+        sup.spawn(0)
+        self.wait_dead(sup)
+        sup.check()
+        self.assertEqual(sup.procs[0].exitcode, 3)
+        # Scheduled once, in BACKOFF_MIN secs, doubling the next one
+        restart_at = sup.restart_at[0]
+        sup.check()
+        self.assertEqual(sup.restart_at[0], restart_at)
+        self.assertEqual(sup.backoff[0], supervisor.BACKOFF_MIN * 2)
+        sup.restart_at[0] = time.time()
+        first = sup.procs[0]
+        sup.check()
+        self.assertIsNot(sup.procs[0], first)
+        self.wait_dead(sup)
+        sup.check()
+        self.assertEqual(sup.backoff[0], supervisor.BACKOFF_MIN * 4)
+        # A worker that lived STABLE_SECS resets its backoff
+        del sup.restart_at[0]
+        sup.backoff[0] = supervisor.BACKOFF_MAX
+        sup.started[0] -= supervisor.STABLE_SECS + 1
+        sup.check()
+        self.assertAlmostEqual(sup.restart_at[0] - time.time(),
+                               supervisor.BACKOFF_MIN, delta=0.5)
+        # No restarts once stopping
+        sup.stopping = True
+        sup.restart_at[0] = time.time()
+        spawned = sup.procs[0]
+        sup.check()
+        self.assertIs(sup.procs[0], spawned)
+
+    def test_02_sigterm_drain(self):
+        print("Validating workers drained on SIGTERM")
+        self.use_worker(draining_worker)
+        handlers = [signal.getsignal(s) for s in (signal.SIGTERM, signal.SIGINT)]
+        self.addCleanup(signal.signal, signal.SIGTERM, handlers[0])
+        self.addCleanup(signal.signal, signal.SIGINT, handlers[1])
+        sup = supervisor.Supervisor(2, stats_secs=60)
+        threading.Timer(0.5, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        sup.run()
+        self.assertTrue(sup.stopping)
+        self.assertEqual([p.exitcode for p in sup.procs.values()], [0, 0])
+        self.assertEqual(sup.totals(), (2, 0))
+
+    def test_03_killed_after_drain_time(self):
+        print("Validating stuck workers killed after the drain time")
+        self.use_worker(stuck_worker)
+        p = mock.patch.object(supervisor, 'DRAIN_SECS', 0.5)
+        p.start()
+        self.addCleanup(p.stop)
+        sup = supervisor.Supervisor(1)
+        sup.spawn(0)
+        time.sleep(0.2)
+        sup.shutdown()
+        self.assertEqual(sup.procs[0].exitcode, -signal.SIGKILL)
+
+
+if __name__ == '__main__':
+    unittest.main()
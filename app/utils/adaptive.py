@@ -0,0 +1,147 @@
+"""
+AIMD controller of the Cassandra writes window: grows the writes in
+flight while latency is healthy and shrinks them quickly on driver
+timeouts/overload, so throughput settles near the cluster capacity.
+"""
+import time
+import threading
+from collections import deque
+from cassandra import OperationTimedOut, WriteTimeout, Unavailable
+from cassandra.protocol import OverloadedErrorMessage, IsBootstrappingErrorMessage
+from ByHelpers import applogger
+
+logger = applogger.get_logger()
+
+# Driver errors that mean the cluster is saturated
+OVERLOAD_ERRORS = (
+    OperationTimedOut,
+    WriteTimeout,
+    Unavailable,
+    OverloadedErrorMessage,
+    IsBootstrappingErrorMessage,
+)
+
+
+def percentile(values, pct):
+    """ Nearest rank percentile of a list of values
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[idx]
+
+
+class AdaptiveConcurrency(object):
+    """ Additive increase / multiplicative decrease writes window
+
+        - Every completed window of healthy writes adds `step` slots.
+        - Overload errors halve the window (once per window of writes).
+        - A p99 latency over `target_ms` shrinks it by 10%.
+
+        Params:
+        -----
+        initial : int
+            Starting window
+        minimum, maximum : int
+            Window bounds
+        target_ms : float
+            Healthy p99 write latency
+        sample : int
+            Recent latencies kept for the percentiles
+    """
+
+    def __init__(self, initial=16, minimum=1, maximum=100,
+                 target_ms=50.0, sample=512, step=1.0):
+        self.minimum = minimum
+        self.maximum = max(maximum, minimum)
+        self.window = float(min(max(initial, minimum), self.maximum))
+        self.target = target_ms / 1000.0
+        self.step = step
+        self.latencies = deque(maxlen=sample)
+        self.lock = threading.Lock()
+        # Completions to wait before reacting again
+        self.cooldown = 0
+        self.completed = 0
+        self.overloads = 0
+        self.last_overload = 0
+        self.last_record = 0
+
+    @property
+    def limit(self):
+        """ Writes allowed in flight
+        """
+        return int(self.window)
+
+    def record(self, latency, error=None):
+        """ Feed a finished write
+
+            Params:
+            -----
+            latency : float
+                Seconds since the write was sent
+            error : Exception
+                Write error, if any
+        """
+        with self.lock:
+            self.completed += 1
+            self.last_record = time.time()
+            if self.cooldown > 0:
+                self.cooldown -= 1
+            if isinstance(error, OVERLOAD_ERRORS):
+                self.overloads += 1
+                self.last_overload = self.last_record
+                self.decrease(0.5)
+                return
+            if error is not None:
+                return
+            self.latencies.append(latency)
+            # Evaluate latency every quarter of the sample
+            if self.completed % max(self.latencies.maxlen // 4, 1) == 0 \
+                    and self.p99 > self.target:
+                self.decrease(0.9)
+            elif self.cooldown == 0:
+                self.window = min(self.window + self.step / self.window,
+                                  self.maximum)
+
+    def decrease(self, factor):
+        """ Shrink the window once per window of completions,
+            writes sent before the decrease do not count twice
+        """
+        if self.cooldown > 0:
+            return
+        prev = self.limit
+        self.window = max(self.window * factor, self.minimum)
+        self.cooldown = prev
+        logger.debug("Writes window {} -> {} (p99 {:.1f} ms)"
+                     .format(prev, self.limit, self.p99 * 1000))
+
+    def healthy(self, secs=5):
+        """ No overload errors in the last `secs` seconds and p99
+            within target (or no recent writes to tell otherwise)
+        """
+        now = time.time()
+        with self.lock:
+            if now - self.last_overload < secs:
+                return False
+            return self.p99 <= self.target or now - self.last_record > secs
+
+    @property
+    def p50(self):
+        return percentile(list(self.latencies), 50)
+
+    @property
+    def p99(self):
+        return percentile(list(self.latencies), 99)
+
+
+class FixedConcurrency(object):
+    """ Constant writes window with the `AdaptiveConcurrency`
+        interface, used when the window is not adapted
+    """
+
+    def __init__(self, limit):
+        self.limit = max(limit, 1)
+
+    def record(self, latency, error=None):
+        pass
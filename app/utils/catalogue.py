@@ -1,5 +1,9 @@
-import requests
+from collections import OrderedDict
+from app.utils import http_session
+from app.utils.catalogue_snapshot import get_snapshot, covers, project
+from app.utils.key_cache import get_cache
 from ByHelpers import applogger
+import config
 
 # Logger
 logger = applogger.get_logger()
@@ -15,22 +19,58 @@ class Catalogue(object):
         self.base_url = "{}://{}".format(self.protocol, self.uri)
         self.auth = None
 
-    def get_items_details(self, 
-                        values=None, 
-                        cols=['item_uuid','gtin','name'], 
-                        loop_size=20, 
-                        fmt='list'):
-        """ Get item details by a given field 
-            that equals a given value.
+    @staticmethod
+    def cached(method, values, cols, fetch):
+        """ Values by uuid through the process cache, keyed by
+            (method, uuid, cols)
+
+            Params:
+            -----
+            method: str
+                Catalogue method
+            values: list
+                List of UUIDs
+            cols: list
+                List of Columns to retrieve
+            fetch: function
+                Called with the missing UUIDs, returns the values
+                by UUID of the ones fetched
+
+            Returns:
+            -----
+            list
+                Values of the UUIDs found, in requested order
         """
-        if not values:
-            logger.error("Set the values to obtain")
-            return False
-        qry_cols = ','.join(cols)
+        _cols = tuple(cols)
+        keys = [(method, v, _cols) for v in OrderedDict.fromkeys(values)]
+        found = get_cache(config.CATALOGUE_CACHE_SIZE, config.CATALOGUE_CACHE_TTL)\
+            .get_many(method, keys, lambda missing: {
+                (method, u, _cols): val
+                for u, val in fetch([k[1] for k in missing]).items()
+            })
+        return [found[k] for k in keys if k in found]
+
+    @staticmethod
+    def cache_stats():
+        """ Catalogue cache size and hit/miss counters
+        """
+        return get_cache(config.CATALOGUE_CACHE_SIZE, config.CATALOGUE_CACHE_TTL)\
+            .stats()
+
+    def fetch_items(self, values, cols, loop_size):
+        """ Request item details in chunks
+
+            Returns:
+            -----
+            dict
+                Item (None if not found) by `item_uuid` of
+                the chunks received
+        """
+        qry_cols = ','.join(cols if 'item_uuid' in cols else cols + ['item_uuid'])
         # Get chunks of n size for the values
         chunks = [values[i:i + loop_size] for i in range(0, len(values), loop_size)]
         # Iterate chunks
-        all_details = []
+        by_item = {}
         for chunk in chunks:
             try:
                 # Url
@@ -41,20 +81,83 @@ class Catalogue(object):
                 )
                 # Request
                 logger.debug ("Requesting details to: {}".format(url))
-                details = requests.get(
+                details = http_session.get(
                     url,
                     headers = {'Content-Type':'application/json'}
                 )
+                items_chunk = details.json()['items']
                 logger.debug("Received chunk")
             except Exception as e:
                 logger.error(e)
                 continue
-            
-            items_chunk = details.json()['items']
-            if isinstance(items_chunk, dict) or isinstance(items_chunk, list):
+            if isinstance(items_chunk, list):
                 logger.debug("Chunk with {} items".format(len(items_chunk)))
-                all_details = all_details + items_chunk
-        
+                by_item.update({_iu: None for _iu in chunk})
+                for i in items_chunk:
+                    by_item[i['item_uuid']] = by_item.get(i['item_uuid']) or i
+        return by_item
+
+    def fetch_products(self, values, cols, loop_size=20):
+        """ Request the products of items in chunks
+
+            Returns:
+            -----
+            dict
+                List of products by `item_uuid` of the
+                chunks received
+        """
+        qry_cols = ','.join(cols if 'item_uuid' in cols else cols + ['item_uuid'])
+        # Get chunks of n size for the values
+        chunks = [values[i:i + loop_size] for i in range(0, len(values), loop_size)]
+        # Iterate chunks
+        by_item = {}
+        for chunk in chunks:
+            try:
+                # Url
+                url = '{}/product/by/iuuid?keys={}&cols={}&ipp={}'.format(
+                    self.base_url,
+                    ','.join(chunk),
+                    qry_cols,
+                    len(chunk) * 100
+                )
+                # Request
+                logger.debug("Requesting details to: {}".format(url))
+                details = http_session.get(
+                    url,
+                    headers = {'Content-Type':'application/json'}
+                )
+                if details.status_code != 200:
+                    raise Exception('Issues requesting Catalogue')
+                items_chunk = details.json()['products']
+                logger.debug("Received chunk")
+            except Exception as e:
+                logger.error(e)
+                continue
+            if isinstance(items_chunk, list):
+                logger.debug("Chunk with {} products".format(len(items_chunk)))
+                by_item.update({_iu: [] for _iu in chunk})
+                for p in items_chunk:
+                    by_item.setdefault(p['item_uuid'], []).append(p)
+        return by_item
+
+    def get_items_details(self, 
+                        values=None, 
+                        cols=['item_uuid','gtin','name'], 
+                        loop_size=20, 
+                        fmt='list'):
+        """ Get item details by a given field 
+            that equals a given value.
+        """
+        if not values:
+            logger.error("Set the values to obtain")
+            return False
+        # Cached items, only misses are requested
+        all_details = [
+            dict(i) for i in self.cached(
+                'items_details', values, cols,
+                lambda uuids: self.fetch_items(uuids, cols, loop_size)
+            ) if i
+        ]
         # Response format
         if fmt == 'dict':
             result = { i['item_uuid'] : i for i in all_details }
@@ -86,7 +189,7 @@ class Catalogue(object):
                 )
                 # Request
                 logger.debug ("Requesting details to: {}".format(url))
-                details = requests.get(
+                details = http_session.get(
                     url,
                     headers = {'Content-Type':'application/json'}
                 )
@@ -111,7 +214,8 @@ class Catalogue(object):
                         values=None, 
                         cols=['item_uuid','gtin'], 
                         loop_size=20, 
-                        fmt='list'):
+                        fmt='list',
+                        snapshot=False):
         """ Get product details by a given field 
             that equals a Item_uuids
 
@@ -125,6 +229,10 @@ class Catalogue(object):
                 Size of chunks to retrieve info
             fmt: str   
                 Result format (`dict` or `list`)
+            snapshot: bool
+                Read from the catalogue snapshot (batch jobs
+                only: products added after it was built are
+                missing for the items it holds)
             
             Returns:
             -----
@@ -134,35 +242,20 @@ class Catalogue(object):
         if not values:
             logger.error("Set the values to obtain")
             return False
-        qry_cols = ','.join(cols)
-        # Get chunks of n size for the values
-        chunks = [values[i:i + loop_size] for i in range(0, len(values), loop_size)]
-        # Iterate chunks
         all_details = []
-        for chunk in chunks:
-            try:
-                # Url
-                url = '{}/product/by/iuuid?keys={}&cols={}&ipp={}'.format(
-                    self.base_url,
-                    ','.join(chunk),
-                    qry_cols,
-                    loop_size * 100
-                )
-                # Request
-                logger.debug("Requesting details to: {}".format(url))
-                details = requests.get(
-                    url,
-                    headers = {'Content-Type':'application/json'}
-                )
-                logger.debug("Received chunk")
-            except Exception as e:
-                logger.error(e)
-                continue
-            
-            items_chunk = details.json()['products']
-            if isinstance(items_chunk, dict) or isinstance(items_chunk, list):
-                logger.debug("Chunk with {} products".format(len(items_chunk)))
-                all_details = all_details + items_chunk        
+        # Products from the snapshot, only misses are requested
+        snap = get_snapshot() if snapshot else None
+        if snap is not None and covers(cols):
+            all_details, values = snap.by_items(values)
+            all_details = project(all_details, cols,
+                                  ('item_uuid', 'product_uuid'))
+            logger.debug("{} products from snapshot, {} items missing"
+                         .format(len(all_details), len(values)))
+        # Cached products of the rest, only misses are requested
+        for prods in self.cached(
+                'products_by_item', values, cols,
+                lambda uuids: self.fetch_products(uuids, cols, loop_size)):
+            all_details += [dict(p) for p in prods]
         # Response format
         if fmt == 'dict':
             result = { i['product_uuid'] : i for i in all_details }
@@ -176,8 +269,9 @@ class Catalogue(object):
 
             Params:
             -----
-            item_uuid : str
-                Item UUID
+            item_uuid : str or list
+                Item UUID, comma separated Item UUIDs
+                or list of them
             cols : list
                 List of requested table columns
             
@@ -186,27 +280,18 @@ class Catalogue(object):
             products : list
                 List requested of products
         """
-        url = self.base_url + \
-            '/product/by/iuuid?keys={item}&ipp=50&cols={cols}'\
-            .format(item=item_uuid,
-                    cols=','.join(cols))
-        logger.debug(url)
-        try:
-            r = requests.get(url)
-            logger.debug(r.status_code)
-            # In case of error
-            if r.status_code != 200:
-                raise Exception('Issues requesting Catalogue')
-        except Exception as e:
-            logger.error(e)
-            return []
+        if isinstance(item_uuid, str):
+            item_uuid = [_iu for _iu in item_uuid.split(',') if _iu]
         # Format response
         products = []
-        for p in r.json()['products']:
-            products.append(
-                {j:x for j, x in p.items() \
-                    if j in cols}
-            )
+        for prods in self.cached(
+                'products_by_item', item_uuid, cols,
+                lambda uuids: self.fetch_products(uuids, cols)):
+            for p in prods:
+                products.append(
+                    {j:x for j, x in p.items() \
+                        if j in cols}
+                )
         return products
 
 
@@ -264,7 +349,7 @@ class Catalogue(object):
                         self.base_url, qry, p, ipp
                     )
                     logger.debug(url)
-                    r = requests.get(url)
+                    r = http_session.get(url)
                     if r.status_code != 200:
                         raise Exception("Could not fetch product intersection")
                     page_prods = r.json()['products'] 
@@ -284,7 +369,8 @@ class Catalogue(object):
 
         return result
     
-    def get_by_source(self, data_source, cols=[], qsize=None):
+    def get_by_source(self, data_source, cols=[], qsize=None, snapshot=False,
+                      strict=False):
         """ Request and build a source's items
             catalogue.
 
@@ -295,8 +381,24 @@ class Catalogue(object):
             cols: list
                 List of columns to retrieve
             qsize: int
-                Size of query (default: NoneType)
+                Products per page (default: 500), also
+                the records built at a time from the snapshot
+            snapshot: bool
+                Read from the catalogue snapshot if it
+                holds the source and columns (batch jobs
+                only: it misses products added after it
+                was built)
+            strict: bool
+                Raise on a failed page instead of returning
+                the pages fetched so far
         """
+        snap = get_snapshot() if snapshot else None
+        if snap is not None and covers(cols):
+            catalogue = snap.by_source(data_source, cols, qsize or 500)
+            if catalogue is not None:
+                logger.debug("{} products of {} from snapshot"
+                             .format(len(catalogue), data_source))
+                return catalogue
         # Build the query
         q = "?keys="+data_source
         # Pagination
@@ -315,16 +417,22 @@ class Catalogue(object):
         while nxt:  
             logger.debug("Getting page: {}".format(p))
             try:
-                r = requests.get(self.base_url \
+                r = http_session.get(self.base_url \
                     + "/product/by/source"\
                     + q \
                     + "&p={}&ipp={}&cols={}".format(p,ipp, cols_fmt)
                 )
-            except:
+            except Exception as e:
                 logger.warning("Issues connecting to Catalogue Service!")
+                if strict:
+                    raise Exception("Could not fetch page {} of {}"
+                                    .format(p, data_source), e)
                 break
             if r.status_code != 200:
                 logger.warning("Could not fetch data_source catalogue")
+                if strict:
+                    raise Exception("Could not fetch page {} of {} ({})"
+                                    .format(p, data_source, r.status_code))
                 break
             page_items = r.json()['products'] 
             if not page_items:
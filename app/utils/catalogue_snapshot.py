@@ -0,0 +1,305 @@
+"""
+Read-only on-disk snapshot of the Catalogue product mapping
+(product_uuid, item_uuid, source, gtin, name), built by the
+`create_catalogue_snapshot` script. Columns are NumPy files
+memory-mapped by every worker (pages shared through the OS page
+cache): products sorted by 16-byte uuid, an item-sorted index,
+source codes and gtin/name string tables. Lookups are binary
+searches, misses are left to the live Catalogue service.
+
+A snapshot can be up to `CATALOGUE_SNAPSHOT_MAX_AGE` old and products
+added since are missing from it, while their item is found. Lookups
+only read it when the caller opts in (`snapshot=True`, batch jobs);
+web and alert paths call the live Catalogue.
+
+Layout of `CATALOGUE_SNAPSHOT_DIR`:
+    CURRENT                 name of the published version
+    <version>/meta.json     sources table, size, build time
+    <version>/*.npy         column arrays
+    <version>/name.bin      utf-8 names, sliced by `name_offsets`
+"""
+import os
+import json
+import time
+import datetime
+import shutil
+import threading
+from uuid import UUID
+import numpy as np
+from ByHelpers import applogger
+import config
+
+logger = applogger.get_logger()
+
+# Fields of a snapshot record
+FIELDS = ('product_uuid', 'item_uuid', 'source', 'gtin', 'name')
+_NULL_UUID = b'\x00' * 16
+
+
+def uuid_bytes(values):
+    """ `S16` array of uuid strings, invalid or empty values
+        become null uuids
+    """
+    out = []
+    for v in values:
+        try:
+            out.append(UUID(str(v)).bytes if v else _NULL_UUID)
+        except ValueError:
+            out.append(_NULL_UUID)
+    return np.array(out, dtype='S16')
+
+
+def uuid_str(raw):
+    """ uuid string of a `S16` value, None for null uuids
+    """
+    raw = bytes(raw).ljust(16, b'\x00')
+    return None if raw == _NULL_UUID else str(UUID(bytes=raw))
+
+
+def build(records, path, keep=2):
+    """ Write a snapshot version of Catalogue records and
+        publish it as CURRENT
+
+        Params:
+        -----
+        records : iterable
+            dicts with (some of) `FIELDS`
+        path : str
+            Snapshot directory
+        keep : int
+            Published versions kept on disk
+
+        Returns:
+        -----
+        str
+            Published version directory
+    """
+    # Last record of a product wins
+    by_product = {}
+    for r in records:
+        if r.get('product_uuid'):
+            by_product[str(r['product_uuid'])] = r
+    rows = list(by_product.values())
+    puuids = uuid_bytes([r['product_uuid'] for r in rows])
+    order = np.argsort(puuids, kind='mergesort')
+    puuids = puuids[order]
+    rows = [rows[i] for i in order]
+    # Rows with an invalid product uuid are dropped
+    valid = puuids != _NULL_UUID
+    puuids = puuids[valid]
+    rows = [r for r, v in zip(rows, valid) if v]
+    iuuids = uuid_bytes([r.get('item_uuid') for r in rows])
+    sources = sorted(set(str(r.get('source') or '') for r in rows))
+    codes = {s: i for i, s in enumerate(sources)}
+    source = np.array([codes[str(r.get('source') or '')] for r in rows],
+                      dtype=np.uint16)
+    gtin = np.array([str(r.get('gtin') or '').encode('utf-8') for r in rows],
+                    dtype=bytes)
+    names = [str(r.get('name') or '').encode('utf-8') for r in rows]
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    np.cumsum([len(n) for n in names], out=offsets[1:])
+    # Item index: positions sorted by item uuid
+    by_item = np.argsort(iuuids, kind='mergesort').astype(np.int64)
+
+    version = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f')
+    vdir = os.path.join(path, version)
+    os.makedirs(vdir)
+    np.save(os.path.join(vdir, 'product_uuid.npy'), puuids)
+    np.save(os.path.join(vdir, 'item_uuid.npy'), iuuids)
+    np.save(os.path.join(vdir, 'item_sorted.npy'), iuuids[by_item])
+    np.save(os.path.join(vdir, 'by_item.npy'), by_item)
+    np.save(os.path.join(vdir, 'source.npy'), source)
+    np.save(os.path.join(vdir, 'gtin.npy'), gtin)
+    np.save(os.path.join(vdir, 'name_offsets.npy'), offsets)
+    with open(os.path.join(vdir, 'name.bin'), 'wb') as f:
+        f.write(b''.join(names))
+    with open(os.path.join(vdir, 'meta.json'), 'w') as f:
+        json.dump({'sources': sources, 'size': len(rows),
+                   'built': time.time()}, f)
+    # Publish atomically
+    tmp = os.path.join(path, 'CURRENT.{}'.format(os.getpid()))
+    with open(tmp, 'w') as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(path, 'CURRENT'))
+    # Prune old versions, mapped files stay readable until unmapped
+    versions = sorted(d for d in os.listdir(path)
+                      if os.path.isdir(os.path.join(path, d)))
+    for old in versions[:-keep]:
+        shutil.rmtree(os.path.join(path, old), ignore_errors=True)
+    logger.info("Published catalogue snapshot {} ({} products)"
+                .format(version, len(rows)))
+    return vdir
+
+
+class CatalogueSnapshot(object):
+    """ Memory-mapped snapshot version
+
+        Params:
+        -----
+        vdir : str
+            Version directory
+    """
+
+    def __init__(self, vdir):
+        self.vdir = vdir
+        with open(os.path.join(vdir, 'meta.json')) as f:
+            meta = json.load(f)
+        self.sources = meta['sources']
+        self.built = meta['built']
+        self.codes = {s: i for i, s in enumerate(self.sources)}
+
+        def load(name):
+            return np.load(os.path.join(vdir, name + '.npy'), mmap_mode='r')
+        self.product_uuid = load('product_uuid')
+        self.item_uuid = load('item_uuid')
+        self.item_sorted = load('item_sorted')
+        self.by_item = load('by_item')
+        self.source = load('source')
+        self.gtin = load('gtin')
+        self.name_offsets = load('name_offsets')
+        if self.name_offsets[-1]:
+            self.names = np.memmap(os.path.join(vdir, 'name.bin'),
+                                   dtype=np.uint8, mode='r')
+        else:
+            self.names = np.array([], dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.product_uuid)
+
+    def age(self):
+        return time.time() - self.built
+
+    def record(self, pos):
+        """ Catalogue-like dict of a position
+        """
+        start, end = self.name_offsets[pos], self.name_offsets[pos + 1]
+        return {
+            'product_uuid': uuid_str(self.product_uuid[pos]),
+            'item_uuid': uuid_str(self.item_uuid[pos]),
+            'source': self.sources[self.source[pos]],
+            'gtin': self.gtin[pos].decode('utf-8'),
+            'name': self.names[start:end].tobytes().decode('utf-8'),
+        }
+
+    @staticmethod
+    def search(sorted_arr, keys):
+        """ [start, end) ranges of the keys in a sorted array
+        """
+        return (np.searchsorted(sorted_arr, keys, side='left'),
+                np.searchsorted(sorted_arr, keys, side='right'))
+
+    def products(self, product_uuids):
+        """ Records of product uuids
+
+            Returns:
+            -----
+            (list, list)
+                Records found, product uuids not found
+        """
+        keys = uuid_bytes(product_uuids)
+        lo, hi = self.search(self.product_uuid, keys)
+        found, missing = [], []
+        for puuid, key, l, h in zip(product_uuids, keys, lo, hi):
+            if h > l and key != _NULL_UUID:
+                found.append(self.record(l))
+            else:
+                missing.append(puuid)
+        return found, missing
+
+    def has_sources(self, sources):
+        """ Whether all the sources are in the snapshot
+        """
+        return all(s in self.codes for s in sources)
+
+    def by_items(self, item_uuids, sources=None):
+        """ Records of the products of item uuids, from the
+            given sources only if set
+
+            Returns:
+            -----
+            (list, list)
+                Records found, item uuids without products
+        """
+        keys = uuid_bytes(item_uuids)
+        lo, hi = self.search(self.item_sorted, keys)
+        codes = None if sources is None \
+            else set(self.codes[s] for s in sources if s in self.codes)
+        found, missing = [], []
+        for iuuid, key, l, h in zip(item_uuids, keys, lo, hi):
+            if h == l or key == _NULL_UUID:
+                missing.append(iuuid)
+                continue
+            for pos in np.sort(self.by_item[l:h]):
+                if codes is None or self.source[pos] in codes:
+                    found.append(self.record(pos))
+        return found, missing
+
+    def by_source(self, source, cols=None, size=500):
+        """ Records of a source with the requested columns
+            (`project`), None if not in the snapshot. Built
+            `size` at a time, like the Catalogue pages
+        """
+        if source not in self.codes:
+            return None
+        positions = np.flatnonzero(self.source == self.codes[source])
+        records = []
+        for start in range(0, len(positions), size):
+            records += project([self.record(p) for p in
+                                positions[start:start + size]], cols)
+        return records
+
+
+def covers(cols):
+    """ Whether the snapshot holds all the requested columns
+    """
+    return set(cols or []) <= set(FIELDS)
+
+
+def project(records, cols, keys=()):
+    """ Records with the requested columns only (plus `keys`,
+        which the Catalogue always returns), whole records
+        when no columns are requested
+    """
+    if not cols:
+        return records
+    fields = set(cols) | set(keys)
+    return [{f: r[f] for f in FIELDS if f in fields} for r in records]
+
+
+# Snapshot of the process, its version and last CURRENT check
+_snapshot = None
+_version = None
+_checked = 0
+_lock = threading.Lock()
+
+
+def get_snapshot():
+    """ Published snapshot, re-opened once CURRENT changes
+        (checked every `CATALOGUE_SNAPSHOT_CHECK` secs). None
+        when disabled, missing or older than
+        `CATALOGUE_SNAPSHOT_MAX_AGE` secs
+    """
+    global _snapshot, _version, _checked
+    path = config.CATALOGUE_SNAPSHOT_DIR
+    if not path:
+        return None
+    if time.time() - _checked > config.CATALOGUE_SNAPSHOT_CHECK:
+        with _lock:
+            if time.time() - _checked > config.CATALOGUE_SNAPSHOT_CHECK:
+                _checked = time.time()
+                try:
+                    with open(os.path.join(path, 'CURRENT')) as f:
+                        version = f.read().strip()
+                    if version != _version:
+                        _snapshot = CatalogueSnapshot(os.path.join(path, version))
+                        _version = version
+                        logger.info("Loaded catalogue snapshot {} ({} products)"
+                                    .format(version, len(_snapshot)))
+                except Exception as e:
+                    if _version is not None or os.path.exists(path):
+                        logger.warning("Could not load catalogue snapshot")
+                        logger.error(e)
+    snap = _snapshot
+    if snap is None or snap.age() > config.CATALOGUE_SNAPSHOT_MAX_AGE:
+        return None
+    return snap
@@ -0,0 +1,175 @@
+"""
+Typed column buffers filled page by page from plain row tuples,
+so large reads become NumPy arrays / a DataFrame without building
+a namedtuple per row and boxing it again into DataFrame columns.
+"""
+import datetime
+from uuid import UUID
+import numpy as np
+import pandas as pd
+
+# Column kinds by Python type of the driver values
+KINDS = (
+    (bool, 'bool'),
+    (int, 'int'),
+    (float, 'float'),
+    (UUID, 'uuid'),
+    (datetime.datetime, 'datetime'),
+)
+# Array dtype of each kind, prices are stored as float32
+DTYPES = {
+    'bool': np.bool_,
+    'int': np.int64,
+    'float': np.float32,
+    'uuid': 'S16',
+    'datetime': 'datetime64[us]',
+    'object': object,
+}
+_NULL_UUID = b'\x00' * 16
+
+
+def kind_of(value):
+    """ Column kind of a value
+    """
+    for _type, kind in KINDS:
+        if isinstance(value, _type):
+            return kind
+    return 'object'
+
+
+def to_array(values, kind, floats=np.float32):
+    """ Typed array of a page column, None values become
+        NaN/NaT (ints are promoted to float64) or null UUIDs
+    """
+    if kind == 'uuid':
+        return np.array([v.bytes if v is not None else _NULL_UUID
+                         for v in values], dtype='S16')
+    if kind in ('int', 'bool') and None in values:
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=np.float64)
+    if kind == 'float':
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=floats)
+    return np.array(values, dtype=DTYPES[kind])
+
+
+def uuid_strings(arr):
+    """ UUID strings of a `S16` array (numpy strips trailing
+        null bytes, they are padded back), null UUIDs as None
+    """
+    return np.array([str(UUID(bytes=b.ljust(16, b'\x00'))) if b else None
+                     for b in arr], dtype=object)
+
+
+class Page(list):
+    """ Row tuples of a page with their column names
+    """
+    names = ()
+
+
+def page_factory(colnames, rows):
+    """ Driver row factory keeping rows as plain tuples
+    """
+    page = Page(rows)
+    page.names = colnames
+    return page
+
+
+class Columns(object):
+    """ Column buffers of a query result, fed with pages of
+        row tuples (`page_factory`) and read as a dict of
+        arrays or a DataFrame
+
+        Params:
+        -----
+        names : list
+            Column names, taken from the first page if not set
+        dtypes : dict
+            Array dtype overrides by column (i.e. `float64`
+            for double sums)
+        floats : numpy.dtype
+            dtype of float columns, float32 by default, float64
+            for values that end up JSON serialized
+    """
+
+    def __init__(self, names=None, dtypes=None, floats=np.float32):
+        self.names = list(names) if names else None
+        self.dtypes = dtypes or {}
+        self.floats = floats
+        self.kinds = {}
+        self.chunks = {}
+        self.rows = 0
+
+    def add_page(self, rows, names=None):
+        """ Append a page of row tuples (a `Page` or
+            namedtuples carry their column names)
+        """
+        if not rows:
+            return
+        if self.names is None:
+            self.names = list(names or getattr(rows, 'names', None)
+                              or rows[0]._fields)
+        for name, values in zip(self.names, zip(*rows)):
+            kind = self.kinds.get(name)
+            if kind is None:
+                first = next((v for v in values if v is not None), None)
+                if first is None:
+                    # Kind still unknown, kept as objects
+                    self.chunks.setdefault(name, []).append(
+                        np.array(values, dtype=object))
+                    continue
+                kind = self.kinds[name] = kind_of(first)
+                # Earlier all-null pages typed as the column
+                self.chunks[name] = [self.typed(name, list(c), kind)
+                                     for c in self.chunks.get(name, [])]
+            self.chunks.setdefault(name, []).append(
+                self.typed(name, values, kind))
+        self.rows += len(rows)
+
+    def typed(self, name, values, kind):
+        """ Array of a page column with its dtype
+        """
+        if name in self.dtypes:
+            return np.array(values, dtype=self.dtypes[name])
+        return to_array(values, kind, self.floats)
+
+    def truncate(self, rows):
+        """ Drop every row after the first `rows` (i.e. the
+            pages of a query that failed partway)
+        """
+        if rows >= self.rows:
+            return
+        for name, chunks in self.chunks.items():
+            if chunks:
+                self.chunks[name] = [np.concatenate(chunks)[:rows]]
+        self.rows = rows
+
+    def __len__(self):
+        return self.rows
+
+    def arrays(self):
+        """ dict of column arrays (UUIDs as `S16` bytes)
+        """
+        result = {}
+        for name in self.names or []:
+            chunks = self.chunks.get(name, [])
+            if not chunks:
+                result[name] = np.array([], dtype=DTYPES[self.kinds.get(name, 'object')])
+            elif len(chunks) == 1:
+                result[name] = chunks[0]
+            else:
+                result[name] = np.concatenate(chunks)
+            # Keep the merged array as the only chunk
+            self.chunks[name] = [result[name]]
+        return result
+
+    def frame(self, uuids=True):
+        """ DataFrame of the columns, UUID columns as strings
+            unless `uuids` is False
+        """
+        arrays = self.arrays()
+        if uuids:
+            for name, kind in self.kinds.items():
+                if kind == 'uuid' and self.dtypes.get(name) is None:
+                    arrays[name] = uuid_strings(arrays[name])
+        return pd.DataFrame(arrays, columns=self.names or [])
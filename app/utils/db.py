@@ -1,5 +1,8 @@
 #-*-coding: utf-8-*-
+import os
 import sys
+import atexit
+import threading
 from cassandra import AlreadyExists
 from app.utils.simple_cassandra import SimpleCassandra
 from ByHelpers import applogger 
@@ -9,6 +12,10 @@ import config
 cluster = None
 session = None
 logger = applogger.get_logger()
+# Process-wide connection and the pid that created it
+shared = None
+shared_pid = None
+shared_lock = threading.Lock()
 
 # Create the database and schema
 def initdb():
@@ -115,6 +122,7 @@ def getdb():
         PORT=config.CASSANDRA_PORT,
         KEYSPACE=config.CASSANDRA_KEYSPACE,
         CONSISTENCY_LEVEL="ONE",
+        LOCAL_DC=config.CASSANDRA_LOCAL_DC,
         USER=config.CASSANDRA_USER,
         PASSWORD=config.CASSANDRA_PASSWORD,
         TIMEOUT=6000000000000000
@@ -122,3 +130,32 @@ def getdb():
     logger.debug("Connected to  Cassandra")
     return cass
 
+
+def shared_db():
+    """ Process-wide SimpleCassandra shared by every request and
+        task of the process. Created lazily on first use, so each
+        forked worker (gunicorn, celery, consumers) builds its own
+        after fork, and shut down only at process exit.
+    """
+    global shared, shared_pid
+    pid = os.getpid()
+    if shared is None or shared_pid != pid:
+        with shared_lock:
+            if shared is None or shared_pid != pid:
+                shared = getdb()
+                shared_pid = pid
+    return shared
+
+
+def close_shared():
+    """ Shut down the process-wide connection, connections
+        inherited through fork belong to the parent
+    """
+    global shared
+    if shared is not None and shared_pid == os.getpid():
+        logger.debug("Closing Cassandra connection")
+        shared.close()
+    shared = None
+
+
+atexit.register(close_shared)
@@ -0,0 +1,61 @@
+"""
+Message body decoders chosen by the AMQP content-type.
+
+JSON goes through `orjson` when installed (falls back to the
+standard library) and MessagePack needs `msgpack` installed.
+"""
+import json
+from ByHelpers import applogger
+
+logger = applogger.get_logger()
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def decode_json(body):
+    """ Decode a UTF-8 JSON body (bytes or str)
+    """
+    return _json_loads(body)
+
+
+def decode_msgpack(body):
+    """ Decode a MessagePack body with the same schema as JSON
+    """
+    if msgpack is None:
+        raise Exception("msgpack is not installed, could not decode body")
+    return msgpack.unpackb(body, raw=False)
+
+
+# Decoders by content-type, JSON is the default
+DECODERS = {
+    'application/json': decode_json,
+    'application/msgpack': decode_msgpack,
+    'application/x-msgpack': decode_msgpack,
+}
+
+
+def decode(body, content_type=None):
+    """ Decode a message body by its content-type
+
+        Params:
+        -----
+        body : bytes
+            Raw message body
+        content_type : str
+            AMQP content-type property (default JSON)
+
+        Returns:
+        -----
+        dict
+            Decoded message
+    """
+    return DECODERS.get(content_type, decode_json)(body)
@@ -1,4 +1,4 @@
-import requests
+from app.utils.store_directory import get_directory
 from ByHelpers import applogger
 
 # Logger
@@ -17,10 +17,7 @@ class Geolocation(object):
         """ Request list of retailers and set them
             in retailers variables
         """
-        self.retailers = requests.get(
-            self.base_url\
-            +"/retailer/all"
-        ).json()
+        self.retailers = list(get_directory().retailers())
         self.retailers_dict = { i['key'] : i for i in self.retailers }
         return self.retailers
 
@@ -37,13 +34,12 @@ class Geolocation(object):
 
         """
         stores = []
-        qry_active = '&active={}'.format(active) if active else ''
         for retailer in rets:
             # Fetch Stores by retailer
             try:
-                stores_j = requests\
-                    .get(self.base_url+"/store/retailer?key="+retailer+qry_active)\
-                    .json()
+                # Copies of the cached stores
+                stores_j = [dict(s) for s in
+                            get_directory().stores(retailer, active)]
                 logger.debug("Fetched {} stores!".format(retailer))
             except Exception as e:
                 logger.error(e)
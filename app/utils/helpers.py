@@ -1,7 +1,9 @@
 import datetime
+from uuid import UUID
 import pandas as pd
 import numpy as np
-import requests
+from app.utils.store_directory import get_directory
+from app.utils.spatial import haversine_km
 from config import *
 from app import logger
 import calendar
@@ -32,6 +34,30 @@ def tuplize(_list, is_uuid=False):
 
 
 
+def valid_uuids(_list):
+    """ UUIDs of a list of strings, malformed ones are
+        logged and skipped
+
+        Params:
+        -----
+        _list : list
+            UUID strings (i.e. from the Catalogue Service)
+
+        Returns:
+        -----
+        uuids : list
+            uuid.UUID of the valid ones, in order
+    """
+    uuids = []
+    for _u in _list:
+        try:
+            uuids.append(UUID(str(_u)))
+        except (ValueError, TypeError):
+            logger.warning("Skipping malformed UUID: {}".format(_u))
+    return uuids
+
+
+
 def tupleize_date(date, periods):
     """ Generate date tuples from a certain date 
         and a number of prior periods (days)
@@ -72,10 +98,9 @@ def fetch_store(rkey):
     """
     try:
         logger.debug('Querying %s' %(geo_stores_url % rkey))
-        xr = requests.get((geo_stores_url % rkey) +'&active=all').json()
-        for i, x in enumerate(xr):
-            xr[i].update({'source': rkey})
-        return xr
+        # Copies of the cached stores
+        return [dict(x, source=rkey)
+                for x in get_directory().stores(rkey, active='all')]
     except Exception as e:
         logger.error(e)
         logger.warning('Issues retrieving %s stores' % str(rkey))
@@ -97,7 +122,7 @@ def get_all_stores(rets=[]):
     """
     # Verify rets
     if not rets:
-        rets = requests.get(geo_rets_url).json()
+        rets = get_directory().retailers()
     stores = []
     for r in rets:
         tmp = fetch_store(r['key'])
@@ -125,28 +150,17 @@ def obtain_distances(fixed, added, rets):
         _added_d : dict
             Hash table mapping fixed store to added store
     """
-    # Fetch all stores
-    _st_list = []
-    _geo_df = get_all_stores([{'key': r} for r in rets])
+    # Coordinates of all stores
+    uuids, lat, lng = get_directory().coords(rets)
     # Get fixed store values
-    _f =  _geo_df[_geo_df['store_uuid'] == fixed]
-    f_lat, f_lng = _f['lat'].values[0], _f['lng'].values[0]
+    _f = np.flatnonzero(uuids == fixed)[0]
+    f_lat, f_lng = lat[_f], lng[_f]
     # Compute distances from fixed against added
-    _geo_df = _geo_df[_geo_df.store_uuid.isin(added)]
-    _geo_df['fdist'] = np\
-        .arccos(np.sin(np.deg2rad(_geo_df.lat))
-            * np.sin(np.deg2rad(f_lat))
-            + np.cos(np.deg2rad(_geo_df.lat))
-            * np.cos(np.deg2rad(f_lat))
-            * np.cos(np.deg2rad(f_lng)
-                        - (np.deg2rad(_geo_df.lng))
-                        )
-            ) * 6371
-    _geo_df.fdist = _geo_df.fdist.apply(lambda x: round(x,2))
+    _mask = np.isin(uuids, added)
+    fdist = haversine_km(f_lat, f_lng, lat[_mask], lng[_mask])
     # Reformat values
-    _added_d = _geo_df[['store_uuid', 'fdist']]\
-                .set_index('store_uuid')\
-                .to_dict()['fdist']
+    _added_d = dict(zip(uuids[_mask].tolist(),
+                        np.round(fdist, 2).tolist()))
     logger.info('Got distances')
     return _added_d
 
@@ -0,0 +1,74 @@
+"""
+Process-wide pooled HTTP session of the service clients
+(Catalogue, Geolocation): keep-alive connections per host,
+default timeout and retries with backoff on connection errors
+and 5xx responses.
+"""
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from ByHelpers import applogger
+import config
+
+logger = applogger.get_logger()
+# Session of the process and the pid that created it
+_session = None
+_session_pid = None
+_lock = threading.Lock()
+# Methods retried
+_IDEMPOTENT = frozenset(['GET', 'HEAD', 'OPTIONS'])
+
+
+def build_session(pool_size=None, retries=None, backoff=None):
+    """ requests Session with pooled keep-alive adapters and
+        retries of idempotent requests
+    """
+    pool_size = pool_size or config.SRV_POOL_SIZE
+    # `allowed_methods` replaced `method_whitelist` in urllib3 1.26,
+    # the old name is gone in 2.x
+    methods = ('allowed_methods' if hasattr(Retry, 'DEFAULT_ALLOWED_METHODS')
+               else 'method_whitelist')
+    retry = Retry(
+        total=config.SRV_RETRIES if retries is None else retries,
+        backoff_factor=config.SRV_BACKOFF if backoff is None else backoff,
+        status_forcelist=(500, 502, 503, 504),
+        raise_on_status=False,
+        **{methods: _IDEMPOTENT}
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """ Session shared by the process, built again after fork
+        so workers never share sockets with their parent
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = build_session()
+                _session_pid = pid
+    return _session
+
+
+def request(method, url, **kwargs):
+    """ `requests.request` through the shared session, with
+        the default service timeout
+    """
+    kwargs.setdefault('timeout', config.SRV_TIMEOUT)
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    """ `requests.get` through the shared session
+    """
+    return request('GET', url, **kwargs)
@@ -0,0 +1,171 @@
+"""
+Per-process TTL LRU of service responses by key, where multi-key
+requests are split into hits and misses, and concurrent askers of
+the same missing key wait for a single in-flight fetch
+(single-flight) instead of requesting it again.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from ByHelpers import applogger
+from app.utils.metrics import REGISTRY
+
+logger = applogger.get_logger()
+
+HITS = REGISTRY.counter('geoprice_service_cache_hits_total',
+                        'Service cache hits', 'method')
+MISSES = REGISTRY.counter('geoprice_service_cache_misses_total',
+                          'Service cache misses (fetched)', 'method')
+COALESCED = REGISTRY.counter('geoprice_service_cache_coalesced_total',
+                             'Misses served by an in-flight fetch', 'method')
+
+
+class _Call(object):
+    """ In-flight fetch of a key
+    """
+    __slots__ = ('event', 'ok', 'value')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.ok = False
+        self.value = None
+
+
+class KeyCache(object):
+    """ TTL LRU with single-flight fetches of the misses
+
+        Params:
+        -----
+        maxsize : int
+            Max cached keys, least recently used are evicted
+        ttl : int
+            Seconds a value is fresh (0: values are not kept,
+            only in-flight fetches are shared)
+        wait : float
+            Max seconds to wait for a fetch of another asker
+    """
+
+    def __init__(self, maxsize=20000, ttl=300, wait=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.wait = wait
+        self.data = OrderedDict()
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.data)
+
+    def store(self, key, value, now):
+        """ Keep a value (lock held)
+        """
+        if not self.ttl:
+            return
+        self.data[key] = (now + self.ttl, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def get_many(self, method, keys, fetch):
+        """ Values of keys: fresh cached ones, the ones being
+            fetched by another asker, and the rest fetched once
+
+            Params:
+            -----
+            method : str
+                Counters label
+            keys : list
+                Hashable keys (i.e. (method, uuid, cols))
+            fetch : function
+                Called with the missing keys, returns a dict of
+                the values by key of the fetched keys (keys left
+                out failed and are neither cached nor returned)
+
+            Returns:
+            -----
+            dict
+                Values by key
+        """
+        result, owned, waiting = {}, [], {}
+        seen = set()
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                if key in seen:
+                    continue
+                seen.add(key)
+                entry = self.data.get(key)
+                if entry is not None and entry[0] > now:
+                    self.data.move_to_end(key)
+                    result[key] = entry[1]
+                    continue
+                if entry is not None:
+                    del self.data[key]
+                call = self.calls.get(key)
+                if call is not None:
+                    waiting[key] = call
+                else:
+                    self.calls[key] = _Call()
+                    owned.append(key)
+        HITS.inc(len(result), method)
+        MISSES.inc(len(owned), method)
+        COALESCED.inc(len(waiting), method)
+        if owned:
+            values = {}
+            try:
+                values = fetch(owned)
+            except Exception as e:
+                logger.error(e)
+            finally:
+                now = time.time()
+                with self.lock:
+                    for key in owned:
+                        call = self.calls.pop(key)
+                        if key in values:
+                            call.ok, call.value = True, values[key]
+                            self.store(key, call.value, now)
+                            result[key] = call.value
+                        call.event.set()
+        for key, call in waiting.items():
+            if call.event.wait(self.wait) and call.ok:
+                result[key] = call.value
+            else:
+                logger.warning("In-flight fetch failed for {}".format(key))
+        return result
+
+    def stats(self):
+        """ Cache size and hit/miss/coalesced counters by method
+        """
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'ttl': self.ttl,
+            'hits': dict(HITS.values),
+            'misses': dict(MISSES.values),
+            'coalesced': dict(COALESCED.values),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+# Cache of the process and the pid that created it
+_cache = None
+_cache_pid = None
+_lock = threading.Lock()
+
+
+def get_cache(maxsize, ttl):
+    """ Cache shared by the process, built again after fork
+        so workers never inherit a held lock
+    """
+    global _cache, _cache_pid
+    pid = os.getpid()
+    if _cache is None or _cache_pid != pid:
+        with _lock:
+            if _cache is None or _cache_pid != pid:
+                _cache = KeyCache(maxsize, ttl)
+                _cache_pid = pid
+    return _cache
@@ -0,0 +1,239 @@
+"""
+In-process consumer metrics: counters, gauges and log-linear
+(HDR-style) latency histograms, exposed in Prometheus text format
+through a tiny HTTP endpoint and/or dumped periodically to the log.
+"""
+import math
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from ByHelpers import applogger
+
+logger = applogger.get_logger()
+
+
+class Counter(object):
+    """ Monotonic counter, optionally by label value
+    """
+    kind = 'counter'
+
+    def __init__(self, name, doc, label=None):
+        self.name = name
+        self.doc = doc
+        self.label = label
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, n=1, label=None):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + n
+
+    def samples(self):
+        for label, val in sorted(list(self.values.items()), key=lambda kv: str(kv[0])):
+            yield self.name, self.labels(label), val
+
+    def labels(self, label, extra=''):
+        pairs = []
+        if self.label and label is not None:
+            pairs.append('{}="{}"'.format(self.label, label))
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Gauge(Counter):
+    """ Current value, set or read from a function on render
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, doc, label=None, fn=None):
+        super(Gauge, self).__init__(name, doc, label)
+        self.fn = fn
+
+    def set(self, val, label=None):
+        self.values[label] = val
+
+    def samples(self):
+        if self.fn is not None:
+            try:
+                self.values[None] = self.fn()
+            except Exception:
+                pass
+        return super(Gauge, self).samples()
+
+
+class Histogram(Counter):
+    """ Log-linear latency histogram: `per_octave` buckets per
+        power of two from `lowest` seconds, so every bucket has the
+        same relative precision (~19% with 4 per octave)
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, doc, label=None, lowest=1e-5, octaves=24,
+                 per_octave=4):
+        super(Histogram, self).__init__(name, doc, label)
+        self.lowest = lowest
+        self.per_octave = per_octave
+        self.bounds = [lowest * 2 ** (k / per_octave)
+                       for k in range(octaves * per_octave + 1)]
+
+    def index(self, secs):
+        if secs <= self.lowest:
+            return 0
+        k = int(math.ceil(self.per_octave * math.log2(secs / self.lowest)))
+        return min(k, len(self.bounds))
+
+    def observe(self, secs, label=None):
+        idx = self.index(secs)
+        with self.lock:
+            hist = self.values.get(label)
+            if hist is None:
+                # Bucket counts (+Inf last), sum
+                hist = self.values[label] = [[0] * (len(self.bounds) + 1), 0.0]
+            hist[0][idx] += 1
+            hist[1] += secs
+
+    def count(self, label=None):
+        hist = self.values.get(label)
+        return sum(hist[0]) if hist else 0
+
+    def percentile(self, pct, label=None):
+        """ Upper bound of the bucket holding the percentile
+        """
+        hist = self.values.get(label)
+        if not hist:
+            return 0.0
+        counts = list(hist[0])
+        rank = pct / 100.0 * sum(counts)
+        acc = 0
+        for idx, n in enumerate(counts):
+            acc += n
+            if acc >= rank and n:
+                return self.bounds[min(idx, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+    def samples(self):
+        for label, (counts, total) in sorted(list(self.values.items()),
+                                             key=lambda kv: str(kv[0])):
+            acc = 0
+            for bound, n in zip(self.bounds + [float('inf')], counts):
+                acc += n
+                # Only non empty buckets and +Inf, keeps output small
+                if n or bound == float('inf'):
+                    le = '+Inf' if bound == float('inf') else '{:.6g}'.format(bound)
+                    yield (self.name + '_bucket',
+                           self.labels(label, 'le="{}"'.format(le)), acc)
+            yield self.name + '_sum', self.labels(label), total
+            yield self.name + '_count', self.labels(label), acc
+
+
+class Registry(object):
+    """ Named metrics of the process
+    """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, doc, label=None):
+        return self.add(Counter(name, doc, label))
+
+    def gauge(self, name, doc, label=None, fn=None):
+        gauge = self.add(Gauge(name, doc, label))
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, doc, label=None):
+        return self.add(Histogram(name, doc, label))
+
+    def render(self):
+        """ Prometheus text exposition format
+        """
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append('# HELP {} {}'.format(name, metric.doc))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for sname, labels, val in metric.samples():
+                lines.append('{}{} {}'.format(sname, labels, val))
+        return '\n'.join(lines) + '\n'
+
+
+# Process registry
+REGISTRY = Registry()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, registry=REGISTRY):
+    """ Serve `registry` at http://0.0.0.0:<port>/metrics
+        from a daemon thread
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = _ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on port {}".format(port))
+    return server
+
+
+class StatsDumper(object):
+    """ Logs rates of the given counters and p50/p99 of the
+        histograms every `secs` seconds from a daemon thread
+    """
+
+    def __init__(self, secs, registry=REGISTRY):
+        self.secs = secs
+        self.registry = registry
+        self.last = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='metrics-dump')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        last_t = time.time()
+        while not self.stopped.wait(self.secs):
+            now = time.time()
+            logger.info(self.summary(now - last_t))
+            last_t = now
+
+    def summary(self, elapsed):
+        parts = []
+        for name, metric in sorted(self.registry.metrics.items()):
+            if metric.kind == 'gauge':
+                list(metric.samples())
+            for label, val in sorted(list(metric.values.items()),
+                                     key=lambda kv: str(kv[0])):
+                key = name if label is None else '{}[{}]'.format(name, label)
+                if metric.kind == 'counter':
+                    rate = (val - self.last.get(key, 0)) / max(elapsed, 1e-9)
+                    self.last[key] = val
+                    parts.append('{} {:.1f}/s'.format(key, rate))
+                elif metric.kind == 'histogram':
+                    parts.append('{} p50 {:.2f}ms p99 {:.2f}ms'.format(
+                        key, metric.percentile(50, label) * 1000,
+                        metric.percentile(99, label) * 1000))
+                else:
+                    parts.append('{} {}'.format(key, val))
+        return 'Metrics: ' + ', '.join(parts)
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,183 @@
+"""
+Asynchronous RabbitMQ publisher: messages are buffered and published
+in batches from a background thread that owns its own connection,
+with publisher confirms enabled: every batch is published at once and
+its confirms are awaited once.
+"""
+import json
+import threading
+import time
+from queue import Queue, Empty
+import pika
+from ByHelpers import applogger
+
+logger = applogger.get_logger()
+
+# Buffer sentinel to stop the publishing thread
+_STOP = object()
+
+
+class AsyncPublisher(object):
+    """ Buffered publisher of a queue. `send` only blocks
+        (backpressure) when the buffer holds `limit` messages.
+    """
+
+    def __init__(self, queue, limit=10000, batch=500, confirm_secs=30):
+        self.queue = queue
+        self.batch = batch
+        self.confirm_secs = confirm_secs
+        self.tag = 0
+        self.pending, self.nacked = {}, {}
+        self.buffer = Queue(maxsize=limit)
+        self.published = 0
+        self.failed = 0
+        self.properties = pika.BasicProperties(
+            app_id="byprice",
+            content_type='application/json',
+            delivery_mode=2
+        )
+        self.thread = threading.Thread(
+            target=self.run,
+            name='publisher-{}'.format(queue)
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, message):
+        """ Buffer a message to be published
+        """
+        self.buffer.put(message)
+
+    def new_engine(self):
+        """ Blocking engine of the queue, only used from
+            the publishing thread
+        """
+        # Imported here: the module opens connections on import
+        from ByHelpers.rabbit_engine import RabbitEngine
+        return RabbitEngine(config={
+            'queue': self.queue,
+            'routing_key': self.queue
+        }, blocking=True)
+
+    def connect(self):
+        """ New engine with publisher confirms tracked by delivery
+            tag on the underlying channel (the blocking channel
+            waits for the confirm of every publish)
+        """
+        engine = self.new_engine()
+        self.tag = 0
+        self.pending, self.nacked = {}, {}
+        engine._channel._impl.confirm_delivery(self.on_confirm, nowait=True)
+        return engine
+
+    def disconnect(self, engine):
+        """ Close a failed engine before reconnecting
+        """
+        if engine is None:
+            return
+        try:
+            engine._connection.close()
+        except Exception as e:
+            logger.debug("Could not close publisher connection: {}".format(e))
+
+    def on_confirm(self, frame):
+        """ Broker ack/nack of a delivery tag, or of every
+            pending one up to it when `multiple` is set
+        """
+        method = frame.method
+        if method.multiple:
+            tags = [t for t in self.pending if t <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        for t in tags:
+            msg = self.pending.pop(t, None)
+            if msg is None:
+                continue
+            if acked:
+                self.published += 1
+            else:
+                self.nacked[t] = msg
+
+    def run(self):
+        """ Publishing thread loop: waits for a message and
+            publishes it with every other buffered one
+        """
+        engine = None
+        stop = False
+        while not stop:
+            msgs = [self.buffer.get()]
+            while len(msgs) < self.batch:
+                try:
+                    msgs.append(self.buffer.get_nowait())
+                except Empty:
+                    break
+            if _STOP in msgs:
+                stop = True
+                msgs = [m for m in msgs if m is not _STOP]
+            engine = self.publish(engine, msgs)
+        self.disconnect(engine)
+        logger.info("Publisher {} stopped: {} published, {} failed"
+                    .format(self.queue, self.published, self.failed))
+
+    def publish_batch(self, engine, msgs):
+        """ Publish every message and then wait once for their
+            confirms, returns the unconfirmed ones in order and
+            the error that stopped the batch, if any
+        """
+        sent, error = 0, None
+        try:
+            for msg in msgs:
+                engine._channel._impl.basic_publish(
+                    exchange=engine.EXCHANGE,
+                    routing_key=engine.ROUTING_KEY,
+                    body=json.dumps(msg, ensure_ascii=False),
+                    properties=self.properties
+                )
+                self.tag += 1
+                self.pending[self.tag] = msg
+                sent += 1
+            deadline = time.time() + self.confirm_secs
+            while self.pending and time.time() < deadline:
+                engine._connection.process_data_events(time_limit=1)
+            if self.pending:
+                error = Exception("Confirms timed out")
+        except Exception as e:
+            error = e
+        unconfirmed = sorted(list(self.pending.items())
+                             + list(self.nacked.items()))
+        self.pending, self.nacked = {}, {}
+        return [m for _, m in unconfirmed] + msgs[sent:], error
+
+    def publish(self, engine, msgs):
+        """ Publish a batch waiting once for the broker confirms,
+            the unconfirmed messages are retried once on a new
+            connection (the failed one is closed)
+        """
+        if not msgs:
+            return engine
+        for attempt in range(2):
+            if engine is None:
+                try:
+                    engine = self.connect()
+                except Exception as e:
+                    logger.warning("Could not connect to {}".format(self.queue))
+                    logger.error(e)
+                    continue
+            msgs, error = self.publish_batch(engine, msgs)
+            if not msgs:
+                return engine
+            logger.warning("Could not publish {} messages to {}"
+                           .format(len(msgs), self.queue))
+            if error is not None:
+                logger.error(error)
+            self.disconnect(engine)
+            engine = None
+        self.failed += len(msgs)
+        return engine
+
+    def close(self, timeout=30):
+        """ Publish what is buffered and stop the thread
+        """
+        self.buffer.put(_STOP)
+        self.thread.join(timeout)
@@ -1,13 +1,56 @@
+import re
 import sys
-from cassandra.cluster import Cluster
-from cassandra import ConsistencyLevel
+import time
+import queue
+import threading
+from collections import OrderedDict
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy, \
+    ConstantSpeculativeExecutionPolicy
+from cassandra import ConsistencyLevel, InvalidRequest
+from cassandra.protocol import SyntaxException
 from cassandra.query import SimpleStatement, PreparedStatement, bind_params
 from cassandra.auth import PlainTextAuthProvider
-from cassandra.concurrent import execute_concurrent_with_args
+from cassandra.concurrent import execute_concurrent_with_args, execute_concurrent
+from app.utils.columnar import Columns, page_factory
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Driver (`%s`, `%(name)s`) placeholders to bind markers
+_NAMED = re.compile(r'%\((\w+)\)s')
+
+
+def to_markers(qry):
+    """ CQL with driver placeholders as prepared bind markers
+    """
+    return _NAMED.sub(r':\1', qry).replace('%s', '?').replace('%%', '%')
+
+
+# Execution profiles by name, `None` values take the
+# session consistency level or the driver defaults
+PROFILES = {
+    # Default profile
+    EXEC_PROFILE_DEFAULT: {},
+    # Latency sensitive single partition reads, a second
+    # replica is tried when the first one takes over 50 ms
+    'fast_read': {
+        'consistency': 'LOCAL_ONE',
+        'timeout': 5,
+        'fetch_size': 5000,
+        'speculative': (0.05, 2),
+    },
+    # Large partition scans (stats, dumps, backups)
+    'bulk_scan': {
+        'timeout': 200,
+        'fetch_size': 10000,
+    },
+    # Price writes
+    'write': {
+        'timeout': 10,
+    },
+}
+
 
 class SimpleCassandra(object):
 
@@ -17,6 +60,17 @@ class SimpleCassandra(object):
 
         # Kwargs
         self.autocommit = kwargs.get('autocommit', False)
+        # LRU of (prepared statement, table metadata) by CQL text
+        self._prepared = OrderedDict()
+        self._prepared_size = kwargs.get('prepared_size', 512)
+        # Seconds a query rejected by the server runs unprepared
+        # before preparing it again (i.e. a table not created yet)
+        self._prepared_retry = kwargs.get('prepared_retry', 60)
+        self._prepared_lock = threading.Lock()
+        # Requests in flight of `execute_adaptive`, shared by
+        # the calls of every thread (each with its own Condition)
+        self.inflight = 0
+        self._inflight_lock = threading.Lock()
         if not self.config:
             raise Exception("Configuration variables missing",'Missing vars in config')
 
@@ -27,6 +81,7 @@ class SimpleCassandra(object):
             "PORT" : "9042" if "PORT" not in config else config['PORT'],
             "TIMEOUT" : 30 if "TIMEOUT" not in config else config['TIMEOUT'],
             "CONSISTENCY_LEVEL" : "QUORUM" if "CONSISTENCY_LEVEL" not in config else config['CONSISTENCY_LEVEL'],
+            "LOCAL_DC" : config.get('LOCAL_DC') or None,
         }     
         # Auth
         if 'USER' in config and 'PASSWORD' in config:
@@ -36,19 +91,27 @@ class SimpleCassandra(object):
                     password=config['PASSWORD']
                 )   
 
+        # Execution profiles
+        self.profiles = {}
+        for name, opts in PROFILES.items():
+            self.profiles[name] = dict(opts, **kwargs.get('profiles', {}).get(name, {}))
+        for name, opts in kwargs.get('profiles', {}).items():
+            self.profiles.setdefault(name, dict(opts))
         # Cluster
         if auth_provider:
             self.cluster = Cluster(
                 self.config['CONTACT_POINTS'],
                 port=self.config['PORT'],
                 connect_timeout=60,
-                auth_provider=auth_provider
+                auth_provider=auth_provider,
+                execution_profiles=self.execution_profiles()
             )
         else:
             self.cluster = Cluster(
                 self.config['CONTACT_POINTS'],
                 port=self.config['PORT'],
-                connect_timeout=60
+                connect_timeout=60,
+                execution_profiles=self.execution_profiles()
             )
         # Set session
         try:
@@ -70,65 +133,405 @@ class SimpleCassandra(object):
         if not hasattr(self,'session'):
             return None
         self.session.set_keyspace(self.config['KEYSPACE'])
-        cl = ConsistencyLevel.ONE
-        # Consistency level
-        if self.config['CONSISTENCY_LEVEL'] == 'LOCAL_ONE':
-            cl = ConsistencyLevel.LOCAL_ONE
-        if self.config['CONSISTENCY_LEVEL'] == 'ONE':
-            cl = ConsistencyLevel.ONE
-        elif self.config['CONSISTENCY_LEVEL'] == 'QUORUM':
-            cl = ConsistencyLevel.QUORUM
-        elif self.config['CONSISTENCY_LEVEL'] == 'ALL':
-            cl = ConsistencyLevel.ALL
-        self.session.default_consistency_level = cl  
         return self.session
 
 
+    def consistency_level(self, name=None):
+        """ Driver consistency level by name (default the
+            configured one)
+        """
+        return getattr(ConsistencyLevel,
+                       name or self.config['CONSISTENCY_LEVEL'],
+                       ConsistencyLevel.ONE)
+
+
+    def execution_profiles(self):
+        """ Driver execution profiles: token aware routing over
+            DC aware round robin, per profile consistency, timeout
+            and speculative execution of idempotent statements
+        """
+        profiles = {}
+        for name, opts in self.profiles.items():
+            kw = {
+                'load_balancing_policy': TokenAwarePolicy(
+                    DCAwareRoundRobinPolicy(local_dc=self.config['LOCAL_DC'])),
+                'consistency_level': self.consistency_level(opts.get('consistency')),
+            }
+            if opts.get('timeout'):
+                kw['request_timeout'] = opts['timeout']
+            if opts.get('speculative'):
+                delay, attempts = opts['speculative']
+                kw['speculative_execution_policy'] = \
+                    ConstantSpeculativeExecutionPolicy(delay, attempts)
+            profiles[name] = ExecutionProfile(**kw)
+            # Twin returning plain row tuples for columnar reads
+            kw['load_balancing_policy'] = TokenAwarePolicy(
+                DCAwareRoundRobinPolicy(local_dc=self.config['LOCAL_DC']))
+            profiles[self.columnar_profile(name)] = \
+                ExecutionProfile(row_factory=page_factory, **kw)
+        return profiles
+
+
+    @staticmethod
+    def columnar_profile(profile):
+        """ Name of the columnar twin of an execution profile
+        """
+        if profile is None or profile is EXEC_PROFILE_DEFAULT:
+            return 'columnar'
+        return '{}:columnar'.format(profile)
+
+
+    def set_timeout(self, seconds, profile=EXEC_PROFILE_DEFAULT):
+        """ Change the request timeout of an execution profile
+            (and of its columnar twin)
+        """
+        profiles = self.cluster.profile_manager.profiles
+        profiles[profile].request_timeout = seconds
+        profiles[self.columnar_profile(profile)].request_timeout = seconds
+
+
+    def options(self, statement, profile, timeout):
+        """ Driver `execute` kwargs of a profile, reads under a
+            speculative profile are marked idempotent
+        """
+        kw = {}
+        if profile is not None:
+            kw['execution_profile'] = profile
+            if self.profiles.get(profile, {}).get('speculative') \
+                    and not isinstance(statement, str):
+                statement.is_idempotent = True
+        if timeout is not None:
+            kw['timeout'] = timeout
+        return kw
+
+
     def close(self):
         self.cluster.shutdown()
 
 
-    def execute(self, qry, args=(), timeout=200):
-        """ Cassandra simple execute statement
+    def execute(self, qry, args=(), timeout=None, profile=None):
+        """ Cassandra simple execute statement, parametrized
+            queries run as bound prepared statements
+            - profile <str>: execution profile name (`PROFILES`)
+            - timeout <float>: seconds, 200 or the profile timeout
         """
-        result = self.session.execute(qry, args, timeout=timeout)
+        if timeout is None and profile is None:
+            timeout = 200
+        bound = self.bind(qry, args)
+        if bound is not None:
+            return self.session.execute(
+                bound, **self.options(bound, profile, timeout))
+        if profile is not None and isinstance(qry, str):
+            qry = SimpleStatement(qry)
+        result = self.session.execute(
+            qry, args, **self.options(qry, profile, timeout))
         return result
 
 
-    def query(self, qry, params=(), size=5000, timeout=30, consistency=None):
+    def table_meta(self, stmt):
+        """ Metadata of the table a prepared statement
+            reads/writes, replaced by the driver on schema change
+        """
+        cols = stmt.column_metadata or stmt.result_metadata
+        if not cols:
+            return None
+        ks = self.cluster.metadata.keyspaces.get(cols[0][0])
+        return ks.tables.get(cols[0][1]) if ks else None
+
+
+    def prepare(self, qry):
+        """ Prepare a statement once per session and reuse it
+            on following calls with the same CQL text (LRU of
+            `prepared_size`), statements of an altered table are
+            prepared again. `%s`/`%(name)s` placeholders are
+            turned into bind markers.
+
+            Returns None when the server rejects the query (cached
+            for `prepared_retry` secs), other errors (timeouts, no
+            hosts) are raised and the next call tries again
+        """
+        with self._prepared_lock:
+            entry = self._prepared.get(qry)
+            if entry is not None:
+                self._prepared.move_to_end(qry)
+        if entry is not None:
+            stmt, meta = entry
+            if stmt is None:
+                # `meta` holds when the rejection expires
+                if meta > time.time():
+                    return None
+            elif meta is None or self.table_meta(stmt) is meta:
+                return stmt
+            else:
+                logger.info("Schema changed, preparing statement again")
+        try:
+            stmt = self.session.prepare(to_markers(qry))
+            meta = self.table_meta(stmt)
+        except (InvalidRequest, SyntaxException) as e:
+            # Cache the rejection, it runs unprepared
+            logger.debug("Could not prepare statement: {}".format(e))
+            stmt, meta = None, time.time() + self._prepared_retry
+        with self._prepared_lock:
+            self._prepared[qry] = (stmt, meta)
+            self._prepared.move_to_end(qry)
+            while len(self._prepared) > self._prepared_size:
+                self._prepared.popitem(last=False)
+        return stmt
+
+
+    def invalidate(self, qry=None):
+        """ Drop a prepared statement (all of them by default)
+        """
+        with self._prepared_lock:
+            if qry is None:
+                self._prepared.clear()
+            else:
+                self._prepared.pop(qry, None)
+
+
+    def bind(self, qry, params):
+        """ Bound prepared statement of a parametrized query, None
+            when it should run as a simple statement (no params,
+            not a CQL string or values that can not be bound)
+        """
+        if not params or not isinstance(qry, str):
+            return None
+        stmt = self.prepare(qry)
+        if stmt is None:
+            return None
+        try:
+            return stmt.bind(params)
+        except Exception as e:
+            logger.debug("Could not bind params: {}".format(e))
+            return None
+
+
+    def statement(self, qry, params=(), size=None, consistency=None,
+                  profile=None):
+        """ Paged statement and params of a query: bound prepared
+            statement when possible, simple statement otherwise
+        """
+        if size is None:
+            size = self.profiles.get(profile, {}).get('fetch_size') or 5000
+        statement = self.bind(qry, params)
+        if statement is not None:
+            statement.fetch_size = size
+            params = None
+        else:
+            statement = SimpleStatement(qry, fetch_size=size)
+        if consistency:
+            statement.consistency_level = consistency
+        return statement, params
+
+
+    def query(self, qry, params=(), size=None, timeout=None, consistency=None,
+              profile=None):
         """ Cassandra query with pagination
             @Params:
                 - qry {str}: cassandra query
-                - size {int}: size of the query batch
+                - size {int}: size of the query batch (5000 or the profile fetch size)
+                - timeout {float}: seconds (30 or the profile timeout)
+                - consistency {ConsistencyLevel}: overrides the profile one
+                - profile {str}: execution profile name (`PROFILES`)
         """
         result = []
-        consistency = consistency if consistency else self.session.default_consistency_level
-        statement = SimpleStatement(
-            qry, 
-            fetch_size=size,
-            consistency_level=consistency
-        )
-        for row in self.session.execute(statement, params, timeout=timeout):
+        if timeout is None and profile is None:
+            timeout = 30
+        statement, params = self.statement(qry, params, size, consistency,
+                                           profile)
+        for row in self.session.execute(
+                statement, params, **self.options(statement, profile, timeout)):
             result.append(row)
         return result
 
 
+    def iter_query(self, qry, params=(), size=None, timeout=None,
+                   consistency=None, profile=None, pages=False):
+        """ Cassandra query as a generator of rows (or of page
+            lists with `pages`), the next page is fetched while the
+            current one is consumed so at most two pages are held
+            in memory. Same params as `query`.
+        """
+        if timeout is None and profile is None:
+            timeout = 30
+        statement, params = self.statement(qry, params, size, consistency,
+                                           profile)
+        future = self.session.execute_async(
+            statement, params, **self.options(statement, profile, timeout))
+        for page in PagedHandler(future):
+            if pages:
+                yield page
+            else:
+                for row in page:
+                    yield row
+
+
+    def query_columns(self, qry, params=(), size=None, timeout=None,
+                      consistency=None, profile=None, columns=None):
+        """ Cassandra query read into typed column buffers, pages
+            arrive as plain tuples and are converted one at a time,
+            no row objects are kept. Same params as `query`, plus:
+                - columns {Columns}: buffer to append to (i.e. to
+                  merge several queries), a new one by default
+
+            Returns the `Columns`, read with `.frame()` or `.arrays()`,
+            raises the query error with none of its rows appended
+        """
+        if columns is None:
+            columns = Columns()
+        if timeout is None and profile is None:
+            timeout = 30
+        statement, params = self.statement(qry, params, size, consistency,
+                                           profile)
+        kw = self.options(statement, profile, timeout)
+        kw['execution_profile'] = self.columnar_profile(profile)
+        future = self.session.execute_async(statement, params, **kw)
+        rows = len(columns)
+        try:
+            for page in PagedHandler(future):
+                columns.add_page(page)
+        except Exception:
+            # Pages before a failed one are not a partial result
+            columns.truncate(rows)
+            raise
+        return columns
+
+
+    def query_paged(self, qry, params=(), on_page=None, size=None,
+                    timeout=None, consistency=None, profile=None):
+        """ Callback variant of `iter_query`: `on_page(rows)` is called
+            from the driver thread for every page, the next page is
+            requested once it returns. Same params as `query`.
+
+            Returns the `PagedHandler`, `wait()` blocks until the
+            last page and raises the query error if any
+        """
+        if timeout is None and profile is None:
+            timeout = 30
+        statement, params = self.statement(qry, params, size, consistency,
+                                           profile)
+        future = self.session.execute_async(
+            statement, params, **self.options(statement, profile, timeout))
+        return PagedHandler(future, on_page)
+
+
 
     def query_concurrent(self, query, params):
         """ Execute query concurrently
             - query <str>: (WHERE = ?)
         """
-        statement = self.session.prepare(query)
+        statement = self.prepare(query)
+        if statement is None:
+            raise Exception("Could not prepare query", query)
         result = list(execute_concurrent_with_args(self.session, statement, params))
         return result
 
 
 
+    def execute_concurrent(self, statements_and_params, concurrency=100):
+        """ Execute statements with `execute_async` keeping at most
+            `concurrency` requests in flight, blocks until all of them
+            are confirmed.
+            - statements_and_params <iterable>: (statement, params) pairs
+
+            Returns list of (success, result_or_exc) in input order
+        """
+        return execute_concurrent(
+            self.session,
+            statements_and_params,
+            concurrency=concurrency,
+            raise_on_first_error=False
+        )
+
+
+
+    def execute_adaptive(self, statements, controller, on_done=None,
+                         profile=None):
+        """ Execute statements with `execute_async` keeping at most
+            `controller.limit` requests in flight, the window is read
+            again on every completion and each latency/error fed back.
+            - statements <list>: bound statements
+            - controller <AdaptiveConcurrency>: writes window
+            - on_done <callable>: called with (index, latency, error)
+            - profile <str>: execution profile name (`PROFILES`)
+
+            Returns list of (success, result_or_exc) in input order
+        """
+        results = [None] * len(statements)
+        cond = threading.Condition()
+        state = {'next': 0, 'inflight': 0, 'done': 0}
+
+        def finish(idx, start, success, res):
+            with cond:
+                results[idx] = (success, res)
+                state['inflight'] -= 1
+                state['done'] += 1
+                with self._inflight_lock:
+                    self.inflight -= 1
+                latency = time.time() - start
+                controller.record(latency, None if success else res)
+                if on_done is not None:
+                    on_done(idx, latency, None if success else res)
+                cond.notify()
+
+        with cond:
+            while state['done'] < len(statements):
+                while state['next'] < len(statements) \
+                        and state['inflight'] < max(controller.limit, 1):
+                    idx = state['next']
+                    state['next'] += 1
+                    state['inflight'] += 1
+                    with self._inflight_lock:
+                        self.inflight += 1
+                    start = time.time()
+                    try:
+                        future = self.session.execute_async(
+                            statements[idx], **self.options(statements[idx], profile, None))
+                    except Exception as e:
+                        finish(idx, start, False, e)
+                        continue
+                    future.add_callbacks(
+                        callback=lambda res, i=idx, t=start: finish(i, t, True, res),
+                        errback=lambda exc, i=idx, t=start: finish(i, t, False, exc)
+                    )
+                if state['done'] < len(statements):
+                    cond.wait()
+        return results
+
+
+
+    def fan_out(self, qry, keys, concurrency=50, timeout=None, profile=None,
+                columnar=False):
+        """ Run a partition query once per key tuple keeping at most
+            `concurrency` partitions in flight
+            - qry <str|PreparedStatement>: query of one partition
+            - keys <iterable>: bind values of each partition
+            - timeout <float>: seconds (30 or the profile timeout)
+            - profile <str>: execution profile name (`PROFILES`)
+            - columnar <bool>: pages as row tuples for `FanOut.columns`
+
+            Returns a `FanOut`, iterated as (key, rows) in completion
+            order, failed partitions end up in `FanOut.errors`
+        """
+        statement = self.prepare(qry) if isinstance(qry, str) else qry
+        if statement is None:
+            raise Exception("Could not prepare query", qry)
+        if timeout is None and profile is None:
+            timeout = 30
+        kw = self.options(statement, profile, timeout)
+        if columnar:
+            kw['execution_profile'] = self.columnar_profile(profile)
+        return FanOut(self.session, statement, keys, concurrency, kw)
+
+
+
     def query_async(self, qry, args=(""), lst=[]):
         """ Execute async queries, best for large 
             volume of data queries
         """
-        prepared = self.session.prepare(qry)
+        prepared = self.prepare(qry)
+        if prepared is None:
+            raise Exception("Could not prepare query", qry)
         futures = []
         if len(args) > 0:
             for a in args:
@@ -153,29 +556,149 @@ class SimpleCassandra(object):
 
 
 class PagedHandler(object):
+    """ Pages of a `ResponseFuture`, either pushed to `on_page`
+        as they arrive or iterated, in which case the next page is
+        requested when the current one is handed out (one page of
+        prefetch)
+    """
+    # End of pages marker
+    _END = object()
 
-    def __init__(self, future):
+    def __init__(self, future, on_page=None):
         self.error = None
+        self.rows = 0
+        self.on_page = on_page
+        self.pages = queue.Queue()
+        self.finished_event = threading.Event()
         self.future = future
         self.future.add_callbacks(
             callback=self.handle_page,
-            errback=self.handle_err
+            errback=self.handle_error
         )
 
-    def finished_event(self):
-        #print("Finished event")
-        pass
-
     def handle_page(self, rows):
-        for row in rows:
-            #print(row)
-            pass
-
+        if not isinstance(rows, list):
+            rows = list(rows or [])
+        self.rows += len(rows)
+        if self.on_page is None:
+            # Read before the page is handed out and the next one requested
+            more = self.future.has_more_pages
+            self.pages.put(rows)
+            if not more:
+                self.pages.put(self._END)
+                self.finished_event.set()
+            return
+        try:
+            self.on_page(rows)
+        except Exception as e:
+            self.handle_error(e)
+            return
         if self.future.has_more_pages:
             self.future.start_fetching_next_page()
         else:
-            self.finished_event()
+            self.finished_event.set()
 
     def handle_error(self, exc):
         self.error = exc
-        self.finished_event.set()
\ No newline at end of file
+        self.pages.put(self._END)
+        self.finished_event.set()
+
+    def wait(self, timeout=None):
+        """ Wait for the last page, raises the query error
+        """
+        if not self.finished_event.wait(timeout):
+            raise TimeoutError("Paged query not finished")
+        if self.error is not None:
+            raise self.error
+        return self.rows
+
+    def __iter__(self):
+        while True:
+            page = self.pages.get()
+            if page is self._END:
+                break
+            # Prefetch the next page while this one is consumed
+            if self.future.has_more_pages:
+                self.future.start_fetching_next_page()
+            yield page
+        if self.error is not None:
+            raise self.error
+
+
+
+class FanOut(object):
+    """ Bounded concurrency reads of many partitions with the
+        same prepared statement, iterated as (key, rows) while
+        they complete. Errors by key are kept in `errors`.
+    """
+
+    def __init__(self, session, statement, keys, concurrency=50, options=None):
+        self.session = session
+        self.statement = statement
+        self.pending = iter(keys)
+        self.concurrency = max(concurrency, 1)
+        self.options = options or {}
+        self.errors = OrderedDict()
+        self.done = queue.Queue()
+        self.inflight = 0
+
+    def start(self, key):
+        """ Send the query of a partition, its pages are
+            fetched from the driver callbacks
+        """
+        pages = []
+        try:
+            future = self.session.execute_async(
+                self.statement.bind(key), **self.options)
+        except Exception as e:
+            self.done.put((key, None, e))
+            return
+
+        def on_page(rows):
+            pages.append(rows)
+            if future.has_more_pages:
+                future.start_fetching_next_page()
+            else:
+                self.done.put((key, pages, None))
+
+        future.add_callbacks(
+            callback=on_page,
+            errback=lambda exc: self.done.put((key, None, exc))
+        )
+
+    def fill(self):
+        """ Start partitions until the window is full
+        """
+        while self.inflight < self.concurrency:
+            key = next(self.pending, None)
+            if key is None:
+                return
+            self.inflight += 1
+            self.start(key)
+
+    def pages(self):
+        """ (key, list of pages) of every partition as they complete
+        """
+        self.fill()
+        while self.inflight:
+            key, pages, error = self.done.get()
+            self.inflight -= 1
+            self.fill()
+            if error is not None:
+                self.errors[key] = error
+                continue
+            yield key, pages
+
+    def __iter__(self):
+        for key, pages in self.pages():
+            yield key, [row for page in pages for row in page]
+
+    def columns(self, columns=None):
+        """ Rows of all partitions merged into `Columns`
+        """
+        if columns is None:
+            columns = Columns()
+        for _, pages in self.pages():
+            for page in pages:
+                columns.add_page(page)
+        return columns
@@ -0,0 +1,129 @@
+"""
+Grid spatial index of store coordinates: points are bucketed in
+`cell_deg` degree cells, radius and nearest queries only compute
+(float32 haversine) distances for the points of the cells that
+overlap the query bounding box.
+"""
+import math
+import numpy as np
+
+EARTH_KM = 6371.0
+# Km per degree of latitude
+DEG_KM = 111.195
+
+
+def haversine_km(lat, lng, lats, lngs):
+    """ Great-circle distances (km, float32) from a point
+        to arrays of points, all in degrees
+    """
+    lat, lng = np.float32(math.radians(lat)), np.float32(math.radians(lng))
+    lats = np.radians(np.asarray(lats, dtype=np.float32))
+    lngs = np.radians(np.asarray(lngs, dtype=np.float32))
+    a = np.sin((lats - lat) / 2) ** 2 \
+        + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return np.float32(2 * EARTH_KM) * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class StoreIndex(object):
+    """ Radius and k-nearest queries over store coordinates
+
+        Params:
+        -----
+        lat, lng : array-like
+            Coordinates in degrees (NaN: not indexed)
+        keys : array-like
+            Value returned for each point (i.e. store uuids),
+            positions by default
+        sources : array-like
+            Retailer of each point, for retailer filters
+        cell_deg : float
+            Grid cell size in degrees (0.1 ~ 11 km)
+    """
+
+    def __init__(self, lat, lng, keys=None, sources=None, cell_deg=0.1):
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.keys = np.arange(len(self.lat)) if keys is None \
+            else np.asarray(keys, dtype=object)
+        self.sources = None if sources is None \
+            else np.asarray(sources, dtype=object)
+        self.cell_deg = cell_deg
+        self.cells = {}
+        valid = np.flatnonzero(np.isfinite(self.lat) & np.isfinite(self.lng))
+        ci = np.floor(self.lat[valid] / cell_deg).astype(np.int64)
+        cj = np.floor(self.lng[valid] / cell_deg).astype(np.int64)
+        order = np.lexsort((cj, ci))
+        ci, cj, valid = ci[order], cj[order], valid[order]
+        # Contiguous runs of points of the same cell
+        bounds = np.flatnonzero((np.diff(ci) != 0) | (np.diff(cj) != 0)) + 1
+        for run in np.split(np.arange(len(valid)), bounds):
+            if len(run):
+                self.cells[(int(ci[run[0]]), int(cj[run[0]]))] = valid[run]
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.valid)
+
+    def candidates(self, lat, lng, radius_km):
+        """ Positions of the points in the cells overlapping
+            the bounding box of a radius
+        """
+        dlat = radius_km / DEG_KM
+        coslat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+        dlng = radius_km / (DEG_KM * coslat) if coslat > 1e-6 else 360.0
+        if dlng >= 180.0:
+            # Around a pole or the whole globe, no useful box
+            return self.valid
+        i0, i1 = (int(math.floor((lat + s * dlat) / self.cell_deg)) for s in (-1, 1))
+        j0, j1 = (int(math.floor((lng + s * dlng) / self.cell_deg)) for s in (-1, 1))
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self.cells):
+            # Box larger than the populated grid, prefilter by box
+            lat_v, lng_v = self.lat[self.valid], self.lng[self.valid]
+            dl = np.abs((lng_v - lng + 180.0) % 360.0 - 180.0)
+            return self.valid[(np.abs(lat_v - lat) <= dlat) & (dl <= dlng)]
+        runs = []
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                # Cells past the antimeridian
+                j_wrap = (j + int(round(180 / self.cell_deg))) \
+                    % int(round(360 / self.cell_deg)) - int(round(180 / self.cell_deg))
+                run = self.cells.get((i, j_wrap))
+                if run is not None:
+                    runs.append(run)
+        return np.concatenate(runs) if runs else np.array([], dtype=np.int64)
+
+    def within(self, lat, lng, radius_km, retailer=None):
+        """ (positions, distances km) of the points within a
+            radius, sorted by distance
+        """
+        pos = self.candidates(lat, lng, radius_km)
+        if retailer is not None and self.sources is not None:
+            pos = pos[self.sources[pos] == retailer]
+        dist = haversine_km(lat, lng, self.lat[pos], self.lng[pos])
+        keep = dist <= radius_km
+        pos, dist = pos[keep], dist[keep]
+        order = np.argsort(dist, kind='mergesort')
+        return pos[order], dist[order]
+
+    def nearest(self, lat, lng, k=1, retailer=None):
+        """ (positions, distances km) of the `k` nearest points,
+            the search radius doubles until enough are found
+        """
+        radius = self.cell_deg * DEG_KM
+        while True:
+            pos, dist = self.within(lat, lng, radius, retailer)
+            if len(pos) >= k or radius > math.pi * EARTH_KM:
+                return pos[:k], dist[:k]
+            radius *= 2
+
+    def stores_within(self, lat, lng, radius_km, retailer=None):
+        """ [(key, distance km)] within a radius, nearest first
+        """
+        pos, dist = self.within(lat, lng, radius_km, retailer)
+        return list(zip(self.keys[pos].tolist(), dist.tolist()))
+
+    def k_nearest(self, lat, lng, k, retailer=None):
+        """ [(key, distance km)] of the `k` nearest points
+        """
+        pos, dist = self.nearest(lat, lng, k, retailer)
+        return list(zip(self.keys[pos].tolist(), dist.tolist()))
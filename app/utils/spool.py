@@ -0,0 +1,228 @@
+"""
+Write-ahead spool of the consumer: records that could not be written
+to Cassandra are appended to segmented local files (length + CRC32
+framed) and replayed in the background once the cluster recovers.
+
+Segments are claimed with `flock`, so several consumer processes can
+share a spool directory: the active segment of a process is locked by
+it and closed segments are replayed by whichever replayer claims them.
+"""
+import os
+import time
+import zlib
+import fcntl
+import pickle
+import struct
+import threading
+from ByHelpers import applogger
+
+logger = applogger.get_logger()
+
+# Record frame: payload length, payload CRC32
+HEADER = struct.Struct('>II')
+SUFFIX = '.spool'
+
+
+class Spool(object):
+    """ Segmented append-only spool of picklable records
+
+        Params:
+        -----
+        path : str
+            Spool directory
+        segment_mb : int
+            Size at which the active segment is rotated
+    """
+
+    def __init__(self, path, segment_mb=64):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.segment_bytes = segment_mb * 1024 * 1024
+        self.lock = threading.RLock()
+        self.active = None
+        self.seq = 0
+        self.spooled = 0
+
+    def open_segment(self):
+        """ New active segment, locked by this process
+        """
+        self.seq += 1
+        name = os.path.join(self.path, '{:013d}-{}-{:06d}{}'.format(
+            int(time.time() * 1000), os.getpid(), self.seq, SUFFIX))
+        f = open(name, 'ab')
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.active = f
+
+    def append(self, records):
+        """ Append records to the active segment
+
+            Params:
+            -----
+            records : list
+                Picklable records
+        """
+        with self.lock:
+            if self.active is None:
+                self.open_segment()
+            for rec in records:
+                payload = pickle.dumps(rec, protocol=pickle.HIGHEST_PROTOCOL)
+                self.active.write(
+                    HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+            self.active.flush()
+            self.spooled += len(records)
+            if self.active.tell() >= self.segment_bytes:
+                self.rotate()
+
+    def rotate(self):
+        """ Close the active segment (releasing its lock) so
+            it can be replayed
+        """
+        with self.lock:
+            if self.active is not None:
+                self.active.close()
+                self.active = None
+
+    @property
+    def pending(self):
+        """ Whether the active segment holds records (under the
+            lock, a writer may be rotating it)
+        """
+        with self.lock:
+            return self.active is not None and self.active.tell() > 0
+
+    def claim(self):
+        """ Oldest segment not locked by a writer or replayer
+
+            Returns:
+            -----
+            tuple
+                (path, locked file) or None
+        """
+        for name in sorted(os.listdir(self.path)):
+            if not name.endswith(SUFFIX):
+                continue
+            fpath = os.path.join(self.path, name)
+            try:
+                f = open(fpath, 'rb')
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                continue
+            # Removed by another replayer before we locked it
+            if not os.path.exists(fpath):
+                f.close()
+                continue
+            return fpath, f
+        return None
+
+    @staticmethod
+    def read(f):
+        """ Records of a segment, stops at a torn or corrupt record
+        """
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                if header:
+                    logger.warning("Torn record header in spool {}".format(f.name))
+                return
+            length, crc = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                logger.warning("Corrupt record in spool {}, skipping rest"
+                               .format(f.name))
+                return
+            yield pickle.loads(payload)
+
+    def close(self):
+        self.rotate()
+
+
+class SpoolReplayer(object):
+    """ Background thread draining spooled records back into
+        Cassandra at `rate` records/sec while `healthy()` holds
+
+        Params:
+        -----
+        spool : Spool
+            Spool to drain
+        write : callable
+            Writes a list of records, returns the failed ones
+        rate : int
+            Max. records per second
+        healthy : callable
+            Whether the cluster can take the replay load
+    """
+    # Records written per step
+    chunk = 100
+    # Seconds to wait after a failed replay
+    backoff = 5
+
+    def __init__(self, spool, write, rate=500, healthy=None):
+        self.spool = spool
+        self.write = write
+        self.rate = max(rate, 1)
+        self.healthy = healthy or (lambda: True)
+        self.replayed = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='spool-replayer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not self.healthy():
+                self.stopped.wait(1)
+                continue
+            seg = self.spool.claim()
+            if seg is None and self.spool.pending:
+                # Replay what this process spooled so far
+                self.spool.rotate()
+                seg = self.spool.claim()
+            if seg is None:
+                self.stopped.wait(1)
+                continue
+            if not self.replay(*seg):
+                self.stopped.wait(self.backoff)
+
+    def replay(self, fpath, f):
+        """ Replay a claimed segment and remove it, a failed
+            chunk releases it to be retried (writes are upserts)
+        """
+        try:
+            chunk = []
+            for rec in Spool.read(f):
+                chunk.append(rec)
+                if len(chunk) >= self.chunk:
+                    if not self.replay_chunk(chunk):
+                        return False
+                    chunk = []
+            if chunk and not self.replay_chunk(chunk):
+                return False
+            os.remove(fpath)
+            logger.info("Replayed spool segment {}".format(fpath))
+            return True
+        except Exception as e:
+            logger.error("Could not replay spool segment {}".format(fpath))
+            logger.error(e)
+            return False
+        finally:
+            f.close()
+
+    def replay_chunk(self, chunk):
+        start = time.time()
+        failed = self.write(chunk)
+        if failed:
+            logger.warning("{} spooled records failed, retrying later"
+                           .format(len(failed)))
+            return False
+        self.replayed += len(chunk)
+        # Throttle to the replay rate
+        self.stopped.wait(max(len(chunk) / self.rate - (time.time() - start), 0))
+        return not self.stopped.is_set()
+
+    def stop(self, timeout=10):
+        self.stopped.set()
+        self.thread.join(timeout)
@@ -0,0 +1,312 @@
+"""
+Process-wide cache of the Geolocation store lists by retailer, kept
+for `STORE_CACHE_TTL` seconds and refreshed in the background once
+stale. Snapshots are shared across workers through Redis and/or a
+local file, and every list carries contiguous lat/lng arrays for
+vectorised distance math.
+"""
+import os
+import json
+import time
+import threading
+import numpy as np
+from flask import g, has_app_context
+from ByHelpers import applogger
+from app.utils import http_session
+from app.utils.key_cache import _Call
+from app.utils.spatial import StoreIndex
+import config
+
+logger = applogger.get_logger()
+
+
+class StoreList(object):
+    """ Stores of a retailer as returned by Geolocation, with
+        uuid index and coordinate arrays
+    """
+    __slots__ = ('stores', 'fetched', 'index', 'uuids', 'lat', 'lng')
+
+    def __init__(self, stores, fetched=None):
+        self.stores = stores
+        self.fetched = fetched or time.time()
+        self.index = {str(s.get('uuid')): i for i, s in enumerate(stores)}
+        self.uuids = np.array([str(s.get('uuid')) for s in stores], dtype=object)
+        self.lat = np.ascontiguousarray(
+            [np.nan if s.get('lat') is None else s['lat'] for s in stores],
+            dtype=np.float64)
+        self.lng = np.ascontiguousarray(
+            [np.nan if s.get('lng') is None else s['lng'] for s in stores],
+            dtype=np.float64)
+
+    def age(self):
+        return time.time() - self.fetched
+
+    def dumps(self):
+        return json.dumps({'fetched': self.fetched, 'stores': self.stores})
+
+    @classmethod
+    def loads(cls, raw):
+        snap = json.loads(raw)
+        return cls(snap['stores'], snap['fetched'])
+
+
+class StoreDirectory(object):
+    """ Store lists by (retailer, active) and the retailers list
+
+        Params:
+        -----
+        ttl : int
+            Seconds a list is fresh (0: always fetched)
+        redis : redis.Redis
+            Snapshot sharing across workers
+        path : str
+            Directory of the local file snapshots
+        wait : float
+            Max seconds to wait for the fetch of another caller
+    """
+    redis_ttl = 60 * 60 * 24
+
+    def __init__(self, ttl=3600, redis=None, path='', wait=60):
+        self.ttl = ttl
+        self.redis = redis
+        self.path = path
+        self.wait = wait
+        self.lists = {}
+        self.refreshing = set()
+        # In-flight fetches of missing lists by key
+        self.calls = {}
+        # (list stamps, StoreIndex, stores) by (retailers, active)
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.base_url = "{}://{}".format(config.SRV_PROTOCOL,
+                                         config.SRV_GEOLOCATION)
+
+    @staticmethod
+    def key(retailer, active=None):
+        return '{}:{}'.format(retailer, active or '')
+
+    def snapshot_file(self, key):
+        return os.path.join(self.path, 'stores_{}.json'.format(key.replace(':', '_')))
+
+    def fetch(self, retailer, active=None):
+        """ Store list of a retailer from Geolocation, `None`
+            stands for the retailers list
+        """
+        if retailer is None:
+            url = self.base_url + "/retailer/all"
+        else:
+            url = self.base_url + "/store/retailer?key=" + retailer \
+                + ('&active={}'.format(active) if active else '')
+        r = http_session.get(url)
+        r.raise_for_status()
+        return StoreList(r.json())
+
+    def load_snapshot(self, key):
+        """ Freshest shared snapshot (Redis or file), if any
+        """
+        found = []
+        if self.redis is not None:
+            try:
+                raw = self.redis.get('geoprice:stores:' + key)
+                if raw:
+                    found.append(StoreList.loads(raw))
+            except Exception as e:
+                logger.warning("Could not read stores snapshot from redis")
+                logger.error(e)
+        if self.path and os.path.exists(self.snapshot_file(key)):
+            try:
+                with open(self.snapshot_file(key)) as f:
+                    found.append(StoreList.loads(f.read()))
+            except Exception as e:
+                logger.warning("Could not read stores snapshot file")
+                logger.error(e)
+        return max(found, key=lambda sl: sl.fetched) if found else None
+
+    def save_snapshot(self, key, stores):
+        raw = stores.dumps()
+        if self.redis is not None:
+            try:
+                self.redis.set('geoprice:stores:' + key, raw, ex=self.redis_ttl)
+            except Exception as e:
+                logger.warning("Could not write stores snapshot to redis")
+                logger.error(e)
+        if self.path:
+            try:
+                tmp = self.snapshot_file(key) + '.{}'.format(os.getpid())
+                with open(tmp, 'w') as f:
+                    f.write(raw)
+                os.replace(tmp, self.snapshot_file(key))
+            except Exception as e:
+                logger.warning("Could not write stores snapshot file")
+                logger.error(e)
+
+    def refresh(self, retailer, active=None):
+        """ Fetch a list again and share it
+        """
+        key = self.key(retailer, active)
+        try:
+            stores = self.fetch(retailer, active)
+            self.lists[key] = stores
+            self.save_snapshot(key, stores)
+            logger.debug("Refreshed {} stores of {}"
+                         .format(len(stores.stores), retailer or 'retailers'))
+            return stores
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def refresh_later(self, retailer, active=None):
+        """ Refresh a stale list from a daemon thread,
+            once at a time
+        """
+        key = self.key(retailer, active)
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def run():
+            try:
+                self.refresh(retailer, active)
+            except Exception as e:
+                logger.warning("Could not refresh {} stores".format(retailer))
+                logger.error(e)
+
+        thread = threading.Thread(target=run, name='stores-refresh')
+        thread.daemon = True
+        thread.start()
+
+    def refresh_once(self, retailer, active=None):
+        """ Fetch a missing list, concurrent callers wait for
+            the in-flight fetch (single-flight)
+        """
+        key = self.key(retailer, active)
+        with self.lock:
+            call = self.calls.get(key)
+            owner = call is None
+            if owner:
+                call = self.calls[key] = _Call()
+                self.refreshing.add(key)
+        if not owner:
+            if call.event.wait(self.wait) and call.ok:
+                return call.value
+            raise Exception("Could not fetch {} stores"
+                            .format(retailer or 'retailers'))
+        try:
+            call.value = self.refresh(retailer, active)
+            call.ok = True
+            return call.value
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.event.set()
+
+    def get(self, retailer, active=None):
+        """ `StoreList` of a retailer (retailers list for `None`),
+            stale lists are served while refreshed in background
+        """
+        if not self.ttl:
+            return self.fetch(retailer, active)
+        key = self.key(retailer, active)
+        stores = self.lists.get(key)
+        if stores is None or stores.age() > self.ttl:
+            shared = self.load_snapshot(key)
+            if shared is not None and (stores is None or shared.fetched > stores.fetched):
+                stores = self.lists[key] = shared
+        if stores is None:
+            return self.refresh_once(retailer, active)
+        if stores.age() > self.ttl:
+            self.refresh_later(retailer, active)
+        return stores
+
+    def retailers(self):
+        """ Retailers from Geolocation
+        """
+        return self.get(None).stores
+
+    def stores(self, retailer, active=None):
+        """ Stores of a retailer
+        """
+        return self.get(retailer, active).stores
+
+    def by_uuid(self, store_uuid, retailers=None, active='all'):
+        """ Store with a uuid among the given retailers (all
+            by default), None if not found
+        """
+        for retailer in retailers or [r['key'] for r in self.retailers()]:
+            stores = self.get(retailer, active)
+            idx = stores.index.get(str(store_uuid))
+            if idx is not None:
+                return stores.stores[idx]
+        return None
+
+    def coords(self, retailers, active='all', lists=None):
+        """ Store uuids, lat and lng arrays of the given retailers
+        """
+        lists = lists or [self.get(r, active) for r in retailers]
+        if len(lists) == 1:
+            return lists[0].uuids, lists[0].lat, lists[0].lng
+        return (np.concatenate([sl.uuids for sl in lists] or [np.array([], dtype=object)]),
+                np.concatenate([sl.lat for sl in lists] or [np.array([])]),
+                np.concatenate([sl.lng for sl in lists] or [np.array([])]))
+
+    def index(self, retailers=None, active='all'):
+        """ `StoreIndex` keyed by store uuid over the stores of
+            the given retailers (all by default) and the store
+            dicts by index position, built again once any of the
+            lists is refreshed
+        """
+        retailers = tuple(retailers or [r['key'] for r in self.retailers()])
+        lists = [self.get(r, active) for r in retailers]
+        stamp = tuple((id(sl), sl.fetched) for sl in lists)
+        cached = self.indexes.get((retailers, active))
+        if cached is not None and cached[0] == stamp:
+            return cached[1], cached[2]
+        uuids, lat, lng = self.coords(retailers, active, lists)
+        stores = [dict(st, source=r, store_uuid=str(st.get('uuid')))
+                  for r, sl in zip(retailers, lists) for st in sl.stores]
+        index = StoreIndex(lat, lng, keys=uuids,
+                           sources=[st['source'] for st in stores])
+        self.indexes[(retailers, active)] = (stamp, index, stores)
+        return index, stores
+
+    def stores_within(self, lat, lng, radius_km, retailers=None, active='all'):
+        """ Stores (copies with `source`, `store_uuid` and
+            `distance` km) within a radius, nearest first
+        """
+        index, stores = self.index(retailers, active)
+        pos, dist = index.within(lat, lng, radius_km)
+        return [dict(stores[p], distance=float(d)) for p, d in zip(pos, dist)]
+
+    def k_nearest(self, lat, lng, k, retailer=None, active='all'):
+        """ `k` nearest stores (of a retailer), same format
+            as `stores_within`
+        """
+        index, stores = self.index([retailer] if retailer else None, active)
+        pos, dist = index.nearest(lat, lng, k)
+        return [dict(stores[p], distance=float(d)) for p, d in zip(pos, dist)]
+
+
+# Directory of the process and the pid that created it
+_directory = None
+_directory_pid = None
+_lock = threading.Lock()
+
+
+def get_directory():
+    """ Store directory shared by the process, Redis snapshots
+        use the app context connection when enabled
+    """
+    global _directory, _directory_pid
+    pid = os.getpid()
+    if _directory is None or _directory_pid != pid:
+        with _lock:
+            if _directory is None or _directory_pid != pid:
+                redis = None
+                if config.STORE_CACHE_REDIS and has_app_context():
+                    redis = getattr(g, '_redis', None)
+                _directory = StoreDirectory(ttl=config.STORE_CACHE_TTL,
+                                            redis=redis,
+                                            path=config.STORE_CACHE_DIR)
+                _directory_pid = pid
+    return _directory
@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# Script to run catalogue snapshot in server
+cd /home/byprice/geoprice/
+# Env
+source /home/byprice/geoprice/.envvars
+source /home/byprice/geoprice/env/bin/activate
+
+# Run script
+echo "Running Create Catalogue Snapshot .."
+/home/byprice/geoprice/env/bin/flask script --name=create_catalogue_snapshot
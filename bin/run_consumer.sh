@@ -34,4 +34,4 @@ fi
 
 
 echo "[$(date)][$APP_NAME]: Starting with FLASK in $MODE mode..."
-pipenv run flask consumer
\ No newline at end of file
+pipenv run flask consumer "$@"
\ No newline at end of file
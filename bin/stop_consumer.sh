@@ -1,4 +1,10 @@
 #!/bin/bash
 
-# Stop Consumer Processes
+# Stop Consumer Processes, they drain on SIGTERM (the supervisor stops
+# restarting workers), whatever is left after the drain time is killed
+pkill -TERM -f "flask consumer"
+for i in $(seq 40); do
+    pgrep -f "flask consumer" > /dev/null || exit 0
+    sleep 1
+done
 kill -9 $(ps aux | grep flask | grep consum | awk '{print $2}')
\ No newline at end of file
@@ -41,6 +41,8 @@ CASSANDRA_KEYSPACE = os.getenv('CASSANDRA_KEYSPACE','prices')
 CASSANDRA_PORT = os.getenv('CASSANDRA_PORT', 9042)
 CASSANDRA_USER = os.getenv('CASSANDRA_USER','')
 CASSANDRA_PASSWORD = os.getenv('CASSANDRA_PASSWORD','')
+# Local datacenter of the load balancing policy (default: first contacted)
+CASSANDRA_LOCAL_DC = os.getenv('CASSANDRA_LOCAL_DC', '')
 CASSANDRA_TTL = int(os.getenv('CASSANDRA_TTL', 60*60*24*31*3)) # Default TTL : 3 months
 if int(CASSANDRA_TTL) < (60*60*24*10):
     raise Exception("TTL too short, minimum valid TTL is 2 weeks")
@@ -80,11 +82,61 @@ QUEUE_GEOPRICE = QUEUE_GEOPRICE + '_dev' \
 QUEUE_CACHE = QUEUE_CACHE + '_dev' \
     if ENV.upper() in ['DEV','LOCAL'] else QUEUE_CACHE
 
+# Consumer writes in flight per message (0: serial writes)
+CONSUMER_WRITE_CONCURRENCY = int(os.getenv('CONSUMER_WRITE_CONCURRENCY', 100))
+# Adapt writes in flight (up to CONSUMER_WRITE_CONCURRENCY) to C* latency
+CONSUMER_ADAPTIVE_WRITES = bool(int(os.getenv('CONSUMER_ADAPTIVE_WRITES', 1)))
+CONSUMER_WRITE_TARGET_MS = float(os.getenv('CONSUMER_WRITE_TARGET_MS', 50))
+# Max. size of a partition UNLOGGED batch (0: no batches)
+CONSUMER_BATCH_KB = int(os.getenv('CONSUMER_BATCH_KB', 40))
+# Unchanged prices are skipped for this many seconds (0: write all)
+CONSUMER_DEDUP_WINDOW = int(os.getenv('CONSUMER_DEDUP_WINDOW', 0))
+CONSUMER_DEDUP_SIZE = int(os.getenv('CONSUMER_DEDUP_SIZE', 500000))
+CONSUMER_DEDUP_REDIS = bool(int(os.getenv('CONSUMER_DEDUP_REDIS', 0)))
+# Directory of the failed writes spool (empty: no spool)
+CONSUMER_SPOOL_DIR = os.getenv('CONSUMER_SPOOL_DIR', '')
+CONSUMER_SPOOL_SEGMENT_MB = int(os.getenv('CONSUMER_SPOOL_SEGMENT_MB', 64))
+# Spool replay records/sec and write deadline before spooling
+CONSUMER_SPOOL_RATE = int(os.getenv('CONSUMER_SPOOL_RATE', 500))
+CONSUMER_SPOOL_DEADLINE_MS = int(os.getenv('CONSUMER_SPOOL_DEADLINE_MS', 2000))
+# Cache queue messages buffered by the background publisher (0: sync publish)
+CONSUMER_PUBLISH_BUFFER = int(os.getenv('CONSUMER_PUBLISH_BUFFER', 10000))
+# Seconds between partial daily stats flushes (0: disabled)
+CONSUMER_STATS_FLUSH_SECS = int(os.getenv('CONSUMER_STATS_FLUSH_SECS', 0))
+# Prometheus metrics port (0: disabled), workers serve on port + slot
+CONSUMER_METRICS_PORT = int(os.getenv('CONSUMER_METRICS_PORT', 0))
+# Seconds between metrics dumps to the log (0: disabled)
+CONSUMER_METRICS_SECS = int(os.getenv('CONSUMER_METRICS_SECS', 0))
+# Seconds between consumer throughput logs of the supervisor
+CONSUMER_STATS_SECS = int(os.getenv('CONSUMER_STATS_SECS', 60))
+
 
 # Services
 SRV_PROTOCOL = os.getenv('SRV_PROTOCOL', 'http')
 SRV_CATALOGUE = ('dev.' if ENV in ['DEV', 'LOCAL'] else '')  + os.getenv('SRV_CATALOGUE', 'catalogue')
 SRV_GEOLOCATION = ('dev.' if ENV in ['DEV', 'LOCAL'] else '') + os.getenv('SRV_GEOLOCATION', 'geolocation')
+# Keep-alive connections per service host, request timeout (secs)
+SRV_POOL_SIZE = int(os.getenv('SRV_POOL_SIZE', 20))
+SRV_TIMEOUT = float(os.getenv('SRV_TIMEOUT', 30))
+# Retries of failed service requests, with exponential backoff (secs)
+SRV_RETRIES = int(os.getenv('SRV_RETRIES', 3))
+SRV_BACKOFF = float(os.getenv('SRV_BACKOFF', 0.3))
+# Seconds Geolocation store lists are cached (0: no cache), shared
+# through redis and/or file snapshots in a directory (empty: none)
+STORE_CACHE_TTL = int(os.getenv('STORE_CACHE_TTL', 3600))
+STORE_CACHE_REDIS = bool(int(os.getenv('STORE_CACHE_REDIS', 0)))
+STORE_CACHE_DIR = os.getenv('STORE_CACHE_DIR', '')
+# Memory-mapped Catalogue snapshot directory (empty: disabled), secs
+# between checks for a new version, max age (secs) of a usable one
+# and the sources it exports (empty: all retailers + dump sources)
+CATALOGUE_SNAPSHOT_DIR = os.getenv('CATALOGUE_SNAPSHOT_DIR', '')
+CATALOGUE_SNAPSHOT_CHECK = int(os.getenv('CATALOGUE_SNAPSHOT_CHECK', 60))
+CATALOGUE_SNAPSHOT_MAX_AGE = int(os.getenv('CATALOGUE_SNAPSHOT_MAX_AGE', 60 * 60 * 48))
+CATALOGUE_SNAPSHOT_SOURCES = os.getenv('CATALOGUE_SNAPSHOT_SOURCES', '')
+# Seconds Catalogue responses are cached per process (0: only
+# concurrent identical requests are shared) and max cached keys
+CATALOGUE_CACHE_TTL = int(os.getenv('CATALOGUE_CACHE_TTL', 300))
+CATALOGUE_CACHE_SIZE = int(os.getenv('CATALOGUE_CACHE_SIZE', 20000))
 
 # Tasks arguments 
 TASK_ARG_CREATE_DUMPS = os.getenv('TASK_ARG_CREATE_DUMPS', 'kelloggs,ims')